@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------
+# bench_check_jvm.py
+#
+# Copyright(C) 2015 Yuichiro SAITO
+# This software is released under the MIT License, see LICENSE.txt.
+# ----------------------------------------------
+
+import sys
+import os
+import json
+import time
+import stat
+import struct
+import shutil
+import resource
+import tempfile
+import subprocess
+import commands
+import logging
+from optparse import OptionParser
+
+import check_jvm
+from check_jvm import _Jvm
+
+# ----------------------------------------------
+# Global Variables
+# ----------------------------------------------
+LOG_FORMAT = '%(levelname)s\t%(asctime)s\t%(name)s\t%(funcName)s\t"%(message)s"'
+BENCH_VERSION = 1
+
+PHASES = ["_getJps", "_getGcUtil", "_getOldStat", "_checkGc"]
+SCENARIOS = {
+    "single": 1,
+    "multi50": 50,
+    "startup": None,
+}
+
+# command name -> interpreter arguments, run from the plugin directory
+STARTUP_COMMANDS = {
+    "interpreter": ["-c", "pass"],
+    "import": ["-c", "import check_jvm"],
+    "script": ["check_jvm.py", "--version"],
+    "launcher": ["check_jvm_launcher.py", "--version"],
+}
+
+PERFDATA_MAGIC = 0xcafec0c0
+PERFDATA_HEADER = ">IBBBBiiqii"
+PERFDATA_ENTRY = "<iiiBBBBi"
+
+GCUTIL_HEADER = "Timestamp         S0     S1     E      O      P     YGC     YGCT    FGC    FGCT     GCT   "
+GCUTIL_FORMAT = "%9.1f %6.2f %6.2f %6.2f %6.2f %6.2f %6d %8.3f %5d %8.3f %8.3f"
+
+JPS_SCRIPT = """#!/bin/sh
+echo jps >> "%(root)s/spawn.log"
+cat "%(root)s/jps.out"
+"""
+
+JSTAT_SCRIPT = """#!/bin/sh
+echo jstat >> "%(root)s/spawn.log"
+cat "%(root)s/jstat/$3$1"
+"""
+
+
+# ----------------------------------------------
+# Synthetic hsperfdata
+# ----------------------------------------------
+
+def writePerfData(path, entries):
+    """
+    Write a minimal little-endian hsperfdata file.
+
+    entries is a list of (name, value); int values are stored as 'J'
+    longs, str values as 'B' byte vectors.
+    """
+
+    body = ""
+    for name, value in entries:
+        name_bytes = name + "\0"
+        if isinstance(value, str):
+            data_type = ord("B")
+            data = value + "\0"
+            vector_length = len(data)
+            units = 5
+        else:
+            data_type = ord("J")
+            data = struct.pack("<q", value)
+            vector_length = 0
+            units = 1
+        name_offset = struct.calcsize(PERFDATA_ENTRY)
+        data_offset = name_offset + len(name_bytes)
+        data_offset += (-data_offset) % 8
+        entry_length = data_offset + len(data)
+        entry_length += (-entry_length) % 8
+        entry = struct.pack(PERFDATA_ENTRY, entry_length, name_offset,
+                            vector_length, data_type, 0, units, 1, data_offset)
+        entry += name_bytes
+        entry += "\0" * (data_offset - len(entry))
+        entry += data
+        entry += "\0" * (entry_length - len(entry))
+        body += entry
+
+    header_size = struct.calcsize(PERFDATA_HEADER)
+    # The magic is always big-endian; the rest follows byte_order (1: little).
+    header = struct.pack(">I", PERFDATA_MAGIC)
+    header += struct.pack("<BBBBiiqii", 1, 2, 0, 1,
+                          header_size + len(body), 0, 0,
+                          header_size, len(entries))
+
+    f = open(path, "wb")
+    f.write(header + body)
+    f.close()
+
+
+# ----------------------------------------------
+# Fake JDK
+# ----------------------------------------------
+
+class _FakeJdk:
+
+    def __init__(self, root, targets, interval):
+
+        self.root = root
+        self.targets = targets
+        self.interval = interval
+        self.bin_dir = os.path.join(root, "bin")
+        self.perf_dir = os.path.join(root, "hsperfdata_bench")
+        self.jstat_dir = os.path.join(root, "jstat")
+        self.spawn_log = os.path.join(root, "spawn.log")
+
+        for path in [self.bin_dir, self.perf_dir, self.jstat_dir]:
+            os.mkdir(path)
+
+        self.pids = {}
+        for i in range(0, targets):
+            self.pids[self.targetName(i)] = 20000 + i
+
+        self._writeScript("jps", JPS_SCRIPT)
+        self._writeScript("jstat", JSTAT_SCRIPT)
+
+        lines = []
+        for name in sorted(self.pids):
+            lines.append("%d %s" % (self.pids[name], name))
+        f = open(os.path.join(root, "jps.out"), "w")
+        f.write("\n".join(lines) + "\n")
+        f.close()
+
+        now_msec = int(time.time() * 1000)
+        for name, pid in self.pids.items():
+            writePerfData(os.path.join(self.perf_dir, str(pid)), [
+                ("sun.rt.createVmBeginTime", now_msec - 86400000),
+                ("sun.rt.javaCommand", name),
+                ("sun.gc.cause", "No GC"),
+                ("sun.gc.lastCause", "Allocation Failure"),
+            ])
+
+        self.setStep(0)
+
+    # ----------------------------------------------
+
+    def targetName(self, i):
+
+        return "BenchTarget%03dMain" % i
+
+    # ----------------------------------------------
+
+    def _writeScript(self, name, template):
+
+        path = os.path.join(self.bin_dir, name)
+        f = open(path, "w")
+        f.write(template % {"root": self.root})
+        f.close()
+        os.chmod(path, stat.S_IRWXU)
+
+    # ----------------------------------------------
+
+    def setStep(self, step):
+        """
+        Advance every fake JVM to the step-th sample.
+        """
+
+        timestamp = 86400.0 + step * self.interval
+        for pid in self.pids.values():
+            values = (timestamp, 0.0, 42.5, 61.2, 55.0, 70.1,
+                      1000 + step * 10, 12.5 + step * 0.1,
+                      10 + step, 2.0 + step * 0.05, 14.5 + step * 0.15)
+            f = open(os.path.join(self.jstat_dir, "%d-gcutil" % pid), "w")
+            f.write(GCUTIL_HEADER + "\n" + GCUTIL_FORMAT % values + "\n")
+            f.close()
+
+    # ----------------------------------------------
+
+    def spawnCounts(self):
+
+        counts = {}
+        if not os.path.exists(self.spawn_log):
+            return counts
+        f = open(self.spawn_log, "r")
+        for line in f:
+            tool = line.strip()
+            counts[tool] = counts.get(tool, 0) + 1
+        f.close()
+
+        return counts
+
+
+# ----------------------------------------------
+# Measurement
+# ----------------------------------------------
+
+def _summary(values):
+
+    if len(values) == 0:
+        return {}
+    ordered = sorted(values)
+    count = len(ordered)
+
+    return {
+        "count": count,
+        "min": ordered[0],
+        "max": ordered[-1],
+        "mean": sum(ordered) / count,
+        "median": ordered[count // 2],
+        "p95": ordered[min(count - 1, int(count * 0.95))],
+    }
+
+
+# ----------------------------------------------
+
+def _instrument(phase_times, spawns):
+    """
+    Wrap the phase methods and the spawn helper, returning a restore function.
+    """
+
+    originals = {}
+
+    def timed(phase, func):
+        def wrapper(self, *args, **kwargs):
+            start = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                phase_times.setdefault(phase, []).append(time.time() - start)
+        return wrapper
+
+    for phase in PHASES:
+        originals[phase] = _Jvm.__dict__[phase]
+        setattr(_Jvm, phase, timed(phase, originals[phase]))
+
+    getoutput = commands.getoutput
+
+    def countingGetoutput(cmd):
+        spawns["shell"] = spawns.get("shell", 0) + 1
+        return getoutput(cmd)
+    commands.getoutput = countingGetoutput
+
+    def restore():
+        for phase in PHASES:
+            setattr(_Jvm, phase, originals[phase])
+        commands.getoutput = getoutput
+
+    return restore
+
+
+# ----------------------------------------------
+
+def runScenario(targets, iterations, interval):
+    """
+    Run main() iterations times for every target and return the metrics.
+    """
+
+    root = tempfile.mkdtemp(prefix="bench_check_jvm.")
+    jdk = _FakeJdk(root, targets, interval)
+    names = sorted(jdk.pids)
+    for name in names:
+        os.mkdir(os.path.join(root, name))
+
+    latencies = []
+    phase_times = {}
+    spawns = {}
+    states = {}
+    restore = _instrument(phase_times, spawns)
+    saved_argv = sys.argv
+    saved_stdout = sys.stdout
+    devnull = open(os.devnull, "w")
+    try:
+        for step in range(0, iterations):
+            jdk.setStep(step)
+            for name in names:
+                sys.argv = ["check_jvm.py",
+                            "-b", jdk.bin_dir,
+                            "-t", os.path.join(root, name),
+                            "-n", name,
+                            "-i", str(interval),
+                            "--perfdata-dir", root]
+                sys.stdout = devnull
+                start = time.time()
+                ret = check_jvm.main()
+                latencies.append(time.time() - start)
+                sys.stdout = saved_stdout
+                states[ret] = states.get(ret, 0) + 1
+    finally:
+        sys.stdout = saved_stdout
+        sys.argv = saved_argv
+        devnull.close()
+        restore()
+
+    tools = jdk.spawnCounts()
+    shutil.rmtree(root)
+
+    phases = {}
+    for phase, values in phase_times.items():
+        phases[phase] = _summary(values)
+        phases[phase]["total"] = sum(values)
+
+    spawn_count = {"shell": spawns.get("shell", 0)}
+    spawn_count.update(tools)
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        "targets": targets,
+        "iterations": iterations,
+        "checks": len(latencies),
+        "latency": _summary(latencies),
+        "latency_per_iteration": sum(latencies) / iterations,
+        "phases": phases,
+        "spawns": spawn_count,
+        "spawns_per_check": float(spawn_count["shell"]) / len(latencies),
+        "states": dict([(str(k), v) for k, v in states.items()]),
+        "peak_rss_kb": self_usage.ru_maxrss,
+        "children_peak_rss_kb": children_usage.ru_maxrss,
+    }
+
+
+# ----------------------------------------------
+
+def runStartup(iterations):
+    """
+    Wall time of fresh interpreters: bare startup, importing the plugin,
+    and running it as a script or through the launcher.
+    """
+
+    directory = os.path.dirname(os.path.abspath(check_jvm.__file__))
+    env = dict(os.environ)
+    # Measure the installed state, where the module bytecode is cached.
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    devnull = open(os.devnull, "w")
+
+    timings = {}
+    for name, args in sorted(STARTUP_COMMANDS.items()):
+        command = [sys.executable] + args
+        subprocess.call(command, cwd=directory, env=env, stdout=devnull)
+        values = []
+        for i in range(0, iterations):
+            start = time.time()
+            subprocess.call(command, cwd=directory, env=env, stdout=devnull)
+            values.append(time.time() - start)
+        timings[name] = _summary(values)
+    devnull.close()
+
+    modules = subprocess.Popen(
+        [sys.executable, "-c",
+         "import sys; before = set(sys.modules); import check_jvm; "
+         "print ' '.join(sorted(set(sys.modules) - before))"],
+        cwd=directory, env=env, stdout=subprocess.PIPE).communicate()[0].split()
+
+    return {
+        "iterations": iterations,
+        "commands": timings,
+        "import_overhead": timings["import"]["median"] - timings["interpreter"]["median"],
+        "import_modules": modules,
+    }
+
+
+# ----------------------------------------------
+
+def runIsolated(func, *args):
+    """
+    Run func in a forked child so that peak RSS is per scenario.
+    """
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            data = json.dumps(func(*args))
+        except Exception, e:
+            data = json.dumps({"error": repr(e)})
+            status = 1
+        f = os.fdopen(write_fd, "w")
+        f.write(data)
+        f.close()
+        os._exit(status)
+
+    os.close(write_fd)
+    f = os.fdopen(read_fd, "r")
+    data = f.read()
+    f.close()
+    os.waitpid(pid, 0)
+
+    return json.loads(data)
+
+
+# ----------------------------------------------
+
+def compareResults(baseline, current):
+    """
+    Ratio of current to baseline for the headline numbers of each scenario.
+    """
+
+    ratios = {}
+    for name, result in current["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if name == "startup" and old is not None:
+            ratios[name] = {
+                "import_overhead": result["import_overhead"] / old["import_overhead"],
+            }
+            continue
+        if old is None or "latency" not in old or "latency" not in result:
+            continue
+        ratios[name] = {
+            "latency_mean": result["latency"]["mean"] / old["latency"]["mean"],
+            "peak_rss_kb": float(result["peak_rss_kb"]) / old["peak_rss_kb"],
+            "spawns_per_check": result["spawns_per_check"] / old["spawns_per_check"],
+        }
+
+    return ratios
+
+
+# -----------------------------------------------
+# Main
+# -----------------------------------------------
+
+def main():
+    """
+    Main
+    """
+
+    usage = "Usage: %prog [option ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-s", "--scenario",
+                      type="choice",
+                      choices=sorted(SCENARIOS.keys()),
+                      action="append",
+                      dest="scenarios",
+                      metavar="<name>",
+                      help="Scenario to run, repeatable. [default: all]")
+    parser.add_option("-n", "--iterations",
+                      type="int",
+                      dest="iterations",
+                      default=20,
+                      metavar="<count>",
+                      help="Check cycles per scenario. [default: %default]")
+    parser.add_option("-i", "--interval",
+                      type="int",
+                      dest="interval",
+                      default=600,
+                      metavar="<sec>",
+                      help="Simulated monitoring interval (sec). [default: %default]")
+    parser.add_option("-o", "--output",
+                      type="string",
+                      dest="output",
+                      metavar="<path>",
+                      help="Write the JSON result to a file instead of stdout.")
+    parser.add_option("--compare",
+                      type="string",
+                      dest="compare",
+                      metavar="<path>",
+                      help="Previous JSON result to compare against.")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL, format=LOG_FORMAT)
+
+    scenarios = options.scenarios or sorted(SCENARIOS.keys())
+    result = {
+        "bench_version": BENCH_VERSION,
+        "program_version": check_jvm.PROGRAM_VERSION,
+        "python": sys.version.split()[0],
+        "timestamp": int(time.time()),
+        "scenarios": {},
+    }
+    for name in scenarios:
+        if SCENARIOS[name] is None:
+            result["scenarios"][name] = runStartup(options.iterations)
+            continue
+        result["scenarios"][name] = runIsolated(
+            runScenario, SCENARIOS[name], options.iterations, options.interval)
+
+    if options.compare is not None:
+        f = open(options.compare, "r")
+        baseline = json.load(f)
+        f.close()
+        result["compare"] = compareResults(baseline, result)
+
+    data = json.dumps(result, indent=4, sort_keys=True)
+    if options.output is None:
+        print data
+    else:
+        f = open(options.output, "w")
+        f.write(data + "\n")
+        f.close()
+
+    return 0
+
+
+# ----------------------------------------------
+
+if __name__ == '__main__':
+    sys.exit(main())
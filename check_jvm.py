@@ -11,13 +11,16 @@
 import sys
 import os
 import re
-import json
+import glob
+import errno
+import struct
+import time
 import os.path
 import commands
-import copy
 import logging
-import logging.config
-from optparse import OptionParser
+
+# json, copy, tempfile, optparse and the config modules are imported where
+# they are used, so that a plain check does not pay for them at startup.
 
 # ----------------------------------------------
 # Global Variables
@@ -27,9 +30,266 @@ PROGRAM_VERSION = "0.0.1"
 
 
 # ----------------------------------------------
-# Internal Class: _Jvm
+# Internal Class: _Rule
 # ----------------------------------------------
-class _Jvm:
+
+class _Rule:
+    """
+    Threshold expression compiled once to a Python function.
+
+    Example: "delta(FGCT) / elapsed > 50", "O > 90 and rate(FGC) > 1/min"
+    Bare names are counters of the current sample, delta(X), rate(X)
+    (per second) and prev(X) read the baseline sample, slope(X) and
+    zscore(X) the TrendAnalysis of the archived window.
+    """
+
+    TOKEN_PATTERN = re.compile(
+        r"\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+)|([A-Za-z_][A-Za-z0-9_]*)|(<=|>=|==|!=|<|>|\+|-|\*|/|\(|\)))")
+    COMPARISONS = ["<", "<=", ">", ">=", "==", "!="]
+    UNITS = {"ms": 0.001, "s": 1.0, "sec": 1.0, "min": 60.0,
+             "h": 3600.0, "hour": 3600.0, "day": 86400.0}
+    FUNCTIONS = {
+        "delta": '(c[%(name)r] - o[%(name)r])',
+        "rate": '((c[%(name)r] - o[%(name)r]) / e)',
+        "prev": 'o[%(name)r]',
+    }
+    TREND_FUNCTIONS = {
+        "slope": 't.slope(%(name)r)',
+        "zscore": 't.zscore(%(name)r)',
+    }
+    KEYWORDS = ["and", "or", "not"]
+
+    # source -> compiled _Rule, shared by every target of a batch run
+    _cache = {}
+
+    # ----------------------------------------------
+
+    def __init__(self, source):
+        """
+        Constractor; raises ValueError on a syntax error.
+        """
+
+        self.source = source
+        self.needs_history = False
+        self.needs_trend = False
+        self.counters = []
+        self.tokens = self._tokenize(source)
+        self.position = 0
+        code = self._parseOr()
+        if self.position != len(self.tokens):
+            raise ValueError("unexpected '%s'" % self.tokens[self.position][1])
+        del self.tokens
+        self.code = code
+        self.func = eval("lambda c, o, e, t: " + code, {"__builtins__": {}})
+
+    # ----------------------------------------------
+
+    def compile(cls, source):
+
+        rule = cls._cache.get(source)
+        if rule is None:
+            rule = cls(source)
+            cls._cache[source] = rule
+
+        return rule
+    compile = classmethod(compile)
+
+    # ----------------------------------------------
+
+    def _tokenize(self, source):
+
+        tokens = []
+        position = 0
+        source = source.rstrip()
+        while position < len(source):
+            match = self.TOKEN_PATTERN.match(source, position)
+            if match is None or match.end() == position:
+                raise ValueError("unexpected '%s'" % source[position:].strip()[0:10])
+            (number, name, operator) = match.groups()
+            if number is not None:
+                tokens.append(("number", number))
+            elif name is not None:
+                tokens.append(("name", name))
+            else:
+                tokens.append(("op", operator))
+            position = match.end()
+
+        return tokens
+
+    # ----------------------------------------------
+
+    def _peek(self):
+
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+
+        return (None, None)
+
+    # ----------------------------------------------
+
+    def _next(self):
+
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError("unexpected end of rule")
+        self.position += 1
+
+        return token
+
+    # ----------------------------------------------
+
+    def _expect(self, value):
+
+        token = self._next()
+        if token[1] != value:
+            raise ValueError("expected '%s' but got '%s'" % (value, token[1]))
+
+    # ----------------------------------------------
+
+    def _parseOr(self):
+
+        code = self._parseAnd()
+        while self._peek() == ("name", "or"):
+            self._next()
+            code = "(%s or %s)" % (code, self._parseAnd())
+
+        return code
+
+    # ----------------------------------------------
+
+    def _parseAnd(self):
+
+        code = self._parseNot()
+        while self._peek() == ("name", "and"):
+            self._next()
+            code = "(%s and %s)" % (code, self._parseNot())
+
+        return code
+
+    # ----------------------------------------------
+
+    def _parseNot(self):
+
+        if self._peek() == ("name", "not"):
+            self._next()
+            return "(not %s)" % self._parseNot()
+
+        return self._parseComparison()
+
+    # ----------------------------------------------
+
+    def _parseComparison(self):
+
+        code = self._parseSum()
+        token = self._peek()
+        if token[0] == "op" and token[1] in self.COMPARISONS:
+            self._next()
+            code = "(%s %s %s)" % (code, token[1], self._parseSum())
+
+        return code
+
+    # ----------------------------------------------
+
+    def _parseSum(self):
+
+        code = self._parseTerm()
+        while self._peek() in [("op", "+"), ("op", "-")]:
+            operator = self._next()[1]
+            code = "(%s %s %s)" % (code, operator, self._parseTerm())
+
+        return code
+
+    # ----------------------------------------------
+
+    def _parseTerm(self):
+
+        code = self._parseUnary()
+        while self._peek() in [("op", "*"), ("op", "/")]:
+            operator = self._next()[1]
+            code = "(%s %s %s)" % (code, operator, self._parseUnary())
+
+        return code
+
+    # ----------------------------------------------
+
+    def _parseUnary(self):
+
+        if self._peek() == ("op", "-"):
+            self._next()
+            return "(-%s)" % self._parseUnary()
+
+        return self._parseAtom()
+
+    # ----------------------------------------------
+
+    def _parseAtom(self):
+
+        (kind, value) = self._next()
+        if kind == "number":
+            return repr(float(value))
+        elif kind == "op" and value == "(":
+            code = self._parseOr()
+            self._expect(")")
+            return code
+        elif kind == "name" and value in self.KEYWORDS:
+            raise ValueError("unexpected '%s'" % value)
+        elif kind == "name" and self._peek() == ("op", "("):
+            if value not in self.FUNCTIONS and value not in self.TREND_FUNCTIONS:
+                raise ValueError("unknown function '%s'" % value)
+            self._next()
+            (arg_kind, arg) = self._next()
+            if arg_kind != "name":
+                raise ValueError("%s() takes a counter name" % value)
+            self._expect(")")
+            self.counters.append(arg)
+            if value in self.TREND_FUNCTIONS:
+                self.needs_trend = True
+                return self.TREND_FUNCTIONS[value] % {"name": arg}
+            self.needs_history = True
+            return self.FUNCTIONS[value] % {"name": arg}
+        elif kind == "name" and value == "elapsed":
+            self.needs_history = True
+            return "e"
+        elif kind == "name" and value in self.UNITS:
+            return repr(self.UNITS[value])
+        elif kind == "name":
+            self.counters.append(value)
+            return "c[%r]" % value
+
+        raise ValueError("unexpected '%s'" % value)
+
+    # ----------------------------------------------
+
+    def evaluate(self, current_stat, old_stat, trend=None):
+        """
+        True/False, or None when the rule cannot be evaluated yet.
+        Raises KeyError for a counter the sample does not have.
+        """
+
+        if self.needs_trend and trend is None:
+            return None
+        if old_stat is None:
+            if self.needs_history:
+                return None
+            elapsed = None
+        else:
+            elapsed = current_stat["Timestamp"] - old_stat["Timestamp"]
+
+        try:
+            return bool(self.func(current_stat, old_stat, elapsed, trend))
+        except (ZeroDivisionError, TypeError):
+            return None
+
+
+# ----------------------------------------------
+# Class: CheckResult
+# ----------------------------------------------
+
+class CheckResult:
+    """
+    Outcome of one evaluation: Nagios state, message without the state
+    prefix, computed metrics and perfdata (label, value, uom, warn, crit).
+    """
 
     STATE_OK = 0
     STATE_WARNING = 1
@@ -37,83 +297,347 @@ class _Jvm:
     STATE_UNKNOWN = 3
     STATE_DEPENDENT = 4
 
-    TEMPFILE_NAME = "jstat_%s.log"
+    STATE_NAMES = {STATE_OK: "OK", STATE_WARNING: "WARNING", STATE_CRITICAL: "CRITICAL",
+                   STATE_UNKNOWN: "UNKNOWN", STATE_DEPENDENT: "DEPENDENT"}
+
+    # Order used to pick the worst of several states.
+    STATE_SEVERITY = {STATE_OK: 0, STATE_WARNING: 1, STATE_UNKNOWN: 2, STATE_CRITICAL: 3}
 
     # ----------------------------------------------
 
-    def __init__(self, java_bin, temp_dir, name, interval):
+    def __init__(self, state, message, metrics=None, perfdata=None):
         """
         Constractor
         """
-        self.log = logging.getLogger(self.__class__.__name__)
 
-        self.log.debug("START")
+        self.state = state
+        self.message = message
+        if metrics is None:
+            metrics = {}
+        self.metrics = metrics
+        if perfdata is None:
+            perfdata = []
+        self.perfdata = perfdata
+
+    # ----------------------------------------------
+
+    def __repr__(self):
+
+        return "<CheckResult %s: %s>" % (self.STATE_NAMES[self.state], self.message)
+
+
+# ----------------------------------------------
+# Class: NagiosOutput
+# ----------------------------------------------
+
+class NagiosOutput:
+    """
+    Plugin output line of a CheckResult.
+    """
+
+    def format(cls, result):
+
+        line = "%s: %s" % (CheckResult.STATE_NAMES[result.state], result.message)
+        if len(result.perfdata) > 0:
+            items = []
+            for label, value, uom, warning, critical in result.perfdata:
+                item = "%s=%g%s;%s;%s" % (label, value, uom,
+                                          cls._formatThreshold(warning),
+                                          cls._formatThreshold(critical))
+                items.append(item.rstrip(";"))
+            line = "%s | %s" % (line, " ".join(items))
+
+        return line
+    format = classmethod(format)
+
+    # ----------------------------------------------
+
+    def _formatThreshold(cls, value):
+        """
+        A number is an upper bound; a string is written as it is, e.g. a
+        Nagios range "@0:2" for metrics where lower is worse.
+        """
+
+        if value is None:
+            return ""
+        if isinstance(value, str):
+            return value
+
+        return "%g" % value
+    _formatThreshold = classmethod(_formatThreshold)
+
+
+# ----------------------------------------------
+# Class: Sampler
+# ----------------------------------------------
+
+class Sampler:
+    """
+    Reads the counters of JVMs on this host through jps, jstat and
+    hsperfdata.
+    """
+
+    PERFDATA_MAGIC = "\xca\xfe\xc0\xc0"
+    PERFDATA_DIR = "/tmp"
+
+    # hsperfdata counters (bytes) added to a sample in KB under the jstat
+    # -gc/-gccapacity names; the permanent generation before JDK 8.
+    METASPACE_COUNTERS = {
+        "MU": "sun.gc.metaspace.used",
+        "MCMX": "sun.gc.metaspace.maxCapacity",
+        "CCSU": "sun.gc.compressedclassspace.used",
+    }
+    PERMGEN_COUNTERS = {
+        "MU": "sun.gc.generation.2.space.0.used",
+        "MCMX": "sun.gc.generation.2.space.0.maxCapacity",
+    }
+    # hsperfdata strings with the JVM options, in the order they apply.
+    # MaxMetaspaceSize found there is added as MMAX (KB); without it
+    # MCMX is only the reserved space, about 1 GB.
+    OPTION_COUNTERS = ["java.rt.vmFlags", "sun.rt.jvmArgs", "java.rt.vmArgs"]
+    METASPACE_LIMIT_PATTERN = re.compile(r"(?:^|\s)(?:-XX:)?MaxMetaspaceSize=(\d+)([kKmMgGtT]?)(?=\s|$)")
+    SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+    # Tenuring policy, occupancy and capacity under the jstat -gcnew/-gc
+    # names, with the divisor to KB (1 for TT and MTT, which are ages).
+    POLICY_COUNTERS = {
+        "TT": ("sun.gc.policy.tenuringThreshold", 1),
+        "MTT": ("sun.gc.policy.maxTenuringThreshold", 1),
+        "DSS": ("sun.gc.policy.desiredSurvivorSize", 1024),
+        "S0U": ("sun.gc.generation.0.space.1.used", 1024),
+        "S1U": ("sun.gc.generation.0.space.2.used", 1024),
+        "OU": ("sun.gc.generation.1.space.0.used", 1024),
+        "EC": ("sun.gc.generation.0.space.0.capacity", 1024),
+        "OC": ("sun.gc.generation.1.space.0.capacity", 1024),
+    }
+    # jstat prints GC times in seconds; samples carry msec, the unit of
+    # the time thresholds.
+    TIME_COLUMNS = ["YGCT", "FGCT", "CGCT", "GCT"]
+    # GC causes under the jstat -gccause names.
+    CAUSE_COUNTERS = {
+        "LGCC": "sun.gc.lastCause",
+        "GCC": "sun.gc.cause",
+    }
+    # Native names (comm, cut at 15 characters) of the HotSpot threads
+    # doing GC work. JDK 8 and earlier name most of them "java".
+    GC_THREAD_PREFIXES = ("GC Thread#", "GC task thread", "Gang worker#", "VM Thread",
+                          "G1 Conc#", "G1 Main Marker", "G1 Refine#", "G1 Young RemSet",
+                          "G1 Service", "Concurrent Mark", "Surrogate Locke",
+                          "ZWorker", "ZDriver", "ZDirector", "Shenandoah")
+    # Columns added by addThreadCpu().
+    THREAD_CPU_COLUMNS = ["GCCPU", "CPU", "NCPU"]
+
+    # ----------------------------------------------
+
+    def __init__(self, java_bin, perfdata_dir=PERFDATA_DIR):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
 
-        self.temp_dir = temp_dir
-        self.interval = interval
         self.java_bin = java_bin
-        self.pid = self._getJps(name)
-        self.current_stat = self._getGcUtil()
-        self.old_stat = self._getOldStat()
-        self.time_warning = None
-        self.time_critical = None
-        self.count_warning = None
-        self.count_critical = None
+        self.perfdata_dir = perfdata_dir
+        # pid -> (jstat header line, layout), see _getLayout()
+        self.layouts = {}
+        # pid -> {tid: whether the thread does GC work}, see getThreadCpu()
+        self.threads = {}
 
-        self.log.debug("END")
+    # ----------------------------------------------
+
+    def listJvms(self):
+        """
+        All running JVMs as a list of (pid, name).
+        """
+
+        return _listJvms(self.java_bin)
 
     # ----------------------------------------------
 
-    def __del__(self):
+    def forget(self, pid):
         """
-        Destructor
+        Drop what is cached for pid, e.g. when the JVM exits.
         """
+
+        self.layouts.pop(pid, None)
+        self.threads.pop(pid, None)
+
+    # ----------------------------------------------
+
+    def getPid(self, name):
+
         self.log.debug("START")
-        pass
+
+        jps = os.path.join(self.java_bin, "jps")
+        cmd = "%s | grep %s | awk '{ print $1 }'" % (jps, name)
+        stdout = commands.getoutput(cmd)
+        self.log.debug(cmd)
+        self.log.debug(stdout)
+        pid = None
+        try:
+            pid = int(stdout)
+        except ValueError:
+            self.log.error("PID get failed.")
+            pid = None
+
         self.log.debug("END")
 
+        return pid
+
     # ----------------------------------------------
 
-    def _printWarning(self, msg):
+    def _parseGcUtil(self, stdout):
+
+        self.log.debug("START")
+
+        data = {}
+        line = stdout.split("\n")
+        headers = line[0].split()
+        values = line[1].split()
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        for header, value in zip(headers, values):
+            if debug:
+                self.log.debug("%s:%s", header, value)
+            try:
+                data[header] = float(value)
+            except ValueError:
+                data[header] = value
+
+        self.log.debug(data)
 
-        print "WARNING: %s" % msg
+        self.log.debug("END")
 
-        return self.STATE_WARNING
+        return data
 
     # ----------------------------------------------
 
-    def _printCritical(self, msg):
+    def _getLayout(self, pid, header):
+        """
+        Column layout of the JDK of pid: whether it has a permanent
+        generation (P) or metaspace (M, CCS), and the hsperfdata counters
+        to read. Detected once per JVM and jstat header.
+        """
+
+        cached = self.layouts.get(pid)
+        if cached is not None and cached[0] == header:
+            return cached[1]
 
-        print "CRITICAL: %s" % msg
+        columns = header.split()
+        if "P" in columns:
+            layout = {"space": "permgen", "aliases": [("P", "M")], "counters": self.PERMGEN_COUNTERS}
+        else:
+            layout = {"space": "metaspace", "aliases": [], "counters": self.METASPACE_COUNTERS}
+        self.log.debug("%d: %s", pid, layout["space"])
+        self.layouts[pid] = (header, layout)
 
-        return self.STATE_CRITICAL
+        return layout
 
     # ----------------------------------------------
 
-    def _printUnknown(self, msg):
+    def _normalize(self, pid, header, data, counters):
+        """
+        Add the columns other JDKs name differently: M from P before
+        JDK 8, and MU, MCMX, CCSU (KB) from hsperfdata when available.
+        MMAX (KB) is the bound of MU: MaxMetaspaceSize when set, see
+        OPTION_COUNTERS, and MCMX for the permanent generation, which
+        MaxPermSize always bounds. CGC/CGCT exist from JDK 9 on. GC
+        times are converted to msec, see TIME_COLUMNS. hsperfdata also
+        gives the tenuring policy, see POLICY_COUNTERS.
+        """
+
+        layout = self._getLayout(pid, header)
+        for column in self.TIME_COLUMNS:
+            if isinstance(data.get(column), float):
+                data[column] *= 1000.0
+        for source, alias in layout["aliases"]:
+            if source in data and alias not in data:
+                data[alias] = data[source]
+        if counters is not None:
+            for column, name in layout["counters"].items():
+                value = counters.get(name)
+                if isinstance(value, (int, long)):
+                    data[column] = value / 1024.0
+            for column, (name, divisor) in self.POLICY_COUNTERS.items():
+                value = counters.get(name)
+                if isinstance(value, (int, long)):
+                    data[column] = value / float(divisor)
+            for column, name in self.CAUSE_COUNTERS.items():
+                value = counters.get(name)
+                if isinstance(value, str):
+                    data[column] = value
+            if layout["space"] == "permgen":
+                if "MCMX" in data:
+                    data["MMAX"] = data["MCMX"]
+            else:
+                limit = self._metaspaceLimit(counters)
+                if limit is not None:
+                    data["MMAX"] = limit / 1024.0
 
-        print "UNKNOWN: %s" % msg
+        return data
+
+    # ----------------------------------------------
+
+    def _metaspaceLimit(self, counters):
+        """
+        MaxMetaspaceSize (bytes) given to the JVM, None when unset; the
+        last occurrence wins as in HotSpot.
+        """
 
-        return self.STATE_UNKNOWN
+        limit = None
+        for name in self.OPTION_COUNTERS:
+            value = counters.get(name)
+            if not isinstance(value, str):
+                continue
+            for number, unit in self.METASPACE_LIMIT_PATTERN.findall(value):
+                limit = int(number) * self.SIZE_UNITS[unit.lower()]
+
+        return limit
 
     # ----------------------------------------------
 
-    def _loadJson(self, path):
+    def _parseGcCause(self, stdout):
+        """
+        jstat -gccause output: the gcutil columns, then LGCC and GCC,
+        which contain spaces and are cut at their header positions.
+        """
 
-        self.log.debug("START")
+        lines = stdout.split("\n")
+        header = lines[0]
+        start = header.index("LGCC")
+        middle = header.index(" GCC", start) + 1
+        data = self._parseGcUtil("%s\n%s" % (header[:start], lines[1][:start]))
+        data["LGCC"] = lines[1][start:middle].strip()
+        data["GCC"] = lines[1][middle:].strip()
 
-        self.log.debug(path)
+        return data
 
-        if not os.path.exists(path):
-            self.log.debug("Not found: %s" % path)
+    # ----------------------------------------------
+
+    def getGcUtil(self, pid, counters=None):
+        """
+        Normalized gcutil counters of pid; counters are its hsperfdata
+        counters, if already read. Without hsperfdata, jstat -gccause is
+        run instead of -gcutil to get the GC causes.
+        """
+
+        self.log.debug("START")
+
+        if pid is None:
+            self.log.error("PID is not set.")
             self.log.debug("EXIT")
             return None
 
-        f = open(path, "r")
-        data = json.load(f)
-        f.close()
-
-        self.log.debug(data)
+        jstat = os.path.join(self.java_bin, "jstat")
+        if counters is not None:
+            cmd = "%s -gcutil -t %d" % (jstat, pid)
+        else:
+            cmd = "%s -gccause -t %d" % (jstat, pid)
+        stdout = commands.getoutput(cmd)
+        self.log.debug(cmd)
+        self.log.debug(stdout)
+        if counters is not None or stdout.find("LGCC") < 0:
+            data = self._parseGcUtil(stdout)
+        else:
+            data = self._parseGcCause(stdout)
+        data = self._normalize(pid, stdout.split("\n")[0], data, counters)
 
         self.log.debug("END")
 
@@ -121,324 +645,3700 @@ class _Jvm:
 
     # ----------------------------------------------
 
-    def _saveJson(self, path, data):
+    def _parsePerfData(self, data):
 
         self.log.debug("START")
 
-        self.log.debug(path)
-        self.log.debug(data)
+        if data[0:4] != self.PERFDATA_MAGIC:
+            self.log.debug("Bad magic.")
+            self.log.debug("EXIT")
+            return None
 
-        f = open(path, "w")
-        json.dump(data, f, indent=4)
-        f.close()
+        if ord(data[4]) == 0:
+            order = ">"
+        else:
+            order = "<"
+        (entry_offset, num_entries) = struct.unpack(order + "ii", data[24:32])
+
+        counters = {}
+        offset = entry_offset
+        for i in range(0, num_entries):
+            (entry_length, name_offset, vector_length, data_type, flags,
+             units, variability, data_offset) = \
+                struct.unpack(order + "iiicbbbi", data[offset:offset + 20])
+            if entry_length <= 0:
+                break
+            name_start = offset + name_offset
+            name = data[name_start:data.index("\0", name_start)]
+            value_start = offset + data_offset
+            if data_type == "J" and vector_length == 0:
+                counters[name] = struct.unpack(
+                    order + "q", data[value_start:value_start + 8])[0]
+            elif data_type == "B" and vector_length > 0:
+                value = data[value_start:value_start + vector_length]
+                counters[name] = value.split("\0", 1)[0]
+            offset += entry_length
+
+        self.log.debug("%d counters", len(counters))
+
+        self.log.debug("END")
+
+        return counters
+
+    # ----------------------------------------------
+
+    def getPerfData(self, pid):
+
+        self.log.debug("START")
+
+        if pid is None:
+            self.log.debug("EXIT")
+            return None
+
+        pattern = os.path.join(self.perfdata_dir, "hsperfdata_*", str(pid))
+        for path in glob.glob(pattern):
+            self.log.debug(path)
+            try:
+                f = open(path, "rb")
+                data = f.read()
+                f.close()
+                counters = self._parsePerfData(data)
+            except (IOError, struct.error, ValueError), e:
+                self.log.debug("Unreadable: %s (%s)", path, e)
+                continue
+            if counters is not None:
+                self.log.debug("END")
+                return counters
 
         self.log.debug("END")
 
-        return 0
+        return None
+
+    # ----------------------------------------------
+
+    def _getProcStartTime(self, pid):
+
+        self.log.debug("START")
+
+        try:
+            f = open("/proc/%d/stat" % pid, "r")
+            stat = f.read()
+            f.close()
+            f = open("/proc/stat", "r")
+            btime = None
+            for line in f:
+                if line.startswith("btime "):
+                    btime = int(line.split()[1])
+            f.close()
+        except IOError, e:
+            self.log.debug("Unreadable: %s", e)
+            self.log.debug("EXIT")
+            return None
+        if btime is None:
+            self.log.debug("EXIT")
+            return None
+
+        # starttime is the 22nd field; comm (2nd) may contain spaces.
+        fields = stat[stat.rindex(")") + 2:].split()
+        ticks = int(fields[19])
+        start_time = int((btime + float(ticks) / os.sysconf("SC_CLK_TCK")) * 1000)
+
+        self.log.debug("END")
+
+        return start_time
+
+    # ----------------------------------------------
+
+    def _readCpuTicks(self, path):
+        """
+        utime + stime of a /proc stat file in clock ticks.
+        """
+
+        f = open(path, "r")
+        stat = f.read()
+        f.close()
+        # utime and stime are the 14th and 15th fields.
+        fields = stat[stat.rindex(")") + 2:].split()
+
+        return int(fields[11]) + int(fields[12])
+
+    # ----------------------------------------------
+
+    def getThreadCpu(self, pid):
+        """
+        (CPU seconds of the GC threads, CPU seconds of the process) of
+        pid, None if /proc is unreadable.
+
+        Threads are classified by name once and the classification is
+        kept per tid, so a sample reads the directory listing, the stat
+        of the GC threads and the comm of new threads only.
+        """
+
+        self.log.debug("START")
+
+        task_dir = "/proc/%d/task" % pid
+        try:
+            tids = os.listdir(task_dir)
+            process_ticks = self._readCpuTicks("/proc/%d/stat" % pid)
+        except (IOError, OSError), e:
+            self.log.debug("Unreadable: %s", e)
+            self.log.debug("EXIT")
+            return None
+
+        known = self.threads.get(pid, {})
+        threads = {}
+        gc_ticks = 0
+        for tid in tids:
+            try:
+                if tid in known:
+                    threads[tid] = known[tid]
+                else:
+                    f = open(os.path.join(task_dir, tid, "comm"), "r")
+                    threads[tid] = f.read().startswith(self.GC_THREAD_PREFIXES)
+                    f.close()
+                if threads[tid]:
+                    gc_ticks += self._readCpuTicks(os.path.join(task_dir, tid, "stat"))
+            except (IOError, OSError, ValueError), e:
+                # The thread has exited since the listing.
+                self.log.debug("Unreadable: %s", e)
+                threads.pop(tid, None)
+        self.threads[pid] = threads
+
+        clock_ticks = float(os.sysconf("SC_CLK_TCK"))
+
+        self.log.debug("END")
+
+        return (gc_ticks / clock_ticks, process_ticks / clock_ticks)
+
+    # ----------------------------------------------
+
+    def addThreadCpu(self, stat, pid):
+        """
+        Add GCCPU and CPU (seconds, see getThreadCpu()) and NCPU, the
+        online cores of the host, to stat unless /proc is unreadable.
+        """
+
+        cpu = self.getThreadCpu(pid)
+        if cpu is not None:
+            (stat["GCCPU"], stat["CPU"]) = cpu
+            stat["NCPU"] = os.sysconf("SC_NPROCESSORS_ONLN")
+
+        return stat
+
+    # ----------------------------------------------
+
+    def getVmStartTime(self, pid, counters=None):
+        """
+        JVM start time (msec since epoch), None if unknown; counters are
+        the hsperfdata counters of pid, if already read.
+        """
+
+        self.log.debug("START")
+
+        if pid is None:
+            self.log.debug("EXIT")
+            return None
+
+        if counters is None:
+            counters = self.getPerfData(pid)
+        if counters is not None and "sun.rt.createVmBeginTime" in counters:
+            start_time = counters["sun.rt.createVmBeginTime"]
+        else:
+            start_time = self._getProcStartTime(pid)
+        self.log.debug("start_time: %s", start_time)
+
+        self.log.debug("END")
+
+        return start_time
+
+    # ----------------------------------------------
+
+    def sample(self, pid):
+        """
+        gcutil counters of pid with "pid" and "start_time" added,
+        None if jstat failed. The CPU columns of addThreadCpu() cost a
+        read of /proc per thread and are left to the caller.
+        """
+
+        self.log.debug("START")
+
+        counters = self.getPerfData(pid)
+        stat = self.getGcUtil(pid, counters)
+        if stat is None:
+            self.log.debug("EXIT")
+            return None
+        stat["pid"] = pid
+        start_time = self.getVmStartTime(pid, counters)
+        if start_time is not None:
+            stat["start_time"] = start_time
+
+        self.log.debug("END")
+
+        return stat
+
+
+# ----------------------------------------------
+# Class: JvmWatcher
+# ----------------------------------------------
+
+class JvmWatcher:
+    """
+    Live table of the JVMs on this host, pid -> name as jps prints it,
+    kept from the hsperfdata_<user> directories: inotify create/delete
+    events when the kernel offers them, a directory listing per update()
+    otherwise. No jps is run.
+
+    Callables in on_start (pid, name) and on_stop (pid) are told about
+    changes, so per-JVM resources can be dropped with the JVM.
+    """
+
+    IN_NONBLOCK = 0x800
+    IN_CLOEXEC = 0x80000
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    EVENT_HEADER = struct.Struct("iIII")
+
+    # A JVM killed with SIGKILL leaves its file behind; the table is
+    # checked against the process list this often (sec).
+    SWEEP_INTERVAL = 60
+
+    # ----------------------------------------------
+
+    def __init__(self, perfdata_dir=Sampler.PERFDATA_DIR, use_inotify=True):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.perfdata_dir = perfdata_dir
+        self.sampler = Sampler(None, perfdata_dir)
+        self.table = {}
+        # pids whose hsperfdata is not filled in yet
+        self.pending = set()
+        self.on_start = []
+        self.on_stop = []
+        self.fd = None
+        self.watches = {}
+        self.swept = time.time()
+        if use_inotify:
+            self._initInotify()
+        self._scan()
+
+    # ----------------------------------------------
+
+    def _initInotify(self):
+
+        import ctypes
+        import ctypes.util
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError), e:
+            self.log.debug("No inotify: %s", e)
+            return
+        if fd < 0:
+            self.log.debug("inotify_init1 failed: %d", ctypes.get_errno())
+            return
+        self.libc = libc
+        self.fd = fd
+        self._addWatch(self.perfdata_dir, self.IN_CREATE | self.IN_MOVED_TO | self.IN_ONLYDIR)
+
+    # ----------------------------------------------
+
+    def _addWatch(self, path, mask):
+
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self.log.debug("Unable to watch %s", path)
+            return
+        self.watches[wd] = path
+
+    # ----------------------------------------------
+
+    def close(self):
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # ----------------------------------------------
+
+    def _jpsName(self, command):
+        """
+        The name jps prints for sun.rt.javaCommand: the jar file, or the
+        main class without its package.
+        """
+
+        fields = command.split()
+        if len(fields) == 0:
+            return ""
+        main = fields[0]
+        if main.endswith(".jar"):
+            return os.path.basename(main)
+
+        return main.split(".")[-1]
+
+    # ----------------------------------------------
+
+    def _add(self, path):
+
+        name = os.path.basename(path)
+        if not name.isdigit():
+            return
+        pid = int(name)
+        if pid in self.table:
+            return
+        try:
+            f = open(path, "rb")
+            data = f.read()
+            f.close()
+            counters = self.sampler._parsePerfData(data)
+        except (IOError, struct.error, ValueError):
+            counters = None
+        if counters is None or "sun.rt.javaCommand" not in counters:
+            self.pending.add(pid)
+            return
+        self.pending.discard(pid)
+        self.table[pid] = self._jpsName(counters["sun.rt.javaCommand"])
+        self.log.debug("start: %d %s", pid, self.table[pid])
+        for callback in self.on_start:
+            callback(pid, self.table[pid])
+
+    # ----------------------------------------------
+
+    def _remove(self, pid):
+
+        self.pending.discard(pid)
+        if pid not in self.table:
+            return
+        self.log.debug("stop: %d %s", pid, self.table[pid])
+        del self.table[pid]
+        for callback in self.on_stop:
+            callback(pid)
+
+    # ----------------------------------------------
+
+    def _scan(self):
+        """
+        Reconcile the table with the directory listing.
+        """
+
+        seen = set()
+        for directory in glob.glob(os.path.join(self.perfdata_dir, "hsperfdata_*")):
+            if self.fd is not None and directory not in self.watches.values():
+                self._addWatch(directory, self.IN_CREATE | self.IN_CLOSE_WRITE | self.IN_DELETE |
+                               self.IN_MOVED_FROM | self.IN_MOVED_TO)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                if name.isdigit():
+                    seen.add(int(name))
+                    self._add(os.path.join(directory, name))
+        for pid in list(self.table.keys()) + list(self.pending):
+            if pid not in seen:
+                self._remove(pid)
+
+    # ----------------------------------------------
+
+    def _sweep(self):
+
+        for pid in list(self.table.keys()):
+            try:
+                os.kill(pid, 0)
+            except OSError, e:
+                if e.errno == errno.ESRCH:
+                    self._remove(pid)
+
+    # ----------------------------------------------
+
+    def _readEvents(self):
+
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        self._handleEvents(data)
+
+    # ----------------------------------------------
+
+    def _handleEvents(self, data):
+
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            (wd, mask, cookie, length) = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost: reconcile with the directories.
+                self.log.debug("inotify queue overflow")
+                self._scan()
+                self._sweep()
+                continue
+            if mask & self.IN_IGNORED:
+                # The watched directory is gone; _scan() watches one
+                # created again under the same name.
+                directory = self.watches.pop(wd, None)
+                self.log.debug("watch removed: %s", directory)
+                if directory is not None and directory != self.perfdata_dir:
+                    self._scan()
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or name == "":
+                continue
+            path = os.path.join(directory, name)
+            if directory == self.perfdata_dir:
+                if mask & self.IN_ISDIR and name.startswith("hsperfdata_"):
+                    self._scan()
+            elif not name.isdigit():
+                continue
+            elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                self._remove(int(name))
+            else:
+                self._add(path)
+
+    # ----------------------------------------------
+
+    def update(self, timeout=0):
+        """
+        Apply the changes since the last call, waiting up to timeout
+        seconds for one; returns True if the table may have changed.
+        """
+
+        import select
+
+        if self.fd is None:
+            if timeout > 0:
+                time.sleep(timeout)
+            self._scan()
+            return True
+
+        (readable, writable, errors) = select.select([self.fd], [], [], timeout)
+        if len(readable) > 0:
+            self._readEvents()
+        for pid in list(self.pending):
+            for path in glob.glob(os.path.join(self.perfdata_dir, "hsperfdata_*", str(pid))):
+                self._add(path)
+        now = time.time()
+        if now - self.swept >= self.SWEEP_INTERVAL:
+            self._sweep()
+            self.swept = now
+
+        return len(readable) > 0
+
+    # ----------------------------------------------
+
+    def jvms(self):
+        """
+        The table as a sorted list of (pid, name), like _listJvms().
+        """
+
+        return sorted(self.table.items())
+
+
+# ----------------------------------------------
+# Class: HistoryStore
+# ----------------------------------------------
+
+class HistoryStore:
+    """
+    The two most recent samples of one target, kept as JSON files in
+    temp_dir, and the choice of the baseline one interval back.
+    """
+
+    TEMPFILE_NAME = "jstat_%s.log"
+    TEMPFILE_KEY_NAME = "jstat_%s_%%s.log"
+
+    # Format of the stored samples, archive and adaptive state. Version 1,
+    # unmarked, kept GC times in seconds as jstat prints them; version 2
+    # keeps msec, see Sampler.TIME_COLUMNS. Older state is not compared
+    # but started over.
+    VERSION = 2
+    # Counters which only grow during one JVM lifetime.
+    MONOTONIC_COLUMNS = ["Timestamp", "YGC", "YGCT", "FGC", "FGCT", "GCT"]
+    # createVmBeginTime and /proc starttime differ by the JVM boot time.
+    START_TIME_TOLERANCE = 10000
+    # GC causes which always start a full GC, see _attributeCauses().
+    FULL_GC_CAUSES = ["System.gc()", "Heap Inspection Initiated GC", "Heap Dump Initiated GC",
+                      "Diagnostic Command", "Last ditch collection"]
+    UNKNOWN_CAUSE = "unknown"
+
+    # Consolidated archive: (tier, step, retention) from raw samples to
+    # 10-minute rows; counters are kept as deltas, gauges as values.
+    ARCHIVE_TIERS = [("raw", 0, 3600), ("60", 60, 86400), ("600", 600, 30 * 86400)]
+    ARCHIVE_COUNTERS = ["YGC", "YGCT", "FGC", "FGCT", "CGC", "CGCT", "GCT"]
+    ARCHIVE_GAUGES = ["S0", "S1", "E", "O", "P", "M", "CCS", "OU", "OC", "EC"]
+    WINDOW_RESOLUTION = 10
+
+    # ----------------------------------------------
+
+    def __init__(self, temp_dir, interval, key=None):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.temp_dir = temp_dir
+        self.interval = interval
+        self.archive = False
+        if key is None:
+            self.tempfile_name = self.TEMPFILE_NAME
+        else:
+            self.tempfile_name = self.TEMPFILE_KEY_NAME % key
+
+    # ----------------------------------------------
+
+    def _loadJson(self, path):
+
+        self.log.debug("START")
+
+        self.log.debug(path)
+
+        if not os.path.exists(path):
+            self.log.debug("Not found: %s", path)
+            self.log.debug("EXIT")
+            return None
+
+        import json
+
+        f = open(path, "r")
+        data = json.load(f)
+        f.close()
+
+        self.log.debug(data)
+
+        self.log.debug("END")
+
+        return data
+
+    # ----------------------------------------------
+
+    def _saveJson(self, path, data):
+
+        self.log.debug("START")
+
+        self.log.debug(path)
+        self.log.debug(data)
+
+        import json
+
+        f = open(path, "w")
+        json.dump(data, f, indent=4)
+        f.close()
+
+        self.log.debug("END")
+
+        return 0
+
+    # ----------------------------------------------
+
+    def remove(self):
+        """
+        Delete the files of this history, e.g. when its JVM has exited.
+        """
+
+        self.log.debug("START")
+
+        names = ["1", "2", "last", "adaptive", "threads", "archive_state"]
+        names += ["archive_%s" % tier for tier, step, retention in self.ARCHIVE_TIERS]
+        for name in names:
+            path = os.path.join(self.temp_dir, self.tempfile_name % name)
+            for candidate in [path, path + ".tmp"]:
+                if os.path.exists(candidate):
+                    os.remove(candidate)
+
+        self.log.debug("END")
+
+        return 0
+
+    # ----------------------------------------------
+
+    def loadThreads(self, pid, start_time=None):
+        """
+        tid -> whether it is a GC thread, as saved by saveThreads() for
+        the same JVM; empty otherwise.
+        """
+
+        saved = self._loadJson(os.path.join(self.temp_dir, self.tempfile_name % "threads"))
+        if saved is None or not self._isSameJvm(saved, {}, pid, start_time):
+            return {}
+
+        return saved["threads"]
+
+    # ----------------------------------------------
+
+    def saveThreads(self, pid, start_time, threads):
+        """
+        Keep the GC thread classification of Sampler.getThreadCpu(), so
+        a one-shot check reads the comm of new threads only.
+        """
+
+        saved = {"version": self.VERSION, "pid": pid, "start_time": start_time, "threads": threads}
+        self._saveJson(os.path.join(self.temp_dir, self.tempfile_name % "threads"), saved)
+
+    # ----------------------------------------------
+
+    def _isSameJvm(self, history, current_stat, pid, start_time):
+        """
+        Whether history was sampled from the current JVM lifetime.
+        """
+
+        self.log.debug("START")
+
+        if history.get("version") != self.VERSION:
+            self.log.debug("Format changed: %s -> %s", history.get("version"), self.VERSION)
+            self.log.debug("EXIT")
+            return False
+
+        if history["pid"] != pid:
+            self.log.debug("PID changed: %s -> %s", history["pid"], pid)
+            self.log.debug("EXIT")
+            return False
+
+        if start_time is not None and history.get("start_time") is not None \
+                and abs(history["start_time"] - start_time) > self.START_TIME_TOLERANCE:
+            self.log.debug("Start time changed: %s -> %s", history["start_time"], start_time)
+            self.log.debug("EXIT")
+            return False
+
+        for column in self.MONOTONIC_COLUMNS:
+            if column in history and column in current_stat \
+                    and current_stat[column] < history[column]:
+                self.log.debug("%s went backwards: %s -> %s", column, history[column], current_stat[column])
+                self.log.debug("EXIT")
+                return False
+
+        self.log.debug("END")
+
+        return True
+
+    # ----------------------------------------------
+
+    def _archivePath(self, tier):
+
+        return os.path.join(self.temp_dir, self.tempfile_name % ("archive_%s" % tier))
+
+    # ----------------------------------------------
+
+    def _loadArchiveState(self):
+
+        state = self._loadJson(self._archivePath("state"))
+        if state is not None and state.get("version") != self.VERSION:
+            self.log.debug("Archive format changed: %s -> %s", state.get("version"), self.VERSION)
+            for tier, step, retention in self.ARCHIVE_TIERS:
+                if os.path.exists(self._archivePath(tier)):
+                    os.remove(self._archivePath(tier))
+            state = None
+        if state is None:
+            state = {"version": self.VERSION, "last": None, "open": {}, "pruned": {}}
+
+        return state
+
+    # ----------------------------------------------
+
+    def _archiveValues(self, current_stat, last, pid, start_time):
+        """
+        Counter deltas since last and current gauge values of one sample.
+        """
+
+        values = {}
+        if last is not None and self._isSameJvm(last, current_stat, pid, start_time):
+            for column in self.ARCHIVE_COUNTERS:
+                if column in current_stat and column in last:
+                    delta = current_stat[column] - last[column]
+                    values[column] = [delta, delta, delta]
+        for column in self.ARCHIVE_GAUGES:
+            value = current_stat.get(column)
+            if isinstance(value, float):
+                values[column] = [value, value, value]
+
+        return values
+
+    # ----------------------------------------------
+
+    def _mergeRow(self, row, values):
+
+        row[1] += 1
+        for column, (low, high, total) in values.items():
+            if column in row[2]:
+                merged = row[2][column]
+                merged[0] = min(merged[0], low)
+                merged[1] = max(merged[1], high)
+                merged[2] += total
+            else:
+                row[2][column] = [low, high, total]
+
+    # ----------------------------------------------
+
+    def _appendRows(self, tier, rows):
+
+        import json
+
+        f = open(self._archivePath(tier), "a")
+        for row in rows:
+            f.write(json.dumps(row, separators=(",", ":")) + "\n")
+        f.close()
+
+    # ----------------------------------------------
+
+    def _readRows(self, tier, start, end):
+
+        import json
+
+        rows = []
+        path = self._archivePath(tier)
+        if not os.path.exists(path):
+            return rows
+        f = open(path, "r")
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if start <= row[0] <= end:
+                rows.append(row)
+        f.close()
+
+        return rows
+
+    # ----------------------------------------------
+
+    def _pruneTier(self, tier, retention, now):
+        """
+        Drop rows older than retention by rewriting the tier file.
+        """
+
+        import json
+
+        path = self._archivePath(tier)
+        rows = self._readRows(tier, now - retention, now)
+        f = open(path + ".tmp", "w")
+        for row in rows:
+            f.write(json.dumps(row, separators=(",", ":")) + "\n")
+        f.close()
+        os.rename(path + ".tmp", path)
+
+    # ----------------------------------------------
+
+    def record(self, current_stat, now=None, pid=None, start_time=None):
+        """
+        Add one sample to the consolidated archive: raw rows, and rows per
+        ARCHIVE_TIERS step holding min, max and sum of the values.
+        """
+
+        self.log.debug("START")
+
+        if now is None:
+            now = time.time()
+        if pid is None:
+            pid = current_stat.get("pid")
+        if start_time is None:
+            start_time = current_stat.get("start_time")
+
+        state = self._loadArchiveState()
+        values = self._archiveValues(current_stat, state["last"], pid, start_time)
+        self._appendRows("raw", [[now, 1, values]])
+
+        for tier, step, retention in self.ARCHIVE_TIERS[1:]:
+            bucket = int(now // step) * step
+            row = state["open"].get(tier)
+            if row is not None and row[0] != bucket:
+                self._appendRows(tier, [row])
+                row = None
+            if row is None:
+                row = [bucket, 0, {}]
+            self._mergeRow(row, values)
+            state["open"][tier] = row
+
+        # Rewrite a tier once every half retention, so a tier file holds
+        # at most one and a half retention of rows.
+        for tier, step, retention in self.ARCHIVE_TIERS:
+            pruned = state["pruned"].get(tier)
+            if pruned is None:
+                state["pruned"][tier] = now
+            elif now - pruned >= retention / 2:
+                self._pruneTier(tier, retention, now)
+                state["pruned"][tier] = now
+
+        last = {"version": self.VERSION, "pid": pid, "start_time": start_time}
+        for column in self.MONOTONIC_COLUMNS:
+            if column in current_stat:
+                last[column] = current_stat[column]
+        state["last"] = last
+        self._saveJson(self._archivePath("state"), state)
+
+        self.log.debug("END")
+
+        return 0
+
+    # ----------------------------------------------
+
+    def _chooseTier(self, start, now, step):
+        """
+        The coarsest tier not coarser than step which still covers start;
+        the coarsest covering tier if none does.
+        """
+
+        chosen = None
+        for tier in self.ARCHIVE_TIERS:
+            if tier[1] <= step and now - tier[2] <= start:
+                chosen = tier
+        if chosen is None:
+            for tier in self.ARCHIVE_TIERS:
+                chosen = tier
+                if now - tier[2] <= start:
+                    break
+
+        return chosen
+
+    # ----------------------------------------------
+
+    def query(self, start, end=None, step=0, now=None):
+        """
+        Archive rows from start to end (seconds since epoch) at a
+        resolution of at most step seconds where retention allows.
+
+        Returns (step, rows); a row is (time, samples, {column: (min, max, avg)}).
+        """
+
+        self.log.debug("START")
+
+        if now is None:
+            now = time.time()
+        if end is None:
+            end = now
+
+        (tier, tier_step, retention) = self._chooseTier(start, now, step)
+        self.log.debug("tier: %s", tier)
+        rows = self._readRows(tier, start, end)
+        if tier_step > 0:
+            row = self._loadArchiveState()["open"].get(tier)
+            if row is not None and start <= row[0] <= end:
+                rows.append(row)
+
+        result = []
+        for row_time, samples, values in rows:
+            columns = {}
+            for column, (low, high, total) in values.items():
+                columns[column] = (low, high, total / samples)
+            result.append((row_time, samples, columns))
+
+        self.log.debug("END")
+
+        return (tier_step, result)
+
+    # ----------------------------------------------
+
+    def summary(self, column, seconds, now=None):
+        """
+        min, max, avg and sum of column over the last seconds, read from
+        the coarsest tier giving WINDOW_RESOLUTION rows; None if no data.
+        """
+
+        if now is None:
+            now = time.time()
+
+        (step, rows) = self.query(now - seconds, now, seconds / self.WINDOW_RESOLUTION, now)
+        low = None
+        high = None
+        total = 0.0
+        samples = 0
+        for row_time, count, columns in rows:
+            if column not in columns:
+                continue
+            (row_low, row_high, row_avg) = columns[column]
+            if low is None or row_low < low:
+                low = row_low
+            if high is None or row_high > high:
+                high = row_high
+            total += row_avg * count
+            samples += count
+        if samples == 0:
+            return None
+
+        return {"min": low, "max": high, "avg": total / samples, "sum": total}
+
+    # ----------------------------------------------
+
+    def _lastSample(self):
+
+        return self._loadJson(os.path.join(self.temp_dir, self.tempfile_name % "last"))
+
+    # ----------------------------------------------
+
+    def _saveLastSample(self, sample):
+
+        last = {"version": self.VERSION, "pid": sample["pid"], "start_time": sample.get("start_time"),
+                "causes": sample["causes"]}
+        for column in self.MONOTONIC_COLUMNS:
+            if column in sample:
+                last[column] = sample[column]
+        self._saveJson(os.path.join(self.temp_dir, self.tempfile_name % "last"), last)
+
+    # ----------------------------------------------
+
+    def _attributeCauses(self, current_stat, pid, start_time):
+        """
+        Set current_stat["causes"], cause -> [full GC count, full GC time]
+        accumulated over the samples of this JVM.
+
+        LGCC is the cause of the last GC of any kind, so the full GCs
+        since the previous sample are charged to it only when no young GC
+        ran in between. Otherwise they go to GCC when a GC of a cause in
+        FULL_GC_CAUSES was running at sampling time, else to UNKNOWN_CAUSE.
+        """
+
+        self.log.debug("START")
+
+        causes = {}
+        last = self._lastSample()
+        if last is not None and "causes" in last and self._isSameJvm(last, current_stat, pid, start_time):
+            for cause, values in last["causes"].items():
+                causes[cause] = list(values)
+            count = current_stat["FGC"] - last["FGC"]
+            gc_time = current_stat["FGCT"] - last["FGCT"]
+            if count > 0 or gc_time > 0:
+                if current_stat.get("YGC") == last.get("YGC"):
+                    cause = current_stat["LGCC"]
+                elif current_stat.get("GCC") in self.FULL_GC_CAUSES:
+                    cause = current_stat["GCC"]
+                else:
+                    cause = self.UNKNOWN_CAUSE
+                values = causes.setdefault(cause, [0.0, 0.0])
+                values[0] += count
+                values[1] += gc_time
+        current_stat["causes"] = causes
+        sample = dict(current_stat)
+        sample["pid"] = pid
+        if start_time is not None:
+            sample["start_time"] = start_time
+        self._saveLastSample(sample)
+
+        self.log.debug("END")
+
+    # ----------------------------------------------
+
+    def baseline(self, current_stat, pid=None, start_time=None):
+        """
+        Record current_stat and return the sample taken between one and
+        two intervals earlier, or None while collecting data.
+
+        pid and start_time default to the values stored in current_stat.
+        The sample is also added to the archive when archive is set, and
+        gets "causes" when it has a GC cause, see _attributeCauses().
+        """
+
+        self.log.debug("START")
+
+        if pid is None:
+            pid = current_stat.get("pid")
+        if start_time is None:
+            start_time = current_stat.get("start_time")
+
+        if self.archive:
+            self.record(current_stat, pid=pid, start_time=start_time)
+        if "LGCC" in current_stat:
+            self._attributeCauses(current_stat, pid, start_time)
+
+        history = self._chooseBaseline(current_stat, pid, start_time)
+
+        self.log.debug("END")
+
+        return history
+
+    # ----------------------------------------------
+
+    def _chooseBaseline(self, current_stat, pid, start_time):
+
+        self.log.debug("START")
+
+        history_filename = os.path.join(self.temp_dir, self.tempfile_name)
+        history1_filename = history_filename % "1"
+        history2_filename = history_filename % "2"
+
+        history1 = self._loadJson(history1_filename)
+        history2 = self._loadJson(history2_filename)
+
+        # check different process
+        if history1 is not None and not self._isSameJvm(history1, current_stat, pid, start_time):
+            self.log.debug("Target process is restarted (1).")
+            history1 = None
+            history2 = None
+        if history2 is not None and not self._isSameJvm(history2, current_stat, pid, start_time):
+            self.log.debug("Target process is restarted (2).")
+            history1 = None
+            history2 = None
+
+        # choice history
+        using = 0
+        if history1 is None:
+            self.log.debug("Initialize phase.")
+        else:
+            history1_diff = current_stat["Timestamp"] - history1["Timestamp"]
+            history2_diff = current_stat["Timestamp"] - history2["Timestamp"]
+            self.log.debug("history1: %d, history2: %d", history1_diff, history2_diff)
+            if self.interval > history1_diff \
+                    and (self.interval > history2_diff or history2_diff >= self.interval * 2):
+                self.log.debug("Early phase (1).")
+                self.log.debug("EXIT")
+                return None
+            elif self.interval > history2_diff \
+                    and (self.interval > history1_diff or history1_diff >= self.interval * 2):
+                self.log.debug("Early phase (2).")
+                self.log.debug("EXIT")
+                return None
+            elif self.interval <= history1_diff and history1_diff < self.interval * 2:
+                using = 1
+            elif self.interval <= history2_diff and history2_diff < self.interval * 2:
+                using = 2
+            else:
+                self.log.debug("Data is too old.")
+                using = 0
+        self.log.debug("Using %d", using)
+
+        # choice data
+        history = None
+        if using == 1:
+            history = history1
+        elif using == 2:
+            history = history2
+        self.log.debug(history)
+
+        # save history
+        save_stat = dict(current_stat)
+        save_stat["version"] = self.VERSION
+        save_stat["pid"] = pid
+        if start_time is not None:
+            save_stat["start_time"] = start_time
+        if using == 0:
+            self._saveJson(history1_filename, save_stat)
+            self._saveJson(history2_filename, save_stat)
+        elif using == 1:
+            if history2 is None or history1["Timestamp"] >= history2["Timestamp"]:
+                self._saveJson(history2_filename, save_stat)
+        elif using == 2:
+            if history2["Timestamp"] >= history1["Timestamp"]:
+                self._saveJson(history1_filename, save_stat)
+
+        self.log.debug("END")
+
+        return history
+
+
+# ----------------------------------------------
+# Class: SqliteHistory
+# ----------------------------------------------
+
+class SqliteHistory:
+    """
+    The samples of all targets in one SQLite file, indexed by
+    (target, time); an alternative to the JSON files of HistoryStore for
+    hosts with many JVMs.
+
+    Outside a batch every sample is committed on its own. Between
+    beginBatch() and commit() the inserts share one transaction.
+    """
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS samples (target TEXT NOT NULL, time REAL NOT NULL, data TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS samples_target_time ON samples (target, time)",
+    ]
+    # Rows deleted per insert, so pruning never stalls one check.
+    PRUNE_LIMIT = 100
+    # Rows of targets which are no longer checked are dropped after this.
+    STALE_AGE = 7 * 86400
+    BUSY_TIMEOUT = 10.0
+
+    # ----------------------------------------------
+
+    def __init__(self, path):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.path = path
+        self.batch = False
+        self.connection = None
+
+    # ----------------------------------------------
+
+    def _connect(self):
+
+        if self.connection is not None:
+            return self.connection
+
+        import sqlite3
+
+        self.log.debug("START")
+
+        connection = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+        self.connection = connection
+
+        self.log.debug("END")
+
+        return connection
+
+    # ----------------------------------------------
+
+    def store(self, temp_dir, interval, key=None):
+        """
+        A HistoryStore of one target kept in this file.
+        """
+
+        return SqliteHistoryStore(self, temp_dir, interval, key)
+
+    # ----------------------------------------------
+
+    def beginBatch(self):
+
+        self.batch = True
+
+    # ----------------------------------------------
+
+    def commit(self):
+
+        self.batch = False
+        if self.connection is not None:
+            self.connection.commit()
+
+    # ----------------------------------------------
+
+    def close(self):
+
+        self.commit()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    # ----------------------------------------------
+
+    def last(self, target):
+        """
+        The newest sample of target, None if there is none.
+        """
+
+        import json
+
+        connection = self._connect()
+        row = connection.execute(
+            "SELECT data FROM samples WHERE target = ? ORDER BY time DESC, rowid DESC LIMIT 1",
+            (target, )).fetchone()
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    # ----------------------------------------------
+
+    def recent(self, target, since):
+        """
+        Samples of target stored at or after since, newest first.
+        """
+
+        import json
+
+        connection = self._connect()
+        cursor = connection.execute(
+            "SELECT data FROM samples WHERE target = ? AND time >= ? ORDER BY time DESC, rowid DESC",
+            (target, since))
+
+        return [json.loads(data) for (data, ) in cursor]
+
+    # ----------------------------------------------
+
+    def insert(self, target, now, stat, retention):
+        """
+        Store stat and drop at most PRUNE_LIMIT rows older than retention.
+        """
+
+        import json
+
+        connection = self._connect()
+        connection.execute("INSERT INTO samples (target, time, data) VALUES (?, ?, ?)",
+                           (target, now, json.dumps(stat, separators=(",", ":"))))
+        connection.execute(
+            "DELETE FROM samples WHERE rowid IN "
+            "(SELECT rowid FROM samples WHERE target = ? AND time < ? LIMIT ?)",
+            (target, now - retention, self.PRUNE_LIMIT))
+        connection.execute(
+            "DELETE FROM samples WHERE rowid IN "
+            "(SELECT rowid FROM samples WHERE time < ? LIMIT ?)",
+            (now - self.STALE_AGE, self.PRUNE_LIMIT))
+        if not self.batch:
+            connection.commit()
+
+
+# ----------------------------------------------
+# Class: SqliteHistoryStore
+# ----------------------------------------------
+
+class SqliteHistoryStore(HistoryStore):
+    """
+    HistoryStore keeping the samples in a SqliteHistory. The baseline is
+    the newest sample of the same JVM between one and two intervals old,
+    as with the JSON files; the archive still lives in temp_dir.
+    """
+
+    # ----------------------------------------------
+
+    def __init__(self, database, temp_dir, interval, key=None):
+        """
+        Constractor
+        """
+        HistoryStore.__init__(self, temp_dir, interval, key)
+
+        self.database = database
+        if key is None:
+            self.target = ""
+        else:
+            self.target = key
+
+    # ----------------------------------------------
+
+    def _lastSample(self):
+
+        return self.database.last(self.target)
+
+    # ----------------------------------------------
+
+    def _saveLastSample(self, sample):
+
+        # Every sample is inserted by _chooseBaseline().
+        pass
+
+    # ----------------------------------------------
+
+    def _chooseBaseline(self, current_stat, pid, start_time):
+
+        self.log.debug("START")
+
+        now = time.time()
+        retention = self.interval * 3
+        history = None
+        for sample in self.database.recent(self.target, now - retention):
+            if not self._isSameJvm(sample, current_stat, pid, start_time):
+                self.log.debug("Target process is restarted.")
+                break
+            diff = current_stat["Timestamp"] - sample["Timestamp"]
+            if self.interval <= diff and diff < self.interval * 2:
+                history = sample
+                break
+            if diff >= self.interval * 2:
+                self.log.debug("Data is too old.")
+                break
+        self.log.debug(history)
+
+        save_stat = dict(current_stat)
+        save_stat["version"] = self.VERSION
+        save_stat["pid"] = pid
+        if start_time is not None:
+            save_stat["start_time"] = start_time
+        self.database.insert(self.target, now, save_stat, retention)
+
+        self.log.debug("END")
+
+        return history
+
+
+# ----------------------------------------------
+# Class: TrendAnalysis
+# ----------------------------------------------
+
+class TrendAnalysis:
+    """
+    Delta, rate, slope and z-score of every archived column over one
+    window, computed in one pass over columnar arrays (NumPy when it is
+    installed, the array module otherwise).
+
+    Counters are analysed as rates per second, gauges as values. The
+    z-score compares the window mean with the same hour of day on earlier
+    days, or with the window itself while less than SEASON_MIN_ROWS such
+    rows exist. Accessors raise KeyError for an unknown column and
+    ZeroDivisionError when the window has too few samples.
+    """
+
+    SEASON_DAYS = 7
+    SEASON_SLOT = 3600
+    SEASON_MIN_ROWS = 3
+
+    # ----------------------------------------------
+
+    def __init__(self, times, levels, deltas, reference=None):
+        """
+        Constractor
+
+        times: sample times; levels/deltas: column -> values per sample
+        (None where missing); reference: column -> earlier levels of the
+        same season.
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.columns = sorted(levels.keys())
+        self.results = {}
+        if len(times) > 0 and len(self.columns) > 0:
+            numpy = _importNumpy()
+            if numpy is not None:
+                self._analyzeNumpy(numpy, times, levels, deltas, reference or {})
+            else:
+                self._analyzeArray(times, levels, deltas, reference or {})
+
+    # ----------------------------------------------
+
+    def fromArchive(cls, history, seconds, now=None):
+        """
+        Analyse the last seconds of the archive of a HistoryStore.
+        """
+
+        if now is None:
+            now = time.time()
+
+        (step, rows) = history.query(now - seconds, now, 0, now)
+        times = []
+        levels = {}
+        deltas = {}
+        previous = None
+        for index, (row_time, count, columns) in enumerate(rows):
+            times.append(row_time)
+            for column, (low, high, value) in columns.items():
+                if column not in levels:
+                    levels[column] = [None] * index
+                    deltas[column] = [None] * index
+                if column in HistoryStore.ARCHIVE_COUNTERS:
+                    # value is the average delta of the samples in the row
+                    deltas[column].append(value * count)
+                    if previous is not None and row_time > previous:
+                        levels[column].append(value * count / (row_time - previous))
+                    else:
+                        levels[column].append(None)
+                else:
+                    deltas[column].append(None)
+                    levels[column].append(value)
+            for column in levels:
+                if len(levels[column]) <= index:
+                    levels[column].append(None)
+                    deltas[column].append(None)
+            previous = row_time
+
+        # same hour of day on earlier days, from the 10-minute tier
+        reference = {}
+        slot = int(now % 86400) // cls.SEASON_SLOT
+        (step, season_rows) = history.query(now - cls.SEASON_DAYS * 86400,
+                                            now - 86400 + cls.SEASON_SLOT, 600, now)
+        for row_time, count, columns in season_rows:
+            if int(row_time % 86400) // cls.SEASON_SLOT != slot or step == 0:
+                continue
+            for column, (low, high, value) in columns.items():
+                if column in HistoryStore.ARCHIVE_COUNTERS:
+                    value = value * count / step
+                reference.setdefault(column, []).append(value)
+
+        return cls(times, levels, deltas, reference)
+    fromArchive = classmethod(fromArchive)
+
+    # ----------------------------------------------
+
+    def _analyzeArray(self, times, levels, deltas, reference):
+
+        from array import array
+
+        for column in self.columns:
+            points = [(t, y) for t, y in zip(times, levels[column]) if y is not None]
+            t = array("d", [point[0] for point in points])
+            y = array("d", [point[1] for point in points])
+            n = len(y)
+            result = {"delta": None, "rate": None, "slope": None, "zscore": None}
+            values = [(row_time, d) for row_time, d in zip(times, deltas[column]) if d is not None]
+            if len(values) > 0:
+                result["delta"] = sum([value[1] for value in values])
+                # The first delta covers the time before its row.
+                elapsed = values[-1][0] - values[0][0]
+                if elapsed > 0:
+                    result["rate"] = (result["delta"] - values[0][1]) / elapsed
+            if n > 0:
+                mean = sum(y) / n
+                t_mean = sum(t) / n
+                sxx = 0.0
+                sxy = 0.0
+                for i in range(0, n):
+                    sxx += (t[i] - t_mean) ** 2
+                    sxy += (t[i] - t_mean) * (y[i] - mean)
+                if sxx > 0:
+                    result["slope"] = sxy / sxx
+                ref = reference.get(column, [])
+                if len(ref) < self.SEASON_MIN_ROWS:
+                    ref = y
+                ref_mean = sum(ref) / len(ref)
+                variance = sum([(value - ref_mean) ** 2 for value in ref]) / len(ref)
+                if variance > 0:
+                    result["zscore"] = (mean - ref_mean) / variance ** 0.5
+            self.results[column] = result
+
+    # ----------------------------------------------
+
+    def _analyzeNumpy(self, numpy, times, levels, deltas, reference):
+
+        nan = float("nan")
+        t = numpy.array(times, dtype=float)[:, numpy.newaxis]
+        y = numpy.array([[nan if value is None else value for value in levels[column]]
+                         for column in self.columns], dtype=float).T
+        d = numpy.array([[nan if value is None else value for value in deltas[column]]
+                         for column in self.columns], dtype=float).T
+        valid = ~numpy.isnan(y)
+        n = valid.sum(axis=0)
+        count = numpy.maximum(n, 1)
+        y0 = numpy.where(valid, y, 0.0)
+        mean = y0.sum(axis=0) / count
+        t_mean = numpy.where(valid, t, 0.0).sum(axis=0) / count
+        dt = numpy.where(valid, t - t_mean, 0.0)
+        sxx = (dt ** 2).sum(axis=0)
+        sxy = (dt * (y0 - mean)).sum(axis=0)
+        present = ~numpy.isnan(d)
+        has_delta = present.any(axis=0)
+        delta = numpy.where(present, d, 0.0).sum(axis=0)
+        # The first delta covers the time before its row.
+        first = present.argmax(axis=0)
+        last = len(times) - 1 - present[::-1].argmax(axis=0)
+        first_delta = d[first, numpy.arange(len(self.columns))]
+        elapsed = t[last, 0] - t[first, 0]
+
+        for index, column in enumerate(self.columns):
+            result = {"delta": None, "rate": None, "slope": None, "zscore": None}
+            if has_delta[index]:
+                result["delta"] = float(delta[index])
+                if elapsed[index] > 0:
+                    result["rate"] = float((delta[index] - first_delta[index]) / elapsed[index])
+            if n[index] > 0:
+                if sxx[index] > 0:
+                    result["slope"] = float(sxy[index] / sxx[index])
+                ref = reference.get(column, [])
+                if len(ref) < self.SEASON_MIN_ROWS:
+                    ref = y[valid[:, index], index]
+                ref = numpy.asarray(ref, dtype=float)
+                std = ref.std()
+                if std > 0:
+                    result["zscore"] = float((mean[index] - ref.mean()) / std)
+            self.results[column] = result
+
+    # ----------------------------------------------
+
+    def _get(self, column, key):
+
+        value = self.results[column][key]
+        if value is None:
+            raise ZeroDivisionError("not enough samples of %s" % column)
+
+        return value
+
+    # ----------------------------------------------
+
+    def delta(self, column):
+
+        return self._get(column, "delta")
+
+    # ----------------------------------------------
+
+    def rate(self, column):
+        """
+        Delta per second, without the delta of the first row, which
+        covers the time before the window.
+        """
+
+        return self._get(column, "rate")
+
+    # ----------------------------------------------
+
+    def slope(self, column):
+        """
+        Least squares slope per second (rate per second for counters).
+        """
+
+        return self._get(column, "slope")
+
+    # ----------------------------------------------
+
+    def zscore(self, column):
+
+        return self._get(column, "zscore")
+
+
+# ----------------------------------------------
+# Class: AdaptiveBaseline
+# ----------------------------------------------
+
+class AdaptiveBaseline:
+    """
+    Learned full GC time and count per window of one target, kept as the
+    values of the last WINDOW windows in a JSON file next to the history.
+
+    Most windows have no full GC, so a mean and standard deviation over
+    all of them describe neither the quiet windows nor the ones with a
+    full GC. Windows without one never alert; the others are compared
+    with the median and MAD (median absolute deviation) of the learned
+    windows which had one.
+    """
+
+    METRICS = ["gc_time", "gc_count"]
+    # Windows needed before the baseline replaces the fixed thresholds.
+    LEARN_MIN = 12
+    WINDOW = 288
+    # Windows with a full GC needed before their band replaces the fixed
+    # threshold of a metric.
+    NONZERO_MIN = 3
+    # MAD to standard deviation of a normal distribution.
+    MAD_SCALE = 1.4826
+    # Lower bound of the scaled MAD (gc_time in msec, as sampled), so
+    # full GCs of nearly the same length do not alert on small changes.
+    MIN_SPREAD = {"gc_time": 20.0, "gc_count": 0.3}
+
+    # ----------------------------------------------
+
+    def __init__(self, history, warning, critical):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.history = history
+        self.warning = warning
+        self.critical = critical
+        self.path = os.path.join(history.temp_dir, history.tempfile_name % "adaptive")
+        self.state = history._loadJson(self.path)
+        if self.state is not None and (self.state.get("version") != history.VERSION
+                                       or "windows" not in self.state):
+            self.log.debug("Format changed: %s -> %s", self.state.get("version"), history.VERSION)
+            self.state = None
+        if self.state is None:
+            self.state = {"version": history.VERSION, "n": 0, "last": None, "windows": {}}
+            for metric in self.METRICS:
+                self.state["windows"][metric] = []
+
+    # ----------------------------------------------
+
+    def learned(self):
+
+        return self.state["n"] >= self.LEARN_MIN
+
+    # ----------------------------------------------
+
+    def _median(self, values):
+
+        ordered = sorted(values)
+        middle = len(ordered) // 2
+        if len(ordered) % 2 == 1:
+            return ordered[middle]
+
+        return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+    # ----------------------------------------------
+
+    def describe(self, metric):
+        """
+        (median, scaled MAD) of the learned windows of metric with a full
+        GC, None while there are fewer than NONZERO_MIN of them.
+        """
+
+        nonzero = [value for value in self.state["windows"][metric] if value > 0]
+        if len(nonzero) < self.NONZERO_MIN:
+            return None
+        median = self._median(nonzero)
+        mad = self._median([abs(value - median) for value in nonzero])
+
+        return (median, max(mad * self.MAD_SCALE, self.MIN_SPREAD[metric]))
+
+    # ----------------------------------------------
+
+    def thresholds(self, metric):
+        """
+        (warning, critical) of metric: median plus warning/critical
+        scaled MAD, None while it is not described, see describe().
+        """
+
+        described = self.describe(metric)
+        if described is None:
+            return None
+        (median, spread) = described
+
+        return (median + self.warning * spread, median + self.critical * spread)
+
+    # ----------------------------------------------
+
+    def learn(self, values, timestamp):
+        """
+        Add one window; windows starting less than one interval after the
+        last learned one overlap it and are skipped.
+        """
+
+        self.log.debug("START")
+
+        last = self.state["last"]
+        if last is not None and last <= timestamp < last + self.history.interval:
+            self.log.debug("EXIT")
+            return 0
+
+        self.state["n"] += 1
+        for metric in self.METRICS:
+            windows = self.state["windows"][metric]
+            windows.append(values[metric])
+            del windows[:-self.WINDOW]
+        self.state["last"] = timestamp
+        self.history._saveJson(self.path, self.state)
+
+        self.log.debug("END")
+
+        return 0
+
+
+# ----------------------------------------------
+# Class: HeapAdvisor
+# ----------------------------------------------
+
+class HeapAdvisor:
+    """
+    Heap and young generation sizes for one target, from the live set
+    after full GC, the young GC frequency against the eden size and the
+    GC overhead in its archive.
+
+    The old generation gets OLD_FACTOR times the live set, the young
+    generation YOUNG_FACTOR times, after Hunt and John's sizing rules;
+    the young generation then grows until young GCs fit the overhead
+    target (their frequency falls with eden) and shrinks to fit the
+    pause target (their pause is taken to scale with its size). GC
+    times are in msec, as sampled, and sizes in KB.
+    """
+
+    YOUNG_FACTOR = 1.5
+    OLD_FACTOR = 2.0
+    # Old generation factor while full GCs alone exceed the overhead target.
+    OLD_FACTOR_BUSY = 3.0
+    LIVE_PERCENTILE = 0.95
+    # Read the 10-minute tier, so weeks of samples are a few thousand rows.
+    STEP = 600
+
+    # ----------------------------------------------
+
+    def __init__(self, rows, step, now=None):
+        """
+        Constractor
+
+        rows: archive rows as HistoryStore.query() returns them; step:
+        their resolution in seconds; now: the time of the query. A row
+        still open at now covers less than step and only adds to the
+        live set and eden size, not to the GC totals and elapsed time.
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.rows = len(rows)
+        self.elapsed = 0.0
+        self.totals = dict([(column, 0.0) for column in ["YGC", "YGCT", "FGC", "FGCT"]])
+        eden = [0.0, 0]
+        minima = []
+        lowest = None
+        for row_time, count, columns in rows:
+            closed = now is None or row_time + step <= now
+            if closed and "YGC" in columns:
+                self.elapsed += step
+            for column in self.totals:
+                if closed and column in columns:
+                    self.totals[column] += columns[column][2] * count
+            if "EC" in columns:
+                eden[0] += columns["EC"][2] * count
+                eden[1] += count
+            if "OU" in columns:
+                if "FGC" in columns and columns["FGC"][1] > 0:
+                    minima.append(columns["OU"][0])
+                if lowest is None or columns["OU"][0] < lowest:
+                    lowest = columns["OU"][0]
+
+        self.full_gcs = len(minima)
+        if len(minima) > 0:
+            minima.sort()
+            self.live = minima[min(len(minima) - 1, int(len(minima) * self.LIVE_PERCENTILE))]
+        else:
+            # No full GC: the old generation never got below this.
+            self.live = lowest
+        self.eden = eden[0] / eden[1] if eden[1] > 0 else None
+
+    # ----------------------------------------------
+
+    def fromArchive(cls, history, seconds, now=None):
+        """
+        Advise from the last seconds of the archive of a HistoryStore.
+        """
+
+        if now is None:
+            now = time.time()
+
+        (step, rows) = history.query(now - seconds, now, cls.STEP, now)
+
+        return cls(rows, step, now)
+
+    fromArchive = classmethod(fromArchive)
+
+    # ----------------------------------------------
+
+    def overhead(self):
+        """
+        (young, full) GC time per elapsed time, None without data.
+        """
+
+        if self.elapsed <= 0:
+            return None
+
+        return (self.totals["YGCT"] / 1000.0 / self.elapsed, self.totals["FGCT"] / 1000.0 / self.elapsed)
+
+    # ----------------------------------------------
+
+    def recommend(self, pause_target, overhead_target):
+        """
+        (heap, young generation) in KB for a young GC pause target in
+        msec and an overhead target as a fraction of elapsed time;
+        None while the live set is unknown.
+        """
+
+        if self.live is None or self.live <= 0:
+            return None
+
+        young = self.live * self.YOUNG_FACTOR
+        old = self.live * self.OLD_FACTOR
+        overhead = self.overhead()
+        if overhead is not None and self.totals["YGC"] > 0 and self.eden > 0:
+            if overhead[0] > overhead_target:
+                young = max(young, self.eden * overhead[0] / overhead_target)
+            pause = self.totals["YGCT"] / self.totals["YGC"]
+            if pause > pause_target:
+                young = min(young, self.eden * pause_target / pause)
+        if overhead is not None and overhead[1] > overhead_target:
+            old = self.live * self.OLD_FACTOR_BUSY
+
+        return (young + old, young)
+
+    # ----------------------------------------------
+
+    def report(self, pause_target, overhead_target):
+        """
+        Report lines: what was measured and the recommended options.
+        """
+
+        lines = ["%.1f days, %d rows" % (self.elapsed / 86400.0, self.rows)]
+        if self.live is not None:
+            if self.full_gcs > 0:
+                lines.append("live set after full GC: %d MB (%dth percentile of %d windows with full GC)"
+                             % (self.live / 1024, self.LIVE_PERCENTILE * 100, self.full_gcs))
+            else:
+                lines.append("live set after full GC: %d MB or less (no full GC)" % (self.live / 1024))
+        if self.totals["YGC"] > 0 and self.eden is not None:
+            lines.append("young GC: every %.1f sec, %d msec, eden %d MB (%.1f MB/s allocated)"
+                         % (self.elapsed / self.totals["YGC"],
+                            self.totals["YGCT"] / self.totals["YGC"], self.eden / 1024,
+                            self.totals["YGC"] * self.eden / 1024 / self.elapsed))
+        if self.totals["FGC"] > 0:
+            lines.append("full GC: %d times, %d msec" % (
+                self.totals["FGC"], self.totals["FGCT"] / self.totals["FGC"]))
+        overhead = self.overhead()
+        if overhead is not None:
+            lines.append("GC overhead: %.1f%% (young %.1f%%, full %.1f%%)"
+                         % (sum(overhead) * 100, overhead[0] * 100, overhead[1] * 100))
+        sizes = self.recommend(pause_target, overhead_target)
+        if sizes is None:
+            lines.append("recommended: unknown (no heap usage archived)")
+        else:
+            heap = int(-(-sizes[0] // 1024))
+            young = int(-(-sizes[1] // 1024))
+            lines.append("recommended: -Xms%dm -Xmx%dm -Xmn%dm" % (heap, heap, young))
+
+        return lines
+
+
+# ----------------------------------------------
+# Class: Evaluator
+# ----------------------------------------------
+
+class Evaluator:
+    """
+    Full GC thresholds and rules; evaluate() returns a CheckResult.
+    Setters raise ValueError on inconsistent values.
+    """
+
+    def __init__(self):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.time_warning = None
+        self.time_critical = None
+        self.count_warning = None
+        self.count_critical = None
+        self.adaptive_warning = None
+        self.adaptive_critical = None
+        self.metaspace_warning = None
+        self.metaspace_critical = None
+        self.metaspace_growth_warning = None
+        self.metaspace_growth_critical = None
+        self.exclude_causes = []
+        self.tenuring_warning = None
+        self.promotion_warning = None
+        self.gc_cpu_warning = None
+        self.gc_cpu_critical = None
+        self.gc_cpu_host_warning = None
+        self.gc_cpu_host_critical = None
+        self.rules = []
+
+    # ----------------------------------------------
+
+    def _isValidThreshold(self, warning, critical):
+
+        if warning is None and critical is None:
+            raise ValueError("Threshold is None.")
+        elif warning is None:
+            pass
+        elif critical is None:
+            pass
+        elif warning > critical:
+            raise ValueError("Warning value should be more than critical value.")
+
+    # ----------------------------------------------
+
+    def setTimeWarning(self, warning):
+
+        self.time_warning = int(warning)
+        self._isValidThreshold(self.time_warning, self.time_critical)
+
+    # ----------------------------------------------
+
+    def setTimeCritical(self, critical):
+
+        self.time_critical = int(critical)
+        self._isValidThreshold(self.time_warning, self.time_critical)
+
+    # ----------------------------------------------
+
+    def setCountWarning(self, warning):
+
+        self.count_warning = int(warning)
+        self._isValidThreshold(self.count_warning, self.count_critical)
+
+    # ----------------------------------------------
+
+    def setCountCritical(self, critical):
+
+        self.count_critical = int(critical)
+        self._isValidThreshold(self.count_warning, self.count_critical)
+
+    # ----------------------------------------------
+
+    def _optionalThresholds(self, warning, critical):
+
+        if warning is not None:
+            warning = float(warning)
+        if critical is not None:
+            critical = float(critical)
+        if warning is not None and critical is not None:
+            self._isValidThreshold(warning, critical)
+
+        return (warning, critical)
+
+    # ----------------------------------------------
+
+    def setMetaspace(self, warning, critical):
+        """
+        Metaspace (permanent generation before JDK 8) usage thresholds in
+        percent; None disables one.
+        """
+
+        (self.metaspace_warning, self.metaspace_critical) = self._optionalThresholds(warning, critical)
+
+    # ----------------------------------------------
+
+    def setMetaspaceGrowth(self, warning, critical):
+        """
+        Metaspace growth thresholds in MB per hour; None disables one.
+        """
+
+        (self.metaspace_growth_warning, self.metaspace_growth_critical) = \
+            self._optionalThresholds(warning, critical)
+
+    # ----------------------------------------------
+
+    def setGcCpu(self, warning, critical):
+        """
+        Thresholds of GC thread CPU in percent of the process CPU; None
+        disables one.
+        """
+
+        (self.gc_cpu_warning, self.gc_cpu_critical) = self._optionalThresholds(warning, critical)
+
+    # ----------------------------------------------
+
+    def setGcCpuHost(self, warning, critical):
+        """
+        Thresholds of GC thread CPU in percent of all host cores; None
+        disables one.
+        """
+
+        (self.gc_cpu_host_warning, self.gc_cpu_host_critical) = self._optionalThresholds(warning, critical)
+
+    # ----------------------------------------------
+
+    def setPromotion(self, tenuring, promotion):
+        """
+        Early warnings of premature promotion; None disables one.
+
+        tenuring: WARNING while the tenuring threshold stays at or below
+        this age through the window, below MaxTenuringThreshold.
+        promotion: WARNING when the old generation grows by more than
+        this many MB per young GC over the window.
+        """
+
+        if tenuring is not None:
+            tenuring = float(tenuring)
+            if tenuring < 0:
+                raise ValueError("Tenuring threshold should not be negative.")
+        if promotion is not None:
+            promotion = float(promotion)
+            if promotion < 0:
+                raise ValueError("Promotion threshold should not be negative.")
+        (self.tenuring_warning, self.promotion_warning) = (tenuring, promotion)
+
+    # ----------------------------------------------
+
+    def setExcludeCauses(self, causes):
+        """
+        GC causes (LGCC, e.g. "System.gc()") whose full GCs do not count
+        against the GC time and count thresholds.
+        """
+
+        self.exclude_causes = list(causes)
+
+    # ----------------------------------------------
+
+    def setAdaptive(self, warning, critical):
+        """
+        Judge GC time and count by the AdaptiveBaseline, warning/critical
+        standard deviations above the learned mean, once it is learned.
+        """
+
+        self._isValidThreshold(float(warning), float(critical))
+        self.adaptive_warning = float(warning)
+        self.adaptive_critical = float(critical)
+
+    # ----------------------------------------------
+
+    def adaptiveBaseline(self, history):
+        """
+        The AdaptiveBaseline of history, None unless adaptive.
+        """
+
+        if self.adaptive_warning is None:
+            return None
+
+        return AdaptiveBaseline(history, self.adaptive_warning, self.adaptive_critical)
+
+    # ----------------------------------------------
+
+    def addRule(self, state, source):
+        """
+        Add a rule which sets state (STATE_WARNING or STATE_CRITICAL).
+        """
+
+        try:
+            rule = _Rule.compile(source)
+        except ValueError, e:
+            raise ValueError("Invalid rule '%s'. (%s)" % (source, e))
+        self.rules.append((state, rule))
+
+    # ----------------------------------------------
+
+    def applyConfig(self, target):
+        """
+        Set the thresholds and rules of a _Config target.
+        """
+
+        self.setTimeWarning(target["time_warning"])
+        self.setTimeCritical(target["time_critical"])
+        self.setCountWarning(target["count_warning"])
+        self.setCountCritical(target["count_critical"])
+        for source in target["warning_rules"]:
+            self.addRule(CheckResult.STATE_WARNING, source)
+        for source in target["critical_rules"]:
+            self.addRule(CheckResult.STATE_CRITICAL, source)
+        if target.get("adaptive"):
+            self.setAdaptive(target["adaptive_warning"], target["adaptive_critical"])
+        self.setExcludeCauses(target.get("exclude_causes", []))
+        self.setPromotion(target.get("tenuring_warning"), target.get("promotion_warning"))
+        self.setGcCpu(target.get("gc_cpu_warning"), target.get("gc_cpu_critical"))
+        self.setGcCpuHost(target.get("gc_cpu_host_warning"), target.get("gc_cpu_host_critical"))
+        self.setMetaspace(target.get("metaspace_warning"), target.get("metaspace_critical"))
+        self.setMetaspaceGrowth(target.get("metaspace_growth_warning"), target.get("metaspace_growth_critical"))
+
+    # ----------------------------------------------
+
+    def needsTrend(self):
+        """
+        Whether a rule reads the TrendAnalysis, which needs the archive.
+        """
+
+        for state, rule in self.rules:
+            if rule.needs_trend:
+                return True
+
+        return False
+
+    # ----------------------------------------------
+
+    def needsThreadCpu(self):
+        """
+        Whether a GC CPU threshold or a rule reads the columns of
+        Sampler.addThreadCpu().
+        """
+
+        if self.gc_cpu_warning is not None or self.gc_cpu_critical is not None \
+                or self.gc_cpu_host_warning is not None or self.gc_cpu_host_critical is not None:
+            return True
+        for state, rule in self.rules:
+            for counter in rule.counters:
+                if counter in Sampler.THREAD_CPU_COLUMNS:
+                    return True
+
+        return False
+
+    # ----------------------------------------------
+
+    def _windowCauses(self, current_stat, old_stat):
+        """
+        cause -> [full GC count, full GC time] within the window, None
+        unless both samples carry causes.
+        """
+
+        if "causes" not in current_stat or "causes" not in old_stat:
+            return None
+
+        causes = {}
+        for cause, (count, gc_time) in current_stat["causes"].items():
+            (old_count, old_time) = old_stat["causes"].get(cause, (0.0, 0.0))
+            if count - old_count > 0 or gc_time - old_time > 0:
+                causes[cause] = [count - old_count, gc_time - old_time]
+
+        return causes
+
+    # ----------------------------------------------
+
+    def _describeCauses(self, causes):
+
+        items = sorted(causes.items(), key=lambda item: -item[1][1])
+
+        return ", ".join(["%s (%d times, %d msec)" % (cause, count, gc_time)
+                          for cause, (count, gc_time) in items]) or "unknown"
+
+    # ----------------------------------------------
+
+    def _checkThreshold(self, problems, value, warning, critical, msg):
+
+        if critical is not None and critical <= value:
+            problems.append((CheckResult.STATE_CRITICAL, msg))
+        elif warning is not None and warning <= value:
+            problems.append((CheckResult.STATE_WARNING, msg))
+
+    # ----------------------------------------------
+
+    def _metaspaceUsage(self, current_stat):
+        """
+        Metaspace used of its maximum in percent when the maximum is
+        bounded (MMAX, see Sampler._normalize()), else jstat's M, which
+        is relative to the committed size.
+        """
+
+        if "MU" in current_stat and current_stat.get("MMAX", 0) > 0:
+            return current_stat["MU"] * 100.0 / current_stat["MMAX"]
+        value = current_stat.get("M")
+        if isinstance(value, float):
+            return value
+
+        return None
+
+    # ----------------------------------------------
+
+    def _survivorUsage(self, stat):
+        """
+        Occupancy of the used survivor space in percent of the desired
+        survivor size; over 100 means survivors overflow into old.
+        """
+
+        if stat.get("DSS", 0) <= 0 or "S0U" not in stat or "S1U" not in stat:
+            return None
+
+        return max(stat["S0U"], stat["S1U"]) * 100.0 / stat["DSS"]
+
+    # ----------------------------------------------
+
+    def _checkPromotion(self, problems, metrics, perfdata, current_stat, old_stat):
+        """
+        Tenuring threshold collapse and old generation growth per young
+        GC, which precede full GC storms. Windows with a full GC are
+        skipped for growth, as it shrinks the old generation.
+        """
+
+        survivor = self._survivorUsage(current_stat)
+        detail = ""
+        if survivor is not None:
+            metrics["survivor"] = survivor
+            detail = ", survivor %.0f%% of desired" % survivor
+
+        if self.tenuring_warning is not None and "TT" in current_stat and "TT" in old_stat:
+            tenuring = current_stat["TT"]
+            self.log.debug("Tenuring threshold: %s -> %s", old_stat["TT"], tenuring)
+            metrics["tenuring_threshold"] = tenuring
+            # Lower is worse: warn inside 0 .. tenuring_warning.
+            perfdata.append(("tenuring_threshold", tenuring, "", "@0:%g" % self.tenuring_warning, None))
+            if max(tenuring, old_stat["TT"]) <= self.tenuring_warning \
+                    and current_stat.get("MTT", tenuring + 1) > self.tenuring_warning:
+                problems.append((CheckResult.STATE_WARNING, "Tenuring threshold collapsed. (%d of %d%s)"
+                                 % (tenuring, current_stat.get("MTT", 15), detail)))
+
+        young = current_stat["YGC"] - old_stat["YGC"]
+        if self.promotion_warning is not None and "OU" in current_stat and "OU" in old_stat \
+                and young > 0 and current_stat["FGC"] == old_stat["FGC"]:
+            promotion = (current_stat["OU"] - old_stat["OU"]) / 1024.0 / young
+            self.log.debug("Promotion: %.03f", promotion)
+            self._checkThreshold(problems, promotion, self.promotion_warning, None,
+                                 "Old generation grows too fast per young GC. (%.1f MB%s)" % (promotion, detail))
+            metrics["promotion"] = promotion
+            perfdata.append(("promotion", promotion, "MB", self.promotion_warning, None))
+
+    # ----------------------------------------------
+
+    def _checkGcCpu(self, problems, metrics, perfdata, current_stat, old_stat):
+        """
+        CPU burnt by GC threads over the window, which FGCT misses for
+        concurrent collectors.
+        """
+
+        if self.gc_cpu_warning is None and self.gc_cpu_critical is None \
+                and self.gc_cpu_host_warning is None and self.gc_cpu_host_critical is None:
+            return
+        if "GCCPU" not in current_stat or "GCCPU" not in old_stat:
+            return
+        gc_cpu = current_stat["GCCPU"] - old_stat["GCCPU"]
+        cpu = current_stat["CPU"] - old_stat["CPU"]
+        # A GC thread has exited and taken its CPU time with it.
+        if gc_cpu < 0 or metrics["elapsed"] <= 0:
+            return
+        self.log.debug("GC CPU: %.03f of %.03f sec", gc_cpu, cpu)
+
+        if self.gc_cpu_warning is not None or self.gc_cpu_critical is not None:
+            share = gc_cpu * 100.0 / cpu if cpu > 0 else 0.0
+            self._checkThreshold(problems, share, self.gc_cpu_warning, self.gc_cpu_critical,
+                                 "GC threads use too much CPU. (%.1f%% of process)" % share)
+            metrics["gc_cpu"] = share
+            perfdata.append(("gc_cpu", share, "%", self.gc_cpu_warning, self.gc_cpu_critical))
+
+        if self.gc_cpu_host_warning is not None or self.gc_cpu_host_critical is not None:
+            cores = gc_cpu / metrics["elapsed"]
+            share = cores * 100.0 / current_stat.get("NCPU", 1)
+            self._checkThreshold(problems, share, self.gc_cpu_host_warning, self.gc_cpu_host_critical,
+                                 "GC threads use too much CPU. (%.1f cores, %.1f%% of host)" % (cores, share))
+            metrics["gc_cpu_host"] = share
+            perfdata.append(("gc_cpu_host", share, "%", self.gc_cpu_host_warning, self.gc_cpu_host_critical))
+
+    # ----------------------------------------------
+
+    def evaluate(self, current_stat, old_stat, trend=None, adaptive=None):
+        """
+        adaptive: the AdaptiveBaseline of the target, which replaces the
+        fixed GC time and count thresholds once learned and learns this
+        window unless it is critical by the learned thresholds.
+        """
+
+        self.log.debug("START")
+
+        if current_stat is None:
+            self.log.debug("EXIT")
+            return CheckResult(CheckResult.STATE_UNKNOWN, "Unable to get gcutil.")
+
+        problems = []
+        metrics = {}
+        perfdata = []
+
+        if old_stat is not None:
+            time_warning = self.time_warning
+            time_critical = self.time_critical
+            count_warning = self.count_warning
+            count_critical = self.count_critical
+            time_suffix = ""
+            count_suffix = ""
+            learned = adaptive is not None and adaptive.learned()
+            if learned and adaptive.thresholds("gc_time") is not None:
+                (time_warning, time_critical) = adaptive.thresholds("gc_time")
+                time_suffix = " than usual"
+            if learned and adaptive.thresholds("gc_count") is not None:
+                (count_warning, count_critical) = adaptive.thresholds("gc_count")
+                count_suffix = " than usual"
+
+            time = current_stat["FGCT"] - old_stat["FGCT"]
+            count = current_stat["FGC"] - old_stat["FGC"]
+            causes = self._windowCauses(current_stat, old_stat)
+            if causes is not None:
+                metrics["gc_causes"] = causes
+                for cause in self.exclude_causes:
+                    if cause in causes:
+                        self.log.debug("Exclude %s: %s", cause, causes[cause])
+                        count -= causes[cause][0]
+                        time -= causes[cause][1]
+            gc_problems = len(problems)
+
+            # gc time
+            self.log.debug("GC time: %.03f", time)
+            if time_critical <= time:
+                self.log.debug("%d <= %.03f", time_critical, time)
+                problems.append((CheckResult.STATE_CRITICAL, "GC time is too long%s. (%d msec)" % (time_suffix, time)))
+            elif time_warning <= time:
+                self.log.debug("%d <= %.03f", time_warning, time)
+                problems.append((CheckResult.STATE_WARNING, "GC time is too long%s. (%d msec)" % (time_suffix, time)))
+
+            # gc count
+            self.log.debug("GC count: %.03f", count)
+            if count_critical <= count:
+                self.log.debug("%d <= %.03f", count_critical, count)
+                problems.append((CheckResult.STATE_CRITICAL, "GC count is too occured%s. (%d times)" % (count_suffix, count)))
+            elif count_warning <= count:
+                self.log.debug("%d <= %.03f", count_warning, count)
+                problems.append((CheckResult.STATE_WARNING, "GC count is too occured%s. (%d times)" % (count_suffix, count)))
+
+            metrics["gc_time"] = time
+            metrics["gc_count"] = count
+            metrics["elapsed"] = current_stat["Timestamp"] - old_stat["Timestamp"]
+            perfdata.append(("gc_time", time, "ms", time_warning, time_critical))
+            perfdata.append(("gc_count", count, "", count_warning, count_critical))
+            if causes is not None and len(problems) > gc_problems:
+                # Once, on the GC problem that is going to be reported.
+                index = max(range(gc_problems, len(problems)),
+                            key=lambda i: (CheckResult.STATE_SEVERITY[problems[i][0]], -i))
+                problems[index] = (problems[index][0], "%s Causes: %s." % (problems[index][1], self._describeCauses(causes)))
+
+            # metaspace growth
+            if (self.metaspace_growth_warning is not None or self.metaspace_growth_critical is not None) \
+                    and "MU" in current_stat and "MU" in old_stat and metrics["elapsed"] > 0:
+                growth = (current_stat["MU"] - old_stat["MU"]) / 1024.0 / metrics["elapsed"] * 3600
+                self.log.debug("Metaspace growth: %.03f", growth)
+                self._checkThreshold(problems, growth, self.metaspace_growth_warning,
+                                     self.metaspace_growth_critical,
+                                     "Metaspace is growing too fast. (%.1f MB/h)" % growth)
+                metrics["metaspace_growth"] = growth
+                perfdata.append(("metaspace_growth", growth, "", self.metaspace_growth_warning,
+                                 self.metaspace_growth_critical))
+
+            # premature promotion
+            self._checkPromotion(problems, metrics, perfdata, current_stat, old_stat)
+
+            # gc thread cpu
+            self._checkGcCpu(problems, metrics, perfdata, current_stat, old_stat)
+
+            # A critical window would skew what is learned as usual.
+            if adaptive is not None and not (learned and CheckResult.STATE_CRITICAL in
+                                             [state for state, msg in problems]):
+                adaptive.learn(metrics, current_stat["Timestamp"])
+
+        # metaspace usage
+        usage = None
+        if self.metaspace_warning is not None or self.metaspace_critical is not None:
+            usage = self._metaspaceUsage(current_stat)
+        if usage is not None:
+            self.log.debug("Metaspace usage: %.03f", usage)
+            self._checkThreshold(problems, usage, self.metaspace_warning, self.metaspace_critical,
+                                 "Metaspace usage is too high. (%.1f%%)" % usage)
+            metrics["metaspace"] = usage
+            perfdata.append(("metaspace", usage, "%", self.metaspace_warning, self.metaspace_critical))
+
+        # rules
+        for state, rule in self.rules:
+            try:
+                matched = rule.evaluate(current_stat, old_stat, trend)
+            except KeyError, e:
+                problems.append((CheckResult.STATE_UNKNOWN, "Rule '%s' uses unknown counter %s." % (rule.source, e)))
+                continue
+            self.log.debug("%s: %s", rule.source, matched)
+            if matched:
+                problems.append((state, "Rule '%s' matched." % rule.source))
+
+        if len(problems) > 0:
+            worst = max([state for state, msg in problems], key=CheckResult.STATE_SEVERITY.get)
+            msg = ", ".join([msg for state, msg in problems if state == worst])
+            self.log.debug("EXIT")
+            return CheckResult(worst, msg, metrics, perfdata)
+
+        if old_stat is None:
+            self.log.debug("EXIT")
+            return CheckResult(CheckResult.STATE_OK, "now collecting data.")
+
+        self.log.debug("END")
+
+        return CheckResult(CheckResult.STATE_OK,
+                           "GC time is %.03f msec, GC count is %d." % (time, count),
+                           metrics, perfdata)
+
+
+# ----------------------------------------------
+# Internal Class: _Jvm
+# ----------------------------------------------
+
+class _Jvm:
+    """
+    The plugin check of one JVM, printing Nagios output; built on
+    Sampler, HistoryStore and Evaluator.
+    """
+
+    STATE_OK = CheckResult.STATE_OK
+    STATE_WARNING = CheckResult.STATE_WARNING
+    STATE_CRITICAL = CheckResult.STATE_CRITICAL
+    STATE_UNKNOWN = CheckResult.STATE_UNKNOWN
+    STATE_DEPENDENT = CheckResult.STATE_DEPENDENT
+
+    TEMPFILE_NAME = HistoryStore.TEMPFILE_NAME
+    PERFDATA_DIR = Sampler.PERFDATA_DIR
+
+    # ----------------------------------------------
+
+    def __init__(self, java_bin, temp_dir, name, interval,
+                 perfdata_dir=PERFDATA_DIR, pid=None, history_key=None, database=None):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.log.debug("START")
+
+        self.quiet = False
+        self.output = None
+        self.temp_dir = temp_dir
+        self.interval = interval
+        self.java_bin = java_bin
+        self.perfdata_dir = perfdata_dir
+        self.sampler = Sampler(java_bin, perfdata_dir)
+        self.history = _openHistory(temp_dir, interval, history_key, database)
+        if history_key is None:
+            history_key = _historyKey(name)
+        self.history_key = history_key
+        self.diagnostics = None
+        self.evaluator = Evaluator()
+        if pid is None:
+            self.pid = self._getJps(name)
+        else:
+            self.pid = pid
+        self.perfdata = self._getPerfData()
+        self.start_time = self.sampler.getVmStartTime(self.pid, self.perfdata)
+        self.current_stat = self._getGcUtil()
+        # Chosen by checkGc() once the thresholds are set, see _getOldStat().
+        self.old_stat = None
+        self.has_baseline = False
+
+        self.log.debug("END")
+
+    # ----------------------------------------------
+
+    def __del__(self):
+        """
+        Destructor
+        """
+        self.log.debug("START")
+        pass
+        self.log.debug("END")
+
+    # ----------------------------------------------
+
+    def _print(self, line):
+        """
+        Keep the plugin output line; print it unless quiet.
+        """
+
+        self.output = line
+        if not self.quiet:
+            print line
+
+    # ----------------------------------------------
+
+    def _printResult(self, result):
+
+        self._print(NagiosOutput.format(result))
+
+        return result.state
+
+    # ----------------------------------------------
+
+    def _printUnknown(self, msg):
+
+        return self._printResult(CheckResult(self.STATE_UNKNOWN, msg))
+
+    # ----------------------------------------------
+
+    def _loadJson(self, path):
+
+        return self.history._loadJson(path)
+
+    # ----------------------------------------------
+
+    def _saveJson(self, path, data):
+
+        return self.history._saveJson(path, data)
+
+    # ----------------------------------------------
+
+    def _parseGcUtil(self, stdout):
+
+        return self.sampler._parseGcUtil(stdout)
+
+    # ----------------------------------------------
+
+    def _getGcUtil(self):
+
+        return self.sampler.getGcUtil(self.pid, self.perfdata)
+
+    # ----------------------------------------------
+
+    def _parsePerfData(self, data):
+
+        return self.sampler._parsePerfData(data)
+
+    # ----------------------------------------------
+
+    def _getPerfData(self):
+
+        return self.sampler.getPerfData(self.pid)
+
+    # ----------------------------------------------
+
+    def _getVmStartTime(self):
+
+        return self.sampler.getVmStartTime(self.pid)
+
+    # ----------------------------------------------
+
+    def _getJps(self, name):
+
+        return self.sampler.getPid(name)
+
+    # ----------------------------------------------
+
+    def _setThreshold(self, setter, value):
+
+        self.log.debug("START")
+
+        try:
+            setter(value)
+        except ValueError, e:
+            self.log.debug("EXIT")
+            return self._printUnknown(str(e))
+
+        self.log.debug("END")
+
+        return self.STATE_OK
+
+    # ----------------------------------------------
+
+    def setTimeWarning(self, warning):
+
+        return self._setThreshold(self.evaluator.setTimeWarning, warning)
+
+    # ----------------------------------------------
+
+    def setCountWarning(self, warning):
+
+        return self._setThreshold(self.evaluator.setCountWarning, warning)
+
+    # ----------------------------------------------
+
+    def setTimeCritical(self, ctitical):
+
+        return self._setThreshold(self.evaluator.setTimeCritical, ctitical)
+
+    # ----------------------------------------------
+
+    def setCountCritical(self, ctitical):
+
+        return self._setThreshold(self.evaluator.setCountCritical, ctitical)
+
+    # ----------------------------------------------
+
+    def addRule(self, state, source):
+        """
+        Add a rule which sets state (STATE_WARNING or STATE_CRITICAL).
+        """
+
+        self.log.debug("START")
+
+        try:
+            self.evaluator.addRule(state, source)
+        except ValueError, e:
+            self.log.debug("EXIT")
+            return self._printUnknown(str(e))
+
+        self.log.debug("END")
+
+        return self.STATE_OK
+
+    # ----------------------------------------------
+
+    def applyConfig(self, target):
+        """
+        Set the thresholds and rules of a _Config target.
+        """
+
+        ret = self._setThreshold(self.evaluator.applyConfig, target)
+        self.history.archive = target.get("archive", False) or self.evaluator.needsTrend()
+
+        return ret
+
+    # ----------------------------------------------
+
+    def _getOldStat(self):
+        """
+        The baseline of current_stat, which first gets the CPU columns
+        of the GC threads when the thresholds need them; the sample is
+        stored as the baseline of later checks.
+        """
+
+        self.log.debug("START")
+
+        self.has_baseline = True
+        if self.current_stat is None:
+            return 1
+
+        if self.evaluator.needsThreadCpu():
+            _addThreadCpu(self.sampler, self.history, self.current_stat, self.pid, self.start_time)
+        history = self.history.baseline(self.current_stat, self.pid, self.start_time)
+
+        self.log.debug("END")
+
+        return history
+
+    # ----------------------------------------------
+
+    def checkGc(self):
+
+        self.log.debug("START")
+
+        if not self.has_baseline:
+            self.old_stat = self._getOldStat()
+        trend = None
+        adaptive = None
+        if isinstance(self.current_stat, dict):
+            if self.history.archive:
+                self.history.record(self.current_stat, pid=self.pid, start_time=self.start_time)
+                if self.evaluator.needsTrend():
+                    trend = TrendAnalysis.fromArchive(self.history, self.interval)
+            adaptive = self.evaluator.adaptiveBaseline(self.history)
+        result = self._checkGc(self.current_stat, self.old_stat, trend, adaptive)
+        if result == self.STATE_CRITICAL and self.diagnostics is not None and self.pid is not None:
+            self.diagnostics.capture(self.pid, self.history_key)
+
+        self.log.debug("END")
+
+        return result
+
+    # ----------------------------------------------
+
+    def _checkGc(self, current_stat, old_stat, trend=None, adaptive=None):
+
+        self.log.debug("START")
+
+        result = self.evaluator.evaluate(current_stat, old_stat, trend, adaptive)
+
+        self.log.debug("END")
+
+        return self._printResult(result)
+
+    # ----------------------------------------------
+
+
+# ----------------------------------------------
+# Internal Functions: JVM discovery
+# ----------------------------------------------
+
+def _listJvms(java_bin):
+    """
+    All running JVMs as a list of (pid, name), from a single jps run.
+    """
+
+    log = logging.getLogger("_listJvms")
+
+    jps = os.path.join(java_bin, "jps")
+    stdout = commands.getoutput(jps)
+    log.debug(stdout)
+
+    jvms = []
+    for line in stdout.split("\n"):
+        fields = line.strip().split(None, 1)
+        if len(fields) == 0 or not fields[0].isdigit():
+            continue
+        if len(fields) == 1:
+            fields.append("")
+        if fields[1] == "Jps":
+            continue
+        jvms.append((int(fields[0]), fields[1]))
+
+    return jvms
+
+
+# ----------------------------------------------
+
+def _matchJvms(jvms, name):
+    """
+    JVMs whose jps line contains name, like "jps | grep name" does.
+    """
+
+    matched = []
+    for pid, jvm_name in jvms:
+        if name in "%d %s" % (pid, jvm_name):
+            matched.append((pid, jvm_name))
+
+    return matched
+
+
+# ----------------------------------------------
+
+_match_patterns = {}
+
+
+def _matchTarget(jvms, target):
+    """
+    JVMs selected by a _Config target: the "match" regex if given,
+    otherwise the "name" substring.
+    """
+
+    if target["match"] == "":
+        return _matchJvms(jvms, target["name"])
+
+    pattern = _match_patterns.get(target["match"])
+    if pattern is None:
+        pattern = re.compile(target["match"])
+        _match_patterns[target["match"]] = pattern
+
+    matched = []
+    for pid, jvm_name in jvms:
+        if pattern.search("%d %s" % (pid, jvm_name)):
+            matched.append((pid, jvm_name))
+
+    return matched
+
+
+# ----------------------------------------------
+
+def _historyKey(name, pid=None):
+
+    key = re.sub(r"[^A-Za-z0-9.-]", "_", name)
+    if pid is not None:
+        key = "%s_%d" % (key, pid)
+
+    return key
+
+
+# ----------------------------------------------
+
+_numpy = []
+
+
+def _importNumpy():
+    """
+    numpy, or None when it is not installed; imported on first use.
+    """
+
+    if len(_numpy) == 0:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy.append(numpy)
+
+    return _numpy[0]
+
+
+# ----------------------------------------------
+
+def _openHistory(temp_dir, interval, key=None, database=None):
+
+    if database is None:
+        return HistoryStore(temp_dir, interval, key)
+
+    return database.store(temp_dir, interval, key)
+
+
+# ----------------------------------------------
+
+def _addThreadCpu(sampler, history, stat, pid, start_time=None):
+    """
+    Sampler.addThreadCpu() with the GC thread classification of pid
+    kept next to history, see HistoryStore.saveThreads().
+    """
+
+    if pid not in sampler.threads:
+        sampler.threads[pid] = history.loadThreads(pid, start_time)
+    known = sampler.threads[pid]
+    sampler.addThreadCpu(stat, pid)
+    if sampler.threads.get(pid, known) != known:
+        history.saveThreads(pid, start_time, sampler.threads[pid])
+
+    return stat
+
+
+# ----------------------------------------------
+# Internal Class: _Config
+# ----------------------------------------------
+
+class _Config:
+    """
+    Target definitions: one section per target (service), [DEFAULT] and
+    the command line options supply the values a section leaves out.
+
+    The resolved targets are kept in memory while the file is unchanged
+    and cached in temp_dir, keyed by mtime and size, for one-shot runs.
+    """
+
+    CACHE_NAME = "check_jvm_config_%s.cache"
+    CACHE_VERSION = 7
+
+    INT_KEYS = ["interval", "time_warning", "time_critical", "count_warning", "count_critical"]
+    RULE_KEYS = ["warning_rules", "critical_rules"]
+    # One item per line or comma separated.
+    LIST_KEYS = ["exclude_causes"]
+    FLOAT_KEYS = ["adaptive_warning", "adaptive_critical"]
+    # Empty means disabled.
+    OPTIONAL_FLOAT_KEYS = ["metaspace_warning", "metaspace_critical",
+                           "metaspace_growth_warning", "metaspace_growth_critical",
+                           "tenuring_warning", "promotion_warning",
+                           "gc_cpu_warning", "gc_cpu_critical",
+                           "gc_cpu_host_warning", "gc_cpu_host_critical"]
+    BOOL_KEYS = ["archive", "adaptive"]
+    OUTPUTS = ["passive", "prometheus"]
+
+    # ----------------------------------------------
+
+    def __init__(self, path, cache_dir, defaults):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.log.debug("START")
+
+        import hashlib
+
+        self.path = path
+        self.defaults = defaults
+        self.cache_path = os.path.join(cache_dir, self.CACHE_NAME % hashlib.md5(
+            os.path.abspath(path)).hexdigest()[0:12])
+        self.stamp = None
+        self.targets = None
+
+        self.log.debug("END")
+
+    # ----------------------------------------------
+
+    def _parse(self):
+
+        self.log.debug("START")
+
+        import socket
+        import ConfigParser
+
+        defaults = {"host": socket.gethostname(), "name": "", "match": "",
+                    "output": ", ".join(self.OUTPUTS)}
+        for key in self.RULE_KEYS:
+            defaults[key] = ""
+        for key in self.BOOL_KEYS:
+            defaults[key] = "no"
+        defaults["adaptive_warning"] = "3.0"
+        defaults["adaptive_critical"] = "5.0"
+        for key in self.OPTIONAL_FLOAT_KEYS + self.LIST_KEYS:
+            defaults[key] = ""
+        for key, value in self.defaults.items():
+            if isinstance(value, list):
+                defaults[key] = "\n".join(value)
+            elif value is None:
+                defaults[key] = ""
+            else:
+                defaults[key] = str(value)
+        parser = ConfigParser.RawConfigParser(defaults)
+        try:
+            if len(parser.read(self.path)) == 0:
+                raise IOError("Unable to read %s." % self.path)
+            targets = self._parseTargets(parser)
+        except (ConfigParser.Error, re.error), e:
+            raise ValueError(str(e))
+
+        self.log.debug("END")
+
+        return targets
+
+    # ----------------------------------------------
+
+    def _parseTargets(self, parser):
+
+        targets = []
+        for section in parser.sections():
+            target = {
+                "service": section,
+                "host": parser.get(section, "host"),
+                "name": parser.get(section, "name"),
+                "match": parser.get(section, "match"),
+            }
+            if target["name"] == "" and target["match"] == "":
+                raise ValueError("[%s] needs 'name' or 'match'." % section)
+            if target["match"] != "":
+                re.compile(target["match"])
+            for key in self.INT_KEYS:
+                target[key] = parser.getint(section, key)
+            for key in self.FLOAT_KEYS:
+                target[key] = parser.getfloat(section, key)
+            for key in self.OPTIONAL_FLOAT_KEYS:
+                if parser.get(section, key).strip() == "":
+                    target[key] = None
+                else:
+                    target[key] = parser.getfloat(section, key)
+            for key in self.BOOL_KEYS:
+                target[key] = parser.getboolean(section, key)
+            for key in self.RULE_KEYS:
+                target[key] = [line.strip() for line in parser.get(section, key).split("\n")
+                               if line.strip() != ""]
+            for key in self.LIST_KEYS:
+                target[key] = [item.strip() for item in re.split(r"[,\n]", parser.get(section, key))
+                               if item.strip() != ""]
+            target["output"] = [output.strip() for output in parser.get(section, "output").split(",")
+                                if output.strip() != ""]
+            for output in target["output"]:
+                if output not in self.OUTPUTS:
+                    raise ValueError("[%s] unknown output '%s'." % (section, output))
+            targets.append(target)
+
+        return targets
+
+    # ----------------------------------------------
+
+    def _loadCache(self, stamp):
+
+        self.log.debug("START")
+
+        import marshal
+
+        try:
+            f = open(self.cache_path, "rb")
+            cache = marshal.load(f)
+            f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            self.log.debug("EXIT")
+            return None
+
+        if cache.get("version") != self.CACHE_VERSION or cache.get("path") != self.path \
+                or cache.get("stamp") != stamp or cache.get("defaults") != self.defaults:
+            self.log.debug("Stale cache.")
+            self.log.debug("EXIT")
+            return None
+
+        self.log.debug("END")
+
+        return cache["targets"]
+
+    # ----------------------------------------------
+
+    def _saveCache(self, stamp, targets):
+
+        self.log.debug("START")
+
+        import marshal
+        import tempfile
+
+        cache = {"version": self.CACHE_VERSION, "path": self.path, "stamp": stamp,
+                 "defaults": self.defaults, "targets": targets}
+        try:
+            (fd, temp_path) = tempfile.mkstemp(prefix=".check_jvm.",
+                                               dir=os.path.dirname(self.cache_path))
+            f = os.fdopen(fd, "wb")
+            marshal.dump(cache, f)
+            f.close()
+            os.rename(temp_path, self.cache_path)
+        except (IOError, OSError), e:
+            self.log.debug("Unable to save cache: %s", e)
+
+        self.log.debug("END")
+
+        return 0
+
+    # ----------------------------------------------
+
+    def getTargets(self):
+        """
+        Raises IOError, OSError or ValueError on a bad config.
+        """
+
+        self.log.debug("START")
+
+        st = os.stat(self.path)
+        stamp = (st.st_mtime, st.st_size)
+        if stamp == self.stamp:
+            self.log.debug("EXIT")
+            return self.targets
+
+        targets = self._loadCache(stamp)
+        if targets is None:
+            targets = self._parse()
+            self._saveCache(stamp, targets)
+        self.stamp = stamp
+        self.targets = targets
+
+        self.log.debug("END")
+
+        return targets
+
+    # ----------------------------------------------
+
+    def getTarget(self, service):
+
+        for target in self.getTargets():
+            if target["service"] == service:
+                return target
+
+        return None
+
+
+# ----------------------------------------------
+# Internal Class: _PrometheusExporter
+# ----------------------------------------------
+
+class _PrometheusExporter:
+
+    # gcutil column -> gc label
+    COUNT_COLUMNS = {"YGC": "young", "FGC": "full", "CGC": "concurrent"}
+    TIME_COLUMNS = {"YGCT": "young", "FGCT": "full", "CGCT": "concurrent", "GCT": "all"}
+    # GC times are sampled in msec.
+    TIME_SCALE = 1000.0
+    # History keys of the JVMs exported so far, see _pruneHistory().
+    KEYS_FILE = "jstat_exporter_keys.log"
+    SPACE_COLUMNS = ["S0", "S1", "E", "O", "P", "M", "CCS"]
+
+    # ----------------------------------------------
+
+    def __init__(self, java_bin, temp_dir, interval, perfdata_dir, archive=False, database=None):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.log.debug("START")
+
+        self.java_bin = java_bin
+        self.temp_dir = temp_dir
+        self.interval = interval
+        self.perfdata_dir = perfdata_dir
+        self.archive = archive
+        self.database = database
+
+        self.log.debug("END")
+
+    # ----------------------------------------------
+
+    def _escape(self, value):
+
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    # ----------------------------------------------
+
+    def _formatMetrics(self, samples):
+        """
+        samples is a list of (pid, name, service, current_stat, old_stat);
+        service is the _Config target, or None.
+        """
+
+        self.log.debug("START")
+
+        metrics = {}
+
+        def add(metric, labels, value):
+            metrics.setdefault(metric, []).append((labels, value))
+
+        for pid, name, service, current_stat, old_stat in samples:
+            base = 'name="%s",pid="%d"' % (self._escape(name), pid)
+            if service is not None:
+                base += ',target="%s"' % self._escape(service)
+            add("jvm_gcutil_up", base, int(current_stat is not None))
+            if current_stat is None:
+                continue
+
+            if "Timestamp" in current_stat:
+                add("jvm_uptime_seconds", base, current_stat["Timestamp"])
+            for column in self.SPACE_COLUMNS:
+                if isinstance(current_stat.get(column), float):
+                    add("jvm_gc_space_utilization_percent",
+                        '%s,space="%s"' % (base, column), current_stat[column])
+            for column, gc in sorted(self.COUNT_COLUMNS.items()):
+                if isinstance(current_stat.get(column), float):
+                    add("jvm_gc_collections_total",
+                        '%s,gc="%s"' % (base, gc), current_stat[column])
+            for column, gc in sorted(self.TIME_COLUMNS.items()):
+                if isinstance(current_stat.get(column), float):
+                    add("jvm_gc_time_seconds_total",
+                        '%s,gc="%s"' % (base, gc), current_stat[column] / self.TIME_SCALE)
+
+            if old_stat is None:
+                continue
+            elapsed = current_stat["Timestamp"] - old_stat["Timestamp"]
+            add("jvm_gc_window_seconds", base, elapsed)
+            for column, gc in sorted(self.COUNT_COLUMNS.items()):
+                if isinstance(current_stat.get(column), float) and column in old_stat:
+                    delta = current_stat[column] - old_stat[column]
+                    labels = '%s,gc="%s"' % (base, gc)
+                    add("jvm_gc_window_collections", labels, delta)
+                    if elapsed > 0:
+                        add("jvm_gc_window_collections_per_second", labels, delta / elapsed)
+            for column, gc in sorted(self.TIME_COLUMNS.items()):
+                if isinstance(current_stat.get(column), float) and column in old_stat:
+                    delta = (current_stat[column] - old_stat[column]) / self.TIME_SCALE
+                    labels = '%s,gc="%s"' % (base, gc)
+                    add("jvm_gc_window_time_seconds", labels, delta)
+                    if elapsed > 0:
+                        add("jvm_gc_window_time_ratio", labels, delta / elapsed)
+
+        lines = []
+        for metric in sorted(metrics):
+            if metric.endswith("_total"):
+                lines.append("# TYPE %s counter" % metric)
+            else:
+                lines.append("# TYPE %s gauge" % metric)
+            for labels, value in metrics[metric]:
+                lines.append("%s{%s} %s" % (metric, labels, repr(float(value))))
+
+        self.log.debug("END")
+
+        return "\n".join(lines) + "\n"
+
+    # ----------------------------------------------
+
+    def _writeAtomic(self, path, text):
+
+        self.log.debug("START")
+
+        import tempfile
+
+        directory = os.path.dirname(os.path.abspath(path))
+        (fd, temp_path) = tempfile.mkstemp(prefix=".check_jvm.", dir=directory)
+        f = os.fdopen(fd, "w")
+        try:
+            f.write(text)
+            f.close()
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            f.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        self.log.debug("END")
+
+        return 0
+
+    # ----------------------------------------------
+
+    def _pruneHistory(self, jvms, exported):
+        """
+        Histories are kept per name and pid, so a restarted JVM leaves the
+        files of its old pid behind. Remember the keys exported and remove
+        the histories of those no longer among the running jvms. Nothing
+        is removed while no JVM is listed, as jps may have failed.
+        """
+
+        self.log.debug("START")
+
+        store = HistoryStore(self.temp_dir, self.interval)
+        path = os.path.join(self.temp_dir, self.KEYS_FILE)
+        try:
+            keys = set(store._loadJson(path) or [])
+        except ValueError:
+            keys = set()
+        keys.update(exported)
+        if len(jvms) > 0:
+            running = set([_historyKey(jvm_name, pid) for pid, jvm_name in jvms])
+            for key in keys - running:
+                self.log.debug("Exited: %s", key)
+                HistoryStore(self.temp_dir, self.interval, key).remove()
+            keys &= running
+        store._saveJson(path, sorted(keys))
+
+        self.log.debug("END")
+
+        return 0
+
+    # ----------------------------------------------
+
+    def export(self, path, name=None, targets=None):
+        """
+        Export all JVMs (those matching name), or the _Config targets
+        with the prometheus output.
+        """
+
+        self.log.debug("START")
+
+        jvms = _listJvms(self.java_bin)
+        running = jvms
+        selected = []
+        if targets is not None:
+            for target in targets:
+                if "prometheus" not in target["output"]:
+                    continue
+                for pid, jvm_name in _matchTarget(jvms, target):
+                    selected.append((pid, jvm_name, target["service"], target["interval"],
+                                     target.get("archive", False)))
+        else:
+            if name is not None:
+                jvms = _matchJvms(jvms, name)
+            for pid, jvm_name in jvms:
+                selected.append((pid, jvm_name, None, self.interval, self.archive))
+
+        sampler = Sampler(self.java_bin, self.perfdata_dir)
+        if self.database is not None:
+            self.database.beginBatch()
+        samples = []
+        exported = []
+        for pid, jvm_name, service, interval, archive in selected:
+            current_stat = sampler.sample(pid)
+            old_stat = None
+            if current_stat is not None:
+                exported.append(_historyKey(jvm_name, pid))
+                history = _openHistory(self.temp_dir, interval, _historyKey(jvm_name, pid),
+                                       self.database)
+                history.archive = archive
+                old_stat = history.baseline(current_stat)
+            samples.append((pid, jvm_name, service, current_stat, old_stat))
+        if self.database is not None:
+            self.database.commit()
+        try:
+            self._pruneHistory(running, exported)
+        except (IOError, OSError), e:
+            self.log.error("Unable to prune histories. (%s)", e)
+
+        try:
+            self._writeAtomic(path, self._formatMetrics(samples))
+        except (IOError, OSError), e:
+            self.log.debug("EXIT")
+            print "UNKNOWN: Unable to write %s. (%s)" % (path, e)
+            return CheckResult.STATE_UNKNOWN
+
+        print "OK: exported %d JVMs to %s." % (len(samples), path)
+
+        self.log.debug("END")
+
+        return CheckResult.STATE_OK
+
+
+# ----------------------------------------------
+# Internal Class: _DiagnosticCapture
+# ----------------------------------------------
+
+class _DiagnosticCapture:
+    """
+    Evidence of a CRITICAL target (gccause, class histogram, thread dump)
+    written to a timestamped directory by a detached process, so the
+    check result is not delayed.
+
+    A target is captured at most once per cooldown, at most max_running
+    captures run at a time, and the oldest captures are removed while
+    the directory holds more than max_bytes.
+    """
+
+    COMMANDS = [
+        ("gccause.txt", "jstat", ["-gccause", "%(pid)d"]),
+        ("class_histogram.txt", "jmap", ["-histo", "%(pid)d"]),
+        ("threads.txt", "jstack", ["%(pid)d"]),
+    ]
+    STAMP_NAME = ".%s.last"
+    SLOT_NAME = ".running.%d"
+    COMMAND_TIMEOUT = 60
+    # A slot older than this belongs to a capture which died.
+    SLOT_TIMEOUT = 600
 
     # ----------------------------------------------
 
-    def _parseGcUtil(self, stdout):
+    def __init__(self, java_bin, directory, cooldown=3600, max_running=2, max_bytes=100 * 1024 * 1024):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
 
-        self.log.debug("START")
+        self.java_bin = java_bin
+        self.directory = directory
+        self.cooldown = cooldown
+        self.max_running = max_running
+        self.max_bytes = max_bytes
+        self.background = True
 
-        data = {}
-        line = stdout.split("\n")
-        headers = re.split(" +", line[0].strip())
-        values = re.split(" +", line[1].strip())
-        for i in range(0, len(headers)):
-            self.log.debug("%s:%s" % (headers[i], values[i]))
-            try:
-                data[headers[i]] = float(values[i])
-            except ValueError:
-                data[headers[i]] = values[i]
+    # ----------------------------------------------
 
-        self.log.debug(data)
+    def _coolingDown(self, key, now):
 
-        self.log.debug("END")
+        path = os.path.join(self.directory, self.STAMP_NAME % key)
+        try:
+            last = os.path.getmtime(path)
+        except OSError:
+            return False
 
-        return data
+        return now - last < self.cooldown
 
     # ----------------------------------------------
 
-    def _getGcUtil(self):
+    def _acquireSlot(self, now):
+        """
+        Path of a free capture slot, None if max_running are busy.
+        """
 
-        self.log.debug("START")
+        for index in range(0, self.max_running):
+            path = os.path.join(self.directory, self.SLOT_NAME % index)
+            try:
+                if now - os.path.getmtime(path) >= self.SLOT_TIMEOUT:
+                    os.remove(path)
+            except OSError:
+                pass
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            except OSError:
+                continue
+            os.close(fd)
+            return path
 
-        if self.pid is None:
-            self.log.error("PID is not set.")
-            self.log.debug("EXIT")
-            return None
+        return None
 
-        jstat = os.path.join(self.java_bin, "jstat")
-        cmd = "%s -gcutil -t %d" % (jstat, self.pid)
-        stdout = commands.getoutput(cmd)
-        self.log.debug(cmd)
-        self.log.debug(stdout)
-        data = self._parseGcUtil(stdout)
+    # ----------------------------------------------
 
-        self.log.debug("END")
+    def _run(self, args, path):
+        """
+        Run args with stdout and stderr to path, killed after COMMAND_TIMEOUT.
+        """
 
-        return data
+        import signal
+        import subprocess
+
+        f = open(path, "w")
+        try:
+            try:
+                process = subprocess.Popen(args, stdout=f, stderr=subprocess.STDOUT)
+            except OSError, e:
+                f.write("%s: %s\n" % (args[0], e))
+                return None
+            deadline = time.time() + self.COMMAND_TIMEOUT
+            while process.poll() is None:
+                if time.time() >= deadline:
+                    os.kill(process.pid, signal.SIGKILL)
+                    process.wait()
+                    f.write("\n%s: killed after %d sec\n" % (args[0], self.COMMAND_TIMEOUT))
+                    break
+                time.sleep(0.1)
+        finally:
+            f.close()
+
+        return process.returncode
 
     # ----------------------------------------------
 
-    def _getJps(self, name):
+    def _prune(self):
+        """
+        Remove the oldest captures while the directory exceeds max_bytes;
+        the newest capture is always kept.
+        """
 
-        self.log.debug("START")
+        import shutil
+
+        captures = []
+        total = 0
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            size = 0
+            for entry in os.listdir(path):
+                try:
+                    size += os.path.getsize(os.path.join(path, entry))
+                except OSError:
+                    pass
+            captures.append((path, size))
+            total += size
+
+        for path, size in captures[:-1]:
+            if total <= self.max_bytes:
+                break
+            self.log.debug("Remove %s", path)
+            shutil.rmtree(path, True)
+            total -= size
 
-        jps = os.path.join(self.java_bin, "jps")
-        cmd = "%s | grep %s | awk '{ print $1 }'" % (jps, name)
-        stdout = commands.getoutput(cmd)
-        self.log.debug(cmd)
-        self.log.debug(stdout)
-        pid = None
-        try:
-            pid = int(stdout)
-        except ValueError:
-            self.log.error("PID get failed.")
-            pid = None
+    # ----------------------------------------------
 
-        self.log.debug("END")
+    def _collect(self, pid, key, slot, now):
 
-        return pid
+        try:
+            capture_dir = os.path.join(self.directory, "%s_%s" % (
+                time.strftime("%Y%m%dT%H%M%S", time.localtime(now)), key))
+            os.mkdir(capture_dir)
+            for filename, command, args in self.COMMANDS:
+                self._run([os.path.join(self.java_bin, command)] + [arg % {"pid": pid} for arg in args],
+                          os.path.join(capture_dir, filename))
+            self._prune()
+        finally:
+            os.remove(slot)
 
     # ----------------------------------------------
 
-    def _setValue(self, value):
+    def capture(self, pid, key, now=None):
+        """
+        Start a capture of pid unless key is cooling down or all slots are
+        busy; returns True if one was started.
+        """
 
         self.log.debug("START")
 
-        set_value = {}
-
-        set_value["value"] = int(value)
-        self.log.debug(set_value)
+        if now is None:
+            now = time.time()
+        if self._coolingDown(key, now):
+            self.log.debug("EXIT")
+            return False
+        slot = self._acquireSlot(now)
+        if slot is None:
+            self.log.debug("Too many captures running.")
+            self.log.debug("EXIT")
+            return False
+        stamp = os.path.join(self.directory, self.STAMP_NAME % key)
+        open(stamp, "w").close()
+        os.utime(stamp, (now, now))
+
+        if not self.background:
+            self._collect(pid, key, slot, now)
+            self.log.debug("END")
+            return True
+
+        # Detach twice so the capture outlives the check and leaves no zombie.
+        child = os.fork()
+        if child == 0:
+            try:
+                os.setsid()
+                if os.fork() == 0:
+                    devnull = os.open(os.devnull, os.O_RDWR)
+                    for fd in range(0, 3):
+                        os.dup2(devnull, fd)
+                    self._collect(pid, key, slot, now)
+            finally:
+                os._exit(0)
+        os.waitpid(child, 0)
 
         self.log.debug("END")
 
-        return set_value
+        return True
+
+
+# ----------------------------------------------
+# Internal Class: _PassiveSubmitter
+# ----------------------------------------------
+
+class _PassiveSubmitter:
+
+    COMMAND_FORMAT = "[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n"
+    CHECKRESULT_FORMAT = """### Passive Check Result File ###
+file_time=%(time)d
+
+host_name=%(host)s
+service_description=%(service)s
+check_type=1
+check_options=0
+scheduled_check=0
+reschedule_check=0
+latency=0.0
+start_time=%(time)d.0
+finish_time=%(time)d.0
+early_timeout=0
+exited_ok=1
+return_code=%(state)d
+output=%(output)s
+
+"""
+    PIPE_BUF = 4096
 
     # ----------------------------------------------
 
-    def _isValidThreshold(self, warning, critical):
+    def __init__(self, java_bin, temp_dir, perfdata_dir, database=None, diagnostics=None):
+        """
+        Constractor
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
 
         self.log.debug("START")
 
-        if warning is None and critical is None:
-            return self._printUnknown("Threshold is None.")
-        elif warning is None:
-            pass
-        elif critical is None:
-            pass
-        elif warning > critical:
-            return self._printUnknown("Warning value should be more than critical value.")
+        self.java_bin = java_bin
+        self.temp_dir = temp_dir
+        self.perfdata_dir = perfdata_dir
+        self.database = database
+        self.diagnostics = diagnostics
+        self.sampler = Sampler(java_bin, perfdata_dir)
 
         self.log.debug("END")
 
-        return self.STATE_OK
-
     # ----------------------------------------------
 
-    def setTimeWarning(self, warning):
+    def _checkTarget(self, target, jvms):
+        """
+        Run the check of one target quietly; returns (state, output).
+        """
 
         self.log.debug("START")
 
-        set_value = self._setValue(warning)
-        self.time_warning = set_value["value"]
-
-        ret = self._isValidThreshold(self.time_warning, self.time_critical)
-        if ret != self.STATE_OK:
+        matched = _matchTarget(jvms, target)
+        if len(matched) != 1:
             self.log.debug("EXIT")
-            return ret
+            return (CheckResult.STATE_UNKNOWN,
+                    "UNKNOWN: %d processes match '%s'." % (len(matched), target["match"] or target["name"]))
+
+        (pid, jvm_name) = matched[0]
+        result = self.evaluate(target, pid)
+        if result.state == CheckResult.STATE_CRITICAL and self.diagnostics is not None:
+            self.diagnostics.capture(pid, _historyKey("%s_%s" % (target["host"], target["service"])))
 
         self.log.debug("END")
 
-        return self.STATE_OK
+        return (result.state, NagiosOutput.format(result))
 
     # ----------------------------------------------
 
-    def setCountWarning(self, warning):
+    def evaluate(self, target, pid):
+        """
+        Evaluate the _Config target against the JVM pid in-process;
+        returns a CheckResult.
+        """
 
         self.log.debug("START")
 
-        set_value = self._setValue(warning)
-        self.count_warning = set_value["value"]
-
-        ret = self._isValidThreshold(self.count_warning, self.count_critical)
-        if ret != self.STATE_OK:
+        evaluator = Evaluator()
+        try:
+            evaluator.applyConfig(target)
+        except ValueError, e:
             self.log.debug("EXIT")
-            return ret
+            return CheckResult(CheckResult.STATE_UNKNOWN, str(e))
+
+        current_stat = self.sampler.sample(pid)
+        old_stat = None
+        trend = None
+        adaptive = None
+        if current_stat is not None:
+            history = _openHistory(self.temp_dir, target["interval"],
+                                   _historyKey("%s_%s" % (target["host"], target["service"])),
+                                   self.database)
+            if evaluator.needsThreadCpu():
+                _addThreadCpu(self.sampler, history, current_stat, pid, current_stat.get("start_time"))
+            history.archive = target.get("archive", False) or evaluator.needsTrend()
+            old_stat = history.baseline(current_stat)
+            if evaluator.needsTrend():
+                trend = TrendAnalysis.fromArchive(history, target["interval"])
+            adaptive = evaluator.adaptiveBaseline(history)
+        result = evaluator.evaluate(current_stat, old_stat, trend, adaptive)
 
         self.log.debug("END")
 
-        return self.STATE_OK
+        return result
 
     # ----------------------------------------------
 
-    def setTimeCritical(self, ctitical):
+    def _writeCommands(self, path, lines):
+        """
+        Append to the command pipe (or a regular file standing in for it)
+        in writes of at most PIPE_BUF bytes, so lines never interleave.
+
+        The pipe is opened without blocking, so OSError ENXIO is raised
+        at once when Nagios is not running, i.e. has no reader open.
+        """
 
         self.log.debug("START")
 
-        set_value = self._setValue(ctitical)
-        self.time_critical = set_value["value"]
+        import fcntl
 
-        ret = self._isValidThreshold(self.time_warning, self.time_critical)
-        if ret != self.STATE_OK:
-            self.log.debug("EXIT")
-            return ret
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+        try:
+            # Writes may wait for Nagios to drain the pipe.
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            chunk = ""
+            for line in lines:
+                if len(chunk) + len(line) > self.PIPE_BUF and chunk != "":
+                    os.write(fd, chunk)
+                    chunk = ""
+                chunk += line
+            if chunk != "":
+                os.write(fd, chunk)
+        finally:
+            os.close(fd)
 
         self.log.debug("END")
 
-        return self.STATE_OK
+        return 0
 
     # ----------------------------------------------
 
-    def setCountCritical(self, ctitical):
+    def _writeCheckResults(self, directory, results, now):
+        """
+        Drop one check result file (with its .ok marker) into the spool.
+        """
 
         self.log.debug("START")
 
-        set_value = self._setValue(ctitical)
-        self.count_critical = set_value["value"]
+        import tempfile
 
-        ret = self._isValidThreshold(self.count_warning, self.count_critical)
-        if ret != self.STATE_OK:
-            self.log.debug("EXIT")
-            return ret
+        (fd, path) = tempfile.mkstemp(prefix="c", dir=directory)
+        f = os.fdopen(fd, "w")
+        for host, service, state, output in results:
+            f.write(self.CHECKRESULT_FORMAT % {
+                "time": now, "host": host, "service": service,
+                "state": state, "output": output})
+        f.close()
+        os.chmod(path, 0644)
+        f = open(path + ".ok", "w")
+        f.close()
 
         self.log.debug("END")
 
-        return self.STATE_OK
+        return 0
 
     # ----------------------------------------------
 
-    def _getOldStat(self):
+    def submit(self, targets, command_path, jvms=None):
+        """
+        Check targets against jvms, [(pid, name)], or a jps run, and
+        submit the results.
+        """
 
         self.log.debug("START")
 
-        if self.current_stat is None:
-            return 1
-
-        history_filename = os.path.join(self.temp_dir, self.TEMPFILE_NAME)
-        history1_filename = history_filename % "1"
-        history2_filename = history_filename % "2"
-
-        history1 = self._loadJson(history1_filename)
-        history2 = self._loadJson(history2_filename)
-
-        # check different process
-        if history1 is not None and history1["pid"] != self.pid:
-            self.log.debug("Target process is restarted (1).")
-            history1 = None
-            history2 = None
-        if history2 is not None and history2["pid"] != self.pid:
-            self.log.debug("Target process is restarted (2).")
-            history1 = None
-            history2 = None
+        if jvms is None:
+            jvms = _listJvms(self.java_bin)
+        now = int(time.time())
+        results = []
+        counts = [0, 0, 0, 0]
+        if self.database is not None:
+            self.database.beginBatch()
+        for target in targets:
+            if "passive" not in target["output"]:
+                continue
+            (state, output) = self._checkTarget(target, jvms)
+            # Nagios takes the rest of the line as output, so ";" in the
+            # perfdata is kept.
+            output = output.replace("\n", " ")
+            results.append((target["host"], target["service"], state, output))
+            counts[state] += 1
+        if self.database is not None:
+            self.database.commit()
 
-        # choice history
-        using = 0
-        if history1 is None:
-            self.log.debug("Initialize phase.")
-        else:
-            history1_diff = self.current_stat["Timestamp"] - history1["Timestamp"]
-            history2_diff = self.current_stat["Timestamp"] - history2["Timestamp"]
-            self.log.debug("history1: %d, history2: %d" % (history1_diff, history2_diff))
-            if self.interval > history1_diff \
-                    and (self.interval > history2_diff or history2_diff >= self.interval * 2):
-                self.log.debug("Early phase (1).")
-                self.log.debug("EXIT")
-                return None
-            elif self.interval > history2_diff \
-                    and (self.interval > history1_diff or history1_diff >= self.interval * 2):
-                self.log.debug("Early phase (2).")
-                self.log.debug("EXIT")
-                return None
-            elif self.interval <= history1_diff and history1_diff < self.interval * 2:
-                using = 1
-            elif self.interval <= history2_diff and history2_diff < self.interval * 2:
-                using = 2
+        try:
+            if os.path.isdir(command_path):
+                self._writeCheckResults(command_path, results, now)
             else:
-                self.log.debug("Data is too old.")
-                using = 0
-        self.log.debug("Using %d" % using)
-
-        # choice data
-        history = None
-        if using == 1:
-            history = history1
-        elif using == 2:
-            history = history2
-        self.log.debug(history)
+                lines = []
+                for host, service, state, output in results:
+                    lines.append(self.COMMAND_FORMAT % (now, host, service, state, output))
+                self._writeCommands(command_path, lines)
+        except (IOError, OSError), e:
+            if e.errno == errno.ENXIO:
+                # The results are dropped; the next submit checks again.
+                self.log.error("Nagios is not reading %s.", command_path)
+                self.log.debug("EXIT")
+                print "UNKNOWN: Nagios is not running. (no reader on %s)" % command_path
+                return CheckResult.STATE_UNKNOWN
+            self.log.debug("EXIT")
+            print "UNKNOWN: Unable to submit to %s. (%s)" % (command_path, e)
+            return CheckResult.STATE_UNKNOWN
 
-        # save history
-        save_stat = copy.deepcopy(self.current_stat)
-        save_stat["pid"] = self.pid
-        if using == 0:
-            self._saveJson(history1_filename, save_stat)
-            self._saveJson(history2_filename, save_stat)
-        elif using == 1:
-            if history2 is None or history1["Timestamp"] >= history2["Timestamp"]:
-                self._saveJson(history2_filename, save_stat)
-        elif using == 2:
-            if history2["Timestamp"] >= history1["Timestamp"]:
-                self._saveJson(history1_filename, save_stat)
+        print "OK: submitted %d results. (%d ok, %d warning, %d critical, %d unknown)" % (
+            len(results), counts[0], counts[1], counts[2], counts[3])
 
         self.log.debug("END")
 
-        return history
-
-    # ----------------------------------------------
-
-    def checkGc(self):
-
-        self.log.debug("START")
+        return CheckResult.STATE_OK
 
-        result = self._checkGc(self.current_stat, self.old_stat)
 
-        self.log.debug("END")
+# -----------------------------------------------
+# Passive loop
+# -----------------------------------------------
 
-        return result
+def _runPassiveLoop(submitter, config, command_path, every, perfdata_dir):
+    """
+    Submit the config targets every seconds until interrupted. The
+    config is re-read when it changes; JVMs come from a JvmWatcher.
+    """
 
-    # ----------------------------------------------
+    log = logging.getLogger("_runPassiveLoop")
 
-    def _checkGc(self, current_stat, old_stat):
+    watcher = JvmWatcher(perfdata_dir)
+    watcher.on_stop.append(submitter.sampler.forget)
+    next_time = time.time()
+    try:
+        while True:
+            try:
+                targets = config.getTargets()
+            except (IOError, OSError, ValueError), e:
+                log.error("Invalid config. (%s)", e)
+            else:
+                submitter.submit(targets, command_path, watcher.jvms())
+                sys.stdout.flush()
+            next_time += every
+            now = time.time()
+            if next_time < now:
+                next_time = now
+            while now < next_time:
+                watcher.update(next_time - now)
+                now = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
-        self.log.debug("START")
+    return 0
 
-        if current_stat is None:
-            return self._printUnknown("Unable to get gcutil.")
-        elif old_stat is None:
-            print "OK: now collecting data."
-            self.log.debug("EXIT")
-            return self.STATE_OK
 
-        # gc time
-        time = current_stat["FGCT"] - old_stat["FGCT"]
-        self.log.debug("GC time: %.03f", time)
-        if self.time_critical <= time:
-            self.log.debug("%d <= %.03f" % (self.time_critical, time))
-            return self._printCritical("GC time is too long. (%d msec)" % time)
-        elif self.time_warning <= time:
-            self.log.debug("%d <= %.03f" % (self.time_warning, time))
-            return self._printWarning("GC time is too long. (%d msec)" % time)
+# ----------------------------------------------
 
-        # gc count
-        count = current_stat["FGC"] - old_stat["FGC"]
-        self.log.debug("GC count: %.03f", count)
-        if self.count_critical <= count:
-            self.log.debug("%d <= %.03f" % (self.count_critical, count))
-            return self._printCritical("GC count is too occured. (%d times)" % count)
-        elif self.count_warning <= count:
-            self.log.debug("%d <= %.03f" % (self.count_warning, count))
-            return self._printWarning("GC count is too occured. (%d times)" % count)
+def _adviseHeap(temp_dir, interval, keys, days, pause_target, overhead_target):
+    """
+    Print a HeapAdvisor report for each history key, or for every
+    archive in temp_dir when keys is None.
+    """
 
-        print "OK: GC time is %.03f msec, GC count is %d." % (time, count)
+    log = logging.getLogger("_adviseHeap")
 
-        self.log.debug("END")
+    if keys is None:
+        keys = []
+        for path in sorted(glob.glob(os.path.join(temp_dir, "jstat_*archive_state.log"))):
+            match = re.match(r"jstat_(?:(.+)_)?archive_state\.log$", os.path.basename(path))
+            if match is not None:
+                keys.append(match.group(1))
+    if len(keys) == 0:
+        print "UNKNOWN: No archive in %s." % temp_dir
+        return _Jvm.STATE_UNKNOWN
 
-        return self.STATE_OK
+    now = time.time()
+    for key in keys:
+        log.debug("key: %s", key)
+        history = HistoryStore(temp_dir, interval, key)
+        advisor = HeapAdvisor.fromArchive(history, days * 86400, now)
+        print "%s:" % (key or "(default)")
+        for line in advisor.report(pause_target, overhead_target / 100.0):
+            print "  %s" % line
 
-    # ----------------------------------------------
+    return _Jvm.STATE_OK
 
 
 # -----------------------------------------------
@@ -450,6 +4350,8 @@ def main():
     Main
     """
 
+    from optparse import OptionParser
+
     usage = "Usage: %prog [option ...]"
     version = "%%prog %s\nCopyright (C) 2014 Yuichiro SAITO." % (
         PROGRAM_VERSION)
@@ -501,6 +4403,181 @@ def main():
                       default="/usr/bin",
                       metavar="<path>",
                       help="Java bin directory. [default: %default]")
+    parser.add_option("--perfdata-dir",
+                      type="string",
+                      dest="perfdata_dir",
+                      default=_Jvm.PERFDATA_DIR,
+                      metavar="<path>",
+                      help="Directory holding hsperfdata_<user>. [default: %default]")
+    parser.add_option("--export-textfile",
+                      type="string",
+                      dest="export_textfile",
+                      metavar="<path>",
+                      help="Write metrics of all JVMs (or those matching --name) to a node_exporter textfile.")
+    parser.add_option("--passive",
+                      type="string",
+                      dest="passive",
+                      metavar="<path>",
+                      help="Submit passive results of all --config targets to a command file or check result directory.")
+    parser.add_option("--every",
+                      type="int",
+                      dest="every",
+                      metavar="<sec>",
+                      help="Keep running and submit --passive results every <sec>, following JVMs by hsperfdata events instead of jps.")
+    parser.add_option("--config", "--passive-config",
+                      type="string",
+                      dest="config",
+                      metavar="<path>",
+                      help="Target definitions with per-target thresholds, rules and outputs.")
+    parser.add_option("--target",
+                      type="string",
+                      dest="target",
+                      metavar="<section>",
+                      help="Check the --config target of this section.")
+    parser.add_option("--warning-rule",
+                      type="string",
+                      action="append",
+                      dest="warning_rules",
+                      default=[],
+                      metavar="<rule>",
+                      help="Exit with WARNING status if the rule matches, e.g. 'delta(FGCT) / elapsed > 50' (msec per sec). Repeatable.")
+    parser.add_option("--critical-rule",
+                      type="string",
+                      action="append",
+                      dest="critical_rules",
+                      default=[],
+                      metavar="<rule>",
+                      help="Exit with CRITICAL status if the rule matches, e.g. 'O > 90 and rate(FGC) > 1/min'. Repeatable.")
+    parser.add_option("--history-db",
+                      type="string",
+                      dest="history_db",
+                      metavar="<path>",
+                      help="Keep the history of all targets in this SQLite file instead of JSON files in --tempdir.")
+    parser.add_option("--archive",
+                      action="store_true",
+                      dest="archive",
+                      default=False,
+                      help="Keep consolidated history (raw 1h, 1 min for 1 day, 10 min for 30 days) next to the check history.")
+    parser.add_option("--metaspace-warning",
+                      type="float",
+                      dest="metaspace_warning",
+                      metavar="<percent>",
+                      help="Exit with WARNING status if metaspace (perm gen before JDK 8) usage exceeds value.")
+    parser.add_option("--metaspace-critical",
+                      type="float",
+                      dest="metaspace_critical",
+                      metavar="<percent>",
+                      help="Exit with CRITICAL status if metaspace (perm gen before JDK 8) usage exceeds value.")
+    parser.add_option("--metaspace-growth-warning",
+                      type="float",
+                      dest="metaspace_growth_warning",
+                      metavar="<MB/h>",
+                      help="Exit with WARNING status if metaspace grows faster than value.")
+    parser.add_option("--metaspace-growth-critical",
+                      type="float",
+                      dest="metaspace_growth_critical",
+                      metavar="<MB/h>",
+                      help="Exit with CRITICAL status if metaspace grows faster than value.")
+    parser.add_option("--tenuring-warning",
+                      type="float",
+                      dest="tenuring_warning",
+                      metavar="<age>",
+                      help="Exit with WARNING status if the tenuring threshold stays at or below value.")
+    parser.add_option("--promotion-warning",
+                      type="float",
+                      dest="promotion_warning",
+                      metavar="<MB>",
+                      help="Exit with WARNING status if old gen grows by more than value per young gc.")
+    parser.add_option("--gc-cpu-warning",
+                      type="float",
+                      dest="gc_cpu_warning",
+                      metavar="<percent>",
+                      help="Exit with WARNING status if gc threads use more than value of the process cpu.")
+    parser.add_option("--gc-cpu-critical",
+                      type="float",
+                      dest="gc_cpu_critical",
+                      metavar="<percent>",
+                      help="Exit with CRITICAL status if gc threads use more than value of the process cpu.")
+    parser.add_option("--gc-cpu-host-warning",
+                      type="float",
+                      dest="gc_cpu_host_warning",
+                      metavar="<percent>",
+                      help="Exit with WARNING status if gc threads use more than value of all host cores.")
+    parser.add_option("--gc-cpu-host-critical",
+                      type="float",
+                      dest="gc_cpu_host_critical",
+                      metavar="<percent>",
+                      help="Exit with CRITICAL status if gc threads use more than value of all host cores.")
+    parser.add_option("--advise-heap",
+                      action="store_true",
+                      dest="advise_heap",
+                      default=False,
+                      help="Report heap sizes from the archives in --tempdir (of the --config targets if given) and exit.")
+    parser.add_option("--advise-days",
+                      type="float",
+                      dest="advise_days",
+                      default=14.0,
+                      metavar="<days>",
+                      help="Days of archive the heap report reads. [default: %default]")
+    parser.add_option("--pause-target",
+                      type="int",
+                      dest="pause_target",
+                      default=200,
+                      metavar="<msec>",
+                      help="Young gc pause the heap report aims at. [default: %default]")
+    parser.add_option("--overhead-target",
+                      type="float",
+                      dest="overhead_target",
+                      default=5.0,
+                      metavar="<percent>",
+                      help="GC time per elapsed time the heap report aims at. [default: %default]")
+    parser.add_option("--exclude-cause",
+                      type="string",
+                      action="append",
+                      dest="exclude_causes",
+                      default=[],
+                      metavar="<cause>",
+                      help="Do not count full gcs of this cause against the thresholds, e.g. 'System.gc()'. Repeatable.")
+    parser.add_option("--adaptive",
+                      action="store_true",
+                      dest="adaptive",
+                      default=False,
+                      help="Learn the usual full gc time and count of each target and alert on deviation from it.")
+    parser.add_option("--adaptive-warning",
+                      type="float",
+                      dest="adaptive_warning",
+                      default=3.0,
+                      metavar="<sigma>",
+                      help="Exit with WARNING status at this many standard deviations above the learned mean. [default: %default]")
+    parser.add_option("--adaptive-critical",
+                      type="float",
+                      dest="adaptive_critical",
+                      default=5.0,
+                      metavar="<sigma>",
+                      help="Exit with CRITICAL status at this many standard deviations above the learned mean. [default: %default]")
+    parser.add_option("--diagnostics-dir",
+                      type="string",
+                      dest="diagnostics_dir",
+                      metavar="<path>",
+                      help="On CRITICAL, capture gccause, class histogram and thread dump into this directory in the background.")
+    parser.add_option("--diagnostics-cooldown",
+                      type="int",
+                      dest="diagnostics_cooldown",
+                      default=3600,
+                      metavar="<sec>",
+                      help="Minimum time between captures of one target. [default: %default]")
+    parser.add_option("--diagnostics-max-running",
+                      type="int",
+                      dest="diagnostics_max_running",
+                      default=2,
+                      metavar="<count>",
+                      help="Maximum captures running at a time. [default: %default]")
+    parser.add_option("--diagnostics-max-size",
+                      type="int",
+                      dest="diagnostics_max_size",
+                      default=100,
+                      metavar="<MB>",
+                      help="Remove the oldest captures above this size. [default: %default]")
     parser.add_option("-V", "--verbose",
                       action="store_true",
                       dest="verbose",
@@ -511,34 +4588,122 @@ def main():
     if options.verbose:
         logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
     else:
-        logging.basicConfig(level=logging.CRITICAL, format=LOG_FORMAT)
+        # No handler is needed when nothing below CRITICAL is emitted.
+        logging.getLogger().setLevel(logging.CRITICAL)
 
     logging.debug("START")
 
-    if options.name is None:
-        logging.error("'--name' is required.")
-        logging.debug("EXIT")
-        return _Jvm.STATE_UNKNOWN
-
-    checker = _Jvm(
-        options.bin, options.tempdir, options.name, options.interval)
+    defaults = {
+        "interval": options.interval,
+        "time_warning": options.time_warning,
+        "time_critical": options.time_critical,
+        "count_warning": options.count_warning,
+        "count_critical": options.count_critical,
+        "warning_rules": options.warning_rules,
+        "critical_rules": options.critical_rules,
+        "archive": options.archive,
+        "adaptive": options.adaptive,
+        "adaptive_warning": options.adaptive_warning,
+        "adaptive_critical": options.adaptive_critical,
+        "metaspace_warning": options.metaspace_warning,
+        "metaspace_critical": options.metaspace_critical,
+        "metaspace_growth_warning": options.metaspace_growth_warning,
+        "metaspace_growth_critical": options.metaspace_growth_critical,
+        "exclude_causes": options.exclude_causes,
+        "tenuring_warning": options.tenuring_warning,
+        "promotion_warning": options.promotion_warning,
+        "gc_cpu_warning": options.gc_cpu_warning,
+        "gc_cpu_critical": options.gc_cpu_critical,
+        "gc_cpu_host_warning": options.gc_cpu_host_warning,
+        "gc_cpu_host_critical": options.gc_cpu_host_critical,
+    }
+
+    database = None
+    if options.history_db is not None:
+        database = SqliteHistory(options.history_db)
+
+    diagnostics = None
+    if options.diagnostics_dir is not None:
+        diagnostics = _DiagnosticCapture(
+            options.bin, options.diagnostics_dir, options.diagnostics_cooldown,
+            options.diagnostics_max_running, options.diagnostics_max_size * 1024 * 1024)
+
+    targets = None
+    if options.config is not None:
+        config = _Config(options.config, options.tempdir, defaults)
+        try:
+            targets = config.getTargets()
+        except (IOError, OSError, ValueError), e:
+            print "UNKNOWN: Invalid config. (%s)" % e
+            logging.debug("EXIT")
+            return _Jvm.STATE_UNKNOWN
+
+    if options.advise_heap:
+        keys = None
+        if targets is not None:
+            keys = [_historyKey("%s_%s" % (target["host"], target["service"])) for target in targets]
+        ret = _adviseHeap(options.tempdir, options.interval, keys, options.advise_days,
+                          options.pause_target, options.overhead_target)
+        logging.debug("END")
+        return ret
 
-    ret = checker.setTimeWarning(options.time_warning)
-    if ret != _Jvm.STATE_OK:
-        logging.debug("EXIT")
+    if options.export_textfile is not None:
+        exporter = _PrometheusExporter(
+            options.bin, options.tempdir, options.interval, options.perfdata_dir,
+            options.archive, database)
+        ret = exporter.export(options.export_textfile, options.name, targets)
+        logging.debug("END")
         return ret
-    ret = checker.setTimeCritical(options.time_critical)
-    if ret != _Jvm.STATE_OK:
-        logging.debug("EXIT")
+
+    if options.passive is not None:
+        if targets is None:
+            logging.error("'--config' is required.")
+            logging.debug("EXIT")
+            return _Jvm.STATE_UNKNOWN
+        submitter = _PassiveSubmitter(
+            options.bin, options.tempdir, options.perfdata_dir, database, diagnostics)
+        if options.every is None:
+            ret = submitter.submit(targets, options.passive)
+            logging.debug("END")
+            return ret
+        ret = _runPassiveLoop(submitter, config, options.passive, options.every, options.perfdata_dir)
+        logging.debug("END")
         return ret
-    ret = checker.setCountWarning(options.count_warning)
-    if ret != _Jvm.STATE_OK:
+
+    if options.target is not None:
+        if targets is None:
+            logging.error("'--config' is required.")
+            logging.debug("EXIT")
+            return _Jvm.STATE_UNKNOWN
+        target = config.getTarget(options.target)
+        if target is None:
+            print "UNKNOWN: No such target '%s'." % options.target
+            logging.debug("EXIT")
+            return _Jvm.STATE_UNKNOWN
+        matched = _matchTarget(_listJvms(options.bin), target)
+        if len(matched) != 1:
+            print "UNKNOWN: %d processes match '%s'." % (len(matched), target["match"] or target["name"])
+            logging.debug("EXIT")
+            return _Jvm.STATE_UNKNOWN
+        checker = _Jvm(
+            options.bin, options.tempdir, matched[0][1], target["interval"],
+            options.perfdata_dir, matched[0][0],
+            _historyKey("%s_%s" % (target["host"], target["service"])), database)
+    elif options.name is None:
+        logging.error("'--name' is required.")
         logging.debug("EXIT")
-        return ret
-    ret = checker.setCountCritical(options.count_critical)
+        return _Jvm.STATE_UNKNOWN
+    else:
+        target = defaults
+        checker = _Jvm(
+            options.bin, options.tempdir, options.name, options.interval,
+            options.perfdata_dir, database=database)
+
+    ret = checker.applyConfig(target)
     if ret != _Jvm.STATE_OK:
         logging.debug("EXIT")
         return ret
+    checker.diagnostics = diagnostics
 
     ret = checker.checkGc()
 
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------
+# check_jvm_launcher.py
+#
+# Copyright(C) 2015 Yuichiro SAITO
+# This software is released under the MIT License, see LICENSE.txt.
+# ----------------------------------------------
+
+# A script given to the interpreter is compiled on every run, while an
+# imported module reuses its .pyc. Installing this launcher as the plugin
+# command keeps check_jvm.py compiled across checks.
+
+import sys
+import check_jvm
+
+if __name__ == '__main__':
+    sys.exit(check_jvm.main())
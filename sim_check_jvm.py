@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------
+# sim_check_jvm.py
+#
+# Copyright(C) 2015 Yuichiro SAITO
+# This software is released under the MIT License, see LICENSE.txt.
+# ----------------------------------------------
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import logging
+from optparse import OptionParser
+
+from check_jvm import _Jvm
+
+# ----------------------------------------------
+# Global Variables
+# ----------------------------------------------
+LOG_FORMAT = '%(levelname)s\t%(asctime)s\t%(name)s\t%(funcName)s\t"%(message)s"'
+
+SCENARIOS = ["steady", "gc_storm", "leak", "restart", "clock_jump"]
+
+# jstat prints GC times in seconds and the sampler of check_jvm converts
+# them to msec, the unit of its thresholds. "msec" feeds the checker
+# samples as the sampler makes them, "sec" raw jstat values.
+FGCT_SCALE = {"msec": 1000.0, "sec": 1.0}
+
+
+# ----------------------------------------------
+# JVM model
+# ----------------------------------------------
+
+class _JvmModel:
+    """
+    Cumulative gcutil counters of one simulated JVM.
+    """
+
+    def __init__(self, rand, pid, fgct_scale):
+
+        self.rand = rand
+        self.pid = pid
+        self.fgct_scale = fgct_scale
+        self.restart(pid)
+
+    # ----------------------------------------------
+
+    def restart(self, pid):
+
+        self.pid = pid
+        self.uptime = 0.0
+        self.ygc = 0
+        self.ygct = 0.0
+        self.fgc = 0
+        self.fgct = 0.0
+        self.eden = 0.0
+        self.old = 20.0
+        self.live = 20.0
+
+    # ----------------------------------------------
+
+    def _fullGc(self, pause):
+
+        self.fgc += 1
+        self.fgct += pause
+        self.old = self.live + self.rand.uniform(0.0, 5.0)
+
+    # ----------------------------------------------
+
+    def step(self, dt, mode):
+        """
+        Advance the model by dt seconds in the given mode.
+        """
+
+        rand = self.rand
+        self.uptime += dt
+
+        young = int(dt / rand.uniform(4.0, 8.0))
+        self.ygc += young
+        self.ygct += young * rand.uniform(0.005, 0.02)
+        self.old += young * rand.uniform(0.01, 0.05)
+        self.eden = rand.uniform(0.0, 100.0)
+
+        if mode == "leak":
+            self.live = min(self.live + dt * 0.004, 97.0)
+
+        if mode == "storm":
+            for i in range(0, int(dt / rand.uniform(10.0, 30.0))):
+                self._fullGc(rand.uniform(0.5, 2.0))
+        elif self.old >= 90.0:
+            self._fullGc(rand.uniform(0.05, 0.3) + (self.live / 100.0) ** 4)
+        elif rand.random() < dt / 7200.0:
+            self._fullGc(rand.uniform(0.05, 0.3))
+
+    # ----------------------------------------------
+
+    def sample(self, timestamp_offset):
+
+        return {
+            "Timestamp": round(self.uptime + timestamp_offset, 1),
+            "S0": 0.0,
+            "S1": round(self.rand.uniform(0.0, 60.0), 2),
+            "E": round(self.eden, 2),
+            "O": round(min(self.old, 100.0), 2),
+            "P": 60.0,
+            "YGC": float(self.ygc),
+            "YGCT": round(self.ygct * self.fgct_scale, 3),
+            "FGC": float(self.fgc),
+            "FGCT": round(self.fgct * self.fgct_scale, 3),
+            "GCT": round((self.ygct + self.fgct) * self.fgct_scale, 3),
+        }
+
+
+# ----------------------------------------------
+# Scenario generator
+# ----------------------------------------------
+
+def generate(scenario, hours, period, interval, seed, fgct_unit="msec"):
+    """
+    Build a counter stream for a scenario.
+
+    Returns (samples, events): samples is a list of (wall_time, pid, stat)
+    and events a list of (start, end) wall-time ranges that should alert.
+    """
+
+    rand = random.Random(seed)
+    model = _JvmModel(rand, 10000 + rand.randint(0, 20000),
+                      FGCT_SCALE[fgct_unit])
+    total = int(hours * 3600)
+    onset = total * rand.uniform(0.4, 0.6)
+    events = []
+    samples = []
+    offset = 0.0
+
+    if scenario == "gc_storm":
+        events.append((onset, onset + rand.uniform(900.0, 1800.0)))
+    elif scenario == "leak":
+        events.append((onset, total))
+
+    wall = 0.0
+    restarted = False
+    jumped = False
+    while wall <= total:
+        mode = "steady"
+        for start, end in events:
+            if start <= wall < end:
+                mode = "storm" if scenario == "gc_storm" else scenario
+
+        if scenario == "restart" and not restarted and wall >= onset:
+            # Busy hosts reuse PIDs, so the new JVM keeps the same one.
+            model.restart(model.pid)
+            restarted = True
+        if scenario == "clock_jump" and not jumped and wall >= onset:
+            offset += rand.choice([-1, 1]) * interval * 3
+            jumped = True
+
+        model.step(period, mode)
+        samples.append((wall, model.pid, model.sample(offset)))
+        wall += period
+
+    return (samples, events)
+
+
+# ----------------------------------------------
+# Replay
+# ----------------------------------------------
+
+def replay(checker, samples):
+    """
+    Feed samples through _getOldStat and _checkGc; returns the states.
+    """
+
+    states = []
+    saved_stdout = sys.stdout
+    devnull = open(os.devnull, "w")
+    sys.stdout = devnull
+    try:
+        for wall, pid, stat in samples:
+            checker.pid = pid
+            checker.current_stat = stat
+            old_stat = checker._getOldStat()
+            adaptive = checker.evaluator.adaptiveBaseline(checker.history)
+            states.append(checker._checkGc(stat, old_stat, None, adaptive))
+    finally:
+        sys.stdout = saved_stdout
+        devnull.close()
+
+    return states
+
+
+# ----------------------------------------------
+
+def score(samples, events, states, interval):
+    """
+    Detection latency per event and false positives outside any event.
+
+    A sample counts as a negative when its comparison window, which can
+    reach back up to 2 * interval, does not overlap an event.
+    """
+
+    latencies = []
+    missed = 0
+    for start, end in events:
+        found = None
+        for (wall, pid, stat), state in zip(samples, states):
+            if start <= wall <= end + interval * 2 \
+                    and state != _Jvm.STATE_OK:
+                found = wall - start
+                break
+        if found is None:
+            missed += 1
+        else:
+            latencies.append(found)
+
+    negatives = 0
+    false_positives = 0
+    for (wall, pid, stat), state in zip(samples, states):
+        overlapped = False
+        for start, end in events:
+            if wall - interval * 2 <= end and start <= wall:
+                overlapped = True
+        if overlapped:
+            continue
+        negatives += 1
+        if state != _Jvm.STATE_OK:
+            false_positives += 1
+
+    return {
+        "events": len(events),
+        "detected": len(latencies),
+        "missed": missed,
+        "latencies": latencies,
+        "negatives": negatives,
+        "false_positives": false_positives,
+    }
+
+
+# ----------------------------------------------
+
+def _percentile(values, ratio):
+
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+# ----------------------------------------------
+
+def runScenario(scenario, options, temp_dir):
+
+    checker = _Jvm("/nonexistent", temp_dir, scenario, options.interval)
+    checker.setTimeWarning(options.time_warning)
+    checker.setTimeCritical(options.time_critical)
+    checker.setCountWarning(options.count_warning)
+    checker.setCountCritical(options.count_critical)
+    if options.adaptive:
+        checker.evaluator.setAdaptive(options.adaptive_warning, options.adaptive_critical)
+
+    total = {"events": 0, "detected": 0, "missed": 0, "latencies": [],
+             "negatives": 0, "false_positives": 0}
+    sample_count = 0
+    replay_time = 0.0
+    for run in range(0, options.runs):
+        for name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, name))
+        samples, events = generate(scenario, options.hours, options.period,
+                                   options.interval, options.seed + run,
+                                   options.fgct_unit)
+        start = time.time()
+        states = replay(checker, samples)
+        replay_time += time.time() - start
+        sample_count += len(samples)
+
+        result = score(samples, events, states, options.interval)
+        for key in total:
+            total[key] += result[key]
+
+    latencies = total.pop("latencies")
+    total["samples"] = sample_count
+    total["replay_sec"] = replay_time
+    total["samples_per_sec"] = sample_count / replay_time if replay_time > 0 else None
+    total["detection_latency"] = {
+        "min": _percentile(latencies, 0.0),
+        "median": _percentile(latencies, 0.5),
+        "p95": _percentile(latencies, 0.95),
+        "max": _percentile(latencies, 1.0),
+    }
+    if total["negatives"] > 0:
+        total["false_positive_rate"] = \
+            float(total["false_positives"]) / total["negatives"]
+    else:
+        total["false_positive_rate"] = None
+
+    return total
+
+
+# -----------------------------------------------
+# Main
+# -----------------------------------------------
+
+def main():
+    """
+    Main
+    """
+
+    usage = "Usage: %prog [option ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-s", "--scenario",
+                      type="choice",
+                      choices=SCENARIOS,
+                      action="append",
+                      dest="scenarios",
+                      metavar="<name>",
+                      help="Scenario to replay, repeatable. [default: all]")
+    parser.add_option("-w", "--time-warning", type="int", dest="time_warning",
+                      default=200, metavar="<msec>",
+                      help="Full gc time warning threshold. [default: %default]")
+    parser.add_option("-c", "--time-critical", type="int", dest="time_critical",
+                      default=1000, metavar="<msec>",
+                      help="Full gc time critical threshold. [default: %default]")
+    parser.add_option("-W", "--count-warning", type="int", dest="count_warning",
+                      default=3, metavar="<count>",
+                      help="Full gc count warning threshold. [default: %default]")
+    parser.add_option("-C", "--count-critical", type="int", dest="count_critical",
+                      default=10, metavar="<count>",
+                      help="Full gc count critical threshold. [default: %default]")
+    parser.add_option("-i", "--interval", type="int", dest="interval",
+                      default=600, metavar="<sec>",
+                      help="Monitoring interval (sec). [default: %default]")
+    parser.add_option("-p", "--period", type="int", dest="period",
+                      default=60, metavar="<sec>",
+                      help="Seconds between samples. [default: %default]")
+    parser.add_option("-H", "--hours", type="float", dest="hours",
+                      default=6.0, metavar="<hours>",
+                      help="Length of each stream. [default: %default]")
+    parser.add_option("-r", "--runs", type="int", dest="runs",
+                      default=10, metavar="<count>",
+                      help="Streams per scenario. [default: %default]")
+    parser.add_option("--seed", type="int", dest="seed",
+                      default=1, metavar="<seed>",
+                      help="Random seed of the first stream. [default: %default]")
+    parser.add_option("--fgct-unit", type="choice", dest="fgct_unit",
+                      choices=sorted(FGCT_SCALE.keys()), default="msec",
+                      metavar="<unit>",
+                      help="Unit of generated YGCT/FGCT/GCT (msec, sec). [default: %default]")
+    parser.add_option("--adaptive", action="store_true", dest="adaptive",
+                      default=False,
+                      help="Replay with the adaptive baseline of check_jvm.")
+    parser.add_option("--adaptive-warning", type="float", dest="adaptive_warning",
+                      default=3.0, metavar="<sigma>",
+                      help="Adaptive warning threshold. [default: %default]")
+    parser.add_option("--adaptive-critical", type="float", dest="adaptive_critical",
+                      default=5.0, metavar="<sigma>",
+                      help="Adaptive critical threshold. [default: %default]")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL, format=LOG_FORMAT)
+
+    result = {
+        "thresholds": {
+            "time_warning": options.time_warning,
+            "time_critical": options.time_critical,
+            "count_warning": options.count_warning,
+            "count_critical": options.count_critical,
+            "interval": options.interval,
+            "adaptive": options.adaptive,
+        },
+        "scenarios": {},
+    }
+    temp_dir = tempfile.mkdtemp(prefix="sim_check_jvm.")
+    try:
+        for scenario in options.scenarios or SCENARIOS:
+            result["scenarios"][scenario] = runScenario(
+                scenario, options, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print json.dumps(result, indent=4, sort_keys=True)
+
+    return 0
+
+
+# ----------------------------------------------
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,7 +11,19 @@ import unittest
 import os
 import logging
 import copy
-from check_jvm import _Jvm
+import shutil
+import tempfile
+import sys
+import time
+import StringIO
+import optparse
+import check_jvm
+import sim_check_jvm
+from check_jvm import CheckResult, NagiosOutput, Sampler, HistoryStore, Evaluator, SqliteHistory
+from check_jvm import JvmWatcher
+from check_jvm import TrendAnalysis, HeapAdvisor
+from check_jvm import _Jvm, _Rule, _Config, _PrometheusExporter, _PassiveSubmitter, _DiagnosticCapture
+from bench_check_jvm import writePerfData, _FakeJdk
 
 
 # ----------------------------------------------
@@ -33,7 +45,8 @@ class TestSequenceFunctions(unittest.TestCase):
             "P": 68, 
             "GCT": 10.0, 
             "YGC": 655.0, 
-            "FGC": 10.0
+            "FGC": 10.0, 
+            "version": HistoryStore.VERSION
         }
         self.java_bin = "/usr/java/jdk1.7.0_72/bin"
         self.temp_dir = "/tmp"
@@ -53,6 +66,14 @@ class TestSequenceFunctions(unittest.TestCase):
 
     # ----------------------------------------------
 
+    def _defaults(self):
+
+        return {"interval": self.interval, "time_warning": 200, "time_critical": 1000,
+                "count_warning": 3, "count_critical": 10,
+                "warning_rules": [], "critical_rules": []}
+
+    # ----------------------------------------------
+
     def _initJstatLog(self, checker):
 
         checker.current_stat = self.baseJstatData
@@ -171,6 +192,59 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(ret, _Jvm.STATE_UNKNOWN)
 
     # ----------------------------------------------
+
+    def test_paramCheckGC_5(self):
+        """
+        ルール: 最も悪い状態を採用
+        """
+        checker = _Jvm(self.java_bin, self.temp_dir, self.name, self.interval)
+        self._initJstatLog(checker)
+        checker.setTimeWarning(301)
+        checker.setTimeCritical(302)
+        checker.setCountWarning(5)
+        checker.setCountCritical(6)
+        self.assertEqual(checker.addRule(_Jvm.STATE_CRITICAL, "O >= 90 and rate(FGC) > 2/min"), _Jvm.STATE_OK)
+        self.assertEqual(checker.checkGc(), _Jvm.STATE_CRITICAL)
+        self.assertEqual(checker.output, "CRITICAL: Rule 'O >= 90 and rate(FGC) > 2/min' matched. | gc_time=200ms;301;302 gc_count=5;5;6")
+
+    # ----------------------------------------------
+
+    def test_paramCheckGC_6(self):
+        """
+        ルール: 未知のカウンタ / 構文エラー
+        """
+        checker = _Jvm(self.java_bin, self.temp_dir, self.name, self.interval)
+        self._initJstatLog(checker)
+        checker.setTimeWarning(301)
+        checker.setTimeCritical(302)
+        checker.setCountWarning(11)
+        checker.setCountCritical(12)
+        self.assertEqual(checker.addRule(_Jvm.STATE_WARNING, "delta(FGC) >"), _Jvm.STATE_UNKNOWN)
+        self.assertEqual(checker.addRule(_Jvm.STATE_WARNING, "MU > 90"), _Jvm.STATE_OK)
+        self.assertEqual(checker.checkGc(), _Jvm.STATE_UNKNOWN)
+
+    # ----------------------------------------------
+
+    def test_rule_1(self):
+        """
+        ルール: 評価
+        """
+        old = copy.deepcopy(self.baseJstatData)
+        old["Timestamp"] -= 60
+        old["FGC"] -= 2
+        old["FGCT"] -= 3
+        self.assertTrue(_Rule.compile("delta(FGCT) / elapsed > 0.04").evaluate(self.baseJstatData, old))
+        self.assertFalse(_Rule.compile("delta(FGCT)/elapsed > 0.05").evaluate(self.baseJstatData, old))
+        self.assertTrue(_Rule.compile("rate(FGC) >= 2/min and not O < 90").evaluate(self.baseJstatData, old))
+        self.assertTrue(_Rule.compile("-prev(FGC) + FGC * 1 == 2 or P > 100").evaluate(self.baseJstatData, old))
+        self.assertEqual(_Rule.compile("rate(FGC) > 0").evaluate(self.baseJstatData, None), None)
+        self.assertTrue(_Rule.compile("O > 50").evaluate(self.baseJstatData, None))
+        self.assertTrue(_Rule.compile("O > 50") is _Rule.compile("O > 50"))
+        self.assertRaises(ValueError, _Rule, "O > (50")
+        self.assertRaises(ValueError, _Rule, "size(O) > 1")
+        self.assertRaises(ValueError, _Rule, "O > 1 ; import os")
+
+    # ----------------------------------------------
     
     def test_parseGcUtil_1(self):
         """
@@ -572,6 +646,880 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(history1, save_data1)
         self.assertEqual(history2, save_data2)
 
+    # ----------------------------------------------
+    
+    def test_getOldStat_G(self):
+        """
+        過去データ取得: PID 再利用 (起動時刻が異なる)
+        """
+        self._clearJstatLog()
+        checker = _Jvm(self.java_bin, self.temp_dir, self.name, self.interval)
+        checker.current_stat = self.baseJstatData
+        checker.pid = self.baseJstatData["pid"]
+        checker.start_time = 1420000000000
+
+        save_data = copy.deepcopy(self.baseJstatData)
+        save_data["Timestamp"] = self.baseJstatData["Timestamp"] - self.interval
+        save_data["start_time"] = checker.start_time - 3600000
+        checker._saveJson(self.history1_filename, save_data)
+        checker._saveJson(self.history2_filename, save_data)
+
+        ret = checker._getOldStat()
+        self.assertEqual(ret, None)
+
+        expected = copy.deepcopy(self.baseJstatData)
+        expected["start_time"] = checker.start_time
+        self.assertEqual(checker._loadJson(self.history1_filename), expected)
+        self.assertEqual(checker._loadJson(self.history2_filename), expected)
+
+    # ----------------------------------------------
+    
+    def test_getOldStat_H(self):
+        """
+        過去データ取得: カウンタ逆行 (同一 PID で再起動)
+        """
+        self._clearJstatLog()
+        checker = _Jvm(self.java_bin, self.temp_dir, self.name, self.interval)
+        checker.current_stat = self.baseJstatData
+        checker.pid = self.baseJstatData["pid"]
+
+        save_data = copy.deepcopy(self.baseJstatData)
+        save_data["Timestamp"] = self.baseJstatData["Timestamp"] - self.interval
+        save_data["FGC"] = self.baseJstatData["FGC"] + 5
+        checker._saveJson(self.history1_filename, save_data)
+        checker._saveJson(self.history2_filename, save_data)
+
+        ret = checker._getOldStat()
+        self.assertEqual(ret, None)
+        self.assertEqual(checker._loadJson(self.history1_filename), self.baseJstatData)
+
+    # ----------------------------------------------
+    
+    def test_getVmStartTime_1(self):
+        """
+        hsperfdata から JVM 起動時刻を取得
+        """
+        perfdata_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(perfdata_dir, "hsperfdata_test"))
+            writePerfData(os.path.join(perfdata_dir, "hsperfdata_test", "16276"), [
+                ("sun.rt.createVmBeginTime", 1420000000000),
+                ("sun.rt.javaCommand", "test.Main"),
+            ])
+            checker = _Jvm(self.java_bin, self.temp_dir, self.name, self.interval, perfdata_dir)
+            checker.pid = 16276
+            self.assertEqual(checker._getPerfData()["sun.rt.javaCommand"], "test.Main")
+            self.assertEqual(checker._getVmStartTime(), 1420000000000)
+        finally:
+            shutil.rmtree(perfdata_dir)
+
+    # ----------------------------------------------
+    
+    def test_export_1(self):
+        """
+        Prometheus textfile 出力: 全 JVM とウィンドウ差分
+        """
+        root = tempfile.mkdtemp()
+        saved_stdout = sys.stdout
+        try:
+            jdk = _FakeJdk(root, 2, self.interval)
+            path = os.path.join(root, "jvm.prom")
+            exporter = _PrometheusExporter(jdk.bin_dir, root, self.interval, root)
+            sys.stdout = StringIO.StringIO()
+            self.assertEqual(exporter.export(path), _Jvm.STATE_OK)
+            jdk.setStep(1)
+            self.assertEqual(exporter.export(path), _Jvm.STATE_OK)
+            sys.stdout = saved_stdout
+
+            f = open(path, "r")
+            text = f.read()
+            f.close()
+            self.assertTrue('jvm_gc_collections_total{name="BenchTarget001Main",pid="20001",gc="full"} 11.0' in text)
+            self.assertTrue('jvm_gc_window_collections{name="BenchTarget000Main",pid="20000",gc="full"} 1.0' in text)
+            # GC times are sampled in msec and exported in seconds
+            self.assertTrue('jvm_gc_time_seconds_total{name="BenchTarget000Main",pid="20000",gc="full"} 2.05' in text)
+            self.assertEqual([name for name in os.listdir(root) if name.startswith(".check_jvm.")], [])
+
+            # the history of an exited JVM is removed
+            self.assertTrue(os.path.exists(os.path.join(root, "jstat_BenchTarget000Main_20000_1.log")))
+            f = open(os.path.join(root, "jps.out"), "w")
+            f.write("20001 BenchTarget001Main\n")
+            f.close()
+            sys.stdout = StringIO.StringIO()
+            self.assertEqual(exporter.export(path), _Jvm.STATE_OK)
+            sys.stdout = saved_stdout
+            self.assertEqual(sorted([name for name in os.listdir(root) if name.startswith("jstat_Bench")]),
+                             ["jstat_BenchTarget001Main_20001_1.log", "jstat_BenchTarget001Main_20001_2.log",
+                              "jstat_BenchTarget001Main_20001_last.log"])
+        finally:
+            sys.stdout = saved_stdout
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+    
+    def test_passive_1(self):
+        """
+        パッシブチェック: コマンドファイルへ一括投入
+        """
+        root = tempfile.mkdtemp()
+        saved_stdout = sys.stdout
+        try:
+            jdk = _FakeJdk(root, 2, self.interval)
+            config = os.path.join(root, "check_jvm.ini")
+            f = open(config, "w")
+            f.write("[DEFAULT]\nhost = app01\n\n"
+                    "[JVM GC 0]\nname = BenchTarget000Main\n\n"
+                    "[JVM GC 1]\nname = BenchTarget001Main\ncount_warning = 1\ncount_critical = 2\n\n"
+                    "[JVM GC X]\nname = Missing\n")
+            f.close()
+            command_file = os.path.join(root, "nagios.cmd")
+            open(command_file, "w").close()
+
+            targets = _Config(config, root, self._defaults()).getTargets()
+            submitter = _PassiveSubmitter(jdk.bin_dir, root, root)
+            sys.stdout = StringIO.StringIO()
+            self.assertEqual(submitter.submit(targets, command_file), _Jvm.STATE_OK)
+            jdk.setStep(1)
+            self.assertEqual(submitter.submit(targets, command_file), _Jvm.STATE_OK)
+            sys.stdout = saved_stdout
+
+            f = open(command_file, "r")
+            lines = f.read().splitlines()
+            f.close()
+            self.assertEqual(len(lines), 6)
+            self.assertTrue(lines[3].endswith("PROCESS_SERVICE_CHECK_RESULT;app01;JVM GC 0;0;OK: GC time is 50.000 msec, GC count is 1. | gc_time=50ms;200;1000 gc_count=1;3;10"))
+            self.assertTrue(";app01;JVM GC 1;1;WARNING: " in lines[4])
+            self.assertTrue(";app01;JVM GC X;3;UNKNOWN: " in lines[5])
+
+            # a command pipe without Nagios reading it does not block
+            fifo = os.path.join(root, "nagios.fifo")
+            os.mkfifo(fifo)
+            sys.stdout = StringIO.StringIO()
+            self.assertEqual(submitter.submit(targets, fifo), _Jvm.STATE_UNKNOWN)
+            self.assertTrue(sys.stdout.getvalue().startswith("UNKNOWN: Nagios is not running."))
+            reader = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                self.assertEqual(submitter.submit(targets, fifo), _Jvm.STATE_OK)
+                self.assertEqual(len(os.read(reader, 65536).splitlines()), 3)
+            finally:
+                os.close(reader)
+            sys.stdout = saved_stdout
+        finally:
+            sys.stdout = saved_stdout
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+    
+    def test_config_1(self):
+        """
+        設定ファイル: 既定値の継承とキャッシュ
+        """
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, "check_jvm.ini")
+            f = open(path, "w")
+            f.write("[DEFAULT]\nhost = app01\ntime_warning = 300\n\n"
+                    "[tomcat]\nname = Bootstrap\noutput = prometheus\n"
+                    "critical_rules =\n    O > 90\n    rate(FGC) > 1/min\n\n"
+                    "[batch]\nmatch = ^\\d+ batch\\.\ninterval = 60\ntime_warning = 100\n")
+            f.close()
+
+            targets = _Config(path, root, self._defaults()).getTargets()
+            self.assertEqual([target["service"] for target in targets], ["tomcat", "batch"])
+            self.assertEqual(targets[0]["time_warning"], 300)
+            self.assertEqual(targets[0]["time_critical"], 1000)
+            self.assertEqual(targets[0]["critical_rules"], ["O > 90", "rate(FGC) > 1/min"])
+            self.assertEqual(targets[0]["output"], ["prometheus"])
+            self.assertEqual(targets[1]["interval"], 60)
+            self.assertEqual(targets[1]["time_warning"], 100)
+            self.assertEqual(targets[1]["output"], ["passive", "prometheus"])
+
+            config = _Config(path, root, self._defaults())
+            config._parse = None
+            self.assertEqual(config.getTargets(), targets)
+            self.assertTrue(config.getTargets() is config.getTargets())
+
+            f = open(path, "a")
+            f.write("[broken]\nhost = app02\n")
+            f.close()
+            self.assertRaises(ValueError, _Config(path, root, self._defaults()).getTargets)
+        finally:
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_library_1(self):
+        """
+        ライブラリ API: 標準出力を使わずに評価
+        """
+        root = tempfile.mkdtemp()
+        saved_stdout = sys.stdout
+        try:
+            jdk = _FakeJdk(root, 1, self.interval)
+            sampler = Sampler(jdk.bin_dir, root)
+            (pid, name) = sampler.listJvms()[0]
+            history = HistoryStore(root, self.interval, "lib")
+            evaluator = Evaluator()
+            evaluator.setTimeWarning(200)
+            evaluator.setTimeCritical(1000)
+            evaluator.setCountWarning(1)
+            evaluator.setCountCritical(3)
+            self.assertRaises(ValueError, evaluator.setCountWarning, 5)
+            self.assertRaises(ValueError, evaluator.addRule, CheckResult.STATE_WARNING, "O >")
+            evaluator.setCountWarning(1)
+
+            sys.stdout = StringIO.StringIO()
+            stat = sampler.sample(pid)
+            self.assertEqual(stat["pid"], pid)
+            result = evaluator.evaluate(stat, history.baseline(stat))
+            self.assertEqual(result.state, CheckResult.STATE_OK)
+            self.assertEqual(NagiosOutput.format(result), "OK: now collecting data.")
+
+            jdk.setStep(1)
+            stat = sampler.sample(pid)
+            result = evaluator.evaluate(stat, history.baseline(stat))
+            self.assertEqual(sys.stdout.getvalue(), "")
+            sys.stdout = saved_stdout
+            self.assertEqual(result.state, CheckResult.STATE_WARNING)
+            self.assertEqual(result.metrics["gc_count"], 1)
+            self.assertEqual(result.perfdata[1], ("gc_count", 1, "", 1, 3))
+            self.assertEqual(NagiosOutput.format(result),
+                             "WARNING: GC count is too occured. (1 times) Causes: unknown (1 times, 50 msec)."
+                             " | gc_time=50ms;200;1000 gc_count=1;1;3")
+        finally:
+            sys.stdout = saved_stdout
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_archive_1(self):
+        """
+        統合履歴: 差分の集約と粒度の選択
+        """
+        root = tempfile.mkdtemp()
+        try:
+            history = HistoryStore(root, self.interval, "archive")
+            start = 1000000 * 600
+            stat = dict(self.baseJstatData)
+            for minute in range(0, 180):
+                stat["Timestamp"] = 1800 + minute * 60
+                stat["FGC"] = 10.0 + minute
+                stat["FGCT"] += minute % 2 + 1
+                stat["O"] = 50.0 + minute % 30
+                history.record(dict(stat), start + minute * 60 + 1)
+            now = start + 179 * 60 + 1
+
+            (step, rows) = history.query(now - 600, now, 0, now)
+            self.assertEqual(step, 0)
+            self.assertEqual(len(rows), 11)
+            (step, rows) = history.query(start, now, 600, now)
+            self.assertEqual(step, 600)
+            self.assertEqual(len(rows), 18)
+            self.assertEqual(rows[1][2]["FGCT"], (1.0, 2.0, 1.5))
+            (step, rows) = history.query(now - 7200, now, 60, now)
+            self.assertEqual(step, 60)
+            self.assertEqual(len(rows), 120)
+
+            summary = history.summary("FGC", 3600, now)
+            self.assertEqual(summary["sum"], 60.0)
+            self.assertEqual(summary["max"], 1.0)
+            summary = history.summary("O", 10800, now)
+            self.assertEqual((summary["min"], summary["max"]), (50.0, 79.0))
+
+            # restart: no delta across JVMs
+            stat["pid"] = 1
+            history.record(dict(stat), now + 60)
+            (step, rows) = history.query(now + 60, now + 60, 0, now + 60)
+            self.assertFalse("FGC" in rows[0][2])
+        finally:
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_version_1(self):
+        """
+        形式の変更: GC 時間が秒だった旧形式の履歴は比較せず計測し直す
+        """
+        root = tempfile.mkdtemp()
+        try:
+            history = HistoryStore(root, self.interval, "upgrade")
+            history.archive = True
+            old = dict(self.baseJstatData, FGCT=2.048)
+            del old["version"]
+            history._saveJson(os.path.join(root, history.tempfile_name % "1"), old)
+            history._saveJson(os.path.join(root, history.tempfile_name % "2"), old)
+            history._saveJson(history._archivePath("state"),
+                              {"last": old, "open": {}, "pruned": {}})
+            history._appendRows("raw", [[1000, 1, {"FGCT": [0.5, 0.5, 0.5]}]])
+            history._saveJson(os.path.join(root, history.tempfile_name % "adaptive"),
+                              {"n": 20, "last": 1000, "gc_time": [0.002, 0.0], "gc_count": [0.1, 0.1]})
+
+            evaluator = Evaluator()
+            evaluator.applyConfig(dict(self._defaults(), adaptive=True,
+                                       adaptive_warning=3.0, adaptive_critical=5.0))
+            current = dict(self.baseJstatData, Timestamp=old["Timestamp"] + self.interval, FGCT=2048.0)
+            result = evaluator.evaluate(current, history.baseline(current), None,
+                                        evaluator.adaptiveBaseline(history))
+            self.assertEqual(NagiosOutput.format(result), "OK: now collecting data.")
+            self.assertEqual(history._loadJson(os.path.join(root, history.tempfile_name % "1"))["version"],
+                             HistoryStore.VERSION)
+            self.assertEqual(history._readRows("raw", 0, 2000), [])
+            self.assertEqual(evaluator.adaptiveBaseline(history).state["n"], 0)
+        finally:
+            shutil.rmtree(root)
+    # ----------------------------------------------
+
+    def test_sqlite_1(self):
+        """
+        SQLite 履歴: JSON ファイルと同じ基準値の選択
+        """
+        root = tempfile.mkdtemp()
+        try:
+            database = SqliteHistory(os.path.join(root, "history.db"))
+            history = database.store(root, self.interval, "app01_tomcat")
+            other = database.store(root, self.interval, "app01_batch")
+            stat = dict(self.baseJstatData)
+
+            self.assertEqual(history.baseline(dict(stat)), None)
+            stat["Timestamp"] += 50
+            self.assertEqual(history.baseline(dict(stat)), None)
+            stat["Timestamp"] += 60
+            self.assertEqual(history.baseline(dict(stat))["Timestamp"], 1800)
+            stat["Timestamp"] += 60
+            self.assertEqual(history.baseline(dict(stat))["Timestamp"], 1850)
+            self.assertEqual(other.baseline(dict(stat)), None)
+
+            # restarted JVM
+            stat["FGC"] = 0.0
+            stat["Timestamp"] += 100
+            self.assertEqual(history.baseline(dict(stat)), None)
+
+            database.beginBatch()
+            stat["Timestamp"] += 150
+            self.assertEqual(history.baseline(dict(stat))["Timestamp"], 2070)
+            database.close()
+            self.assertEqual(len(SqliteHistory(database.path).recent("app01_tomcat", 0)), 6)
+        finally:
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_trend_1(self):
+        """
+        傾向分析: 傾き・z スコアとルールへの反映
+        """
+        root = tempfile.mkdtemp()
+        try:
+            history = HistoryStore(root, 600, "trend")
+            start = 1000000 * 86400
+            stat = dict(self.baseJstatData)
+            for step in range(0, 750):
+                stat["Timestamp"] = 1800 + step * 120
+                if step >= 720:
+                    # the last hour: full GCs and old gen growing
+                    stat["FGC"] += 2
+                    stat["O"] = 50.0 + (step - 720)
+                else:
+                    stat["FGC"] += step % 3
+                    stat["O"] = 50.0
+                history.record(dict(stat), start + step * 120)
+            now = start + 749 * 120
+
+            trend = TrendAnalysis.fromArchive(history, 600, now)
+            self.assertEqual(trend.delta("FGC"), 12.0)
+            self.assertAlmostEqual(trend.rate("FGC"), 10.0 / 600)
+            self.assertAlmostEqual(trend.slope("O"), 1.0 / 120)
+            self.assertTrue(trend.zscore("FGC") > 3)
+            self.assertRaises(KeyError, trend.slope, "MU")
+
+            evaluator = Evaluator()
+            evaluator.applyConfig(dict(self._defaults(), warning_rules=["zscore(FGC) > 3"],
+                                       critical_rules=["slope(O) * hour > 50"]))
+            self.assertTrue(evaluator.needsTrend())
+            self.assertEqual(evaluator.evaluate(stat, None).state, CheckResult.STATE_OK)
+            result = evaluator.evaluate(stat, None, trend)
+            self.assertEqual(result.state, CheckResult.STATE_WARNING)
+            self.assertEqual(result.message, "Rule 'zscore(FGC) > 3' matched.")
+
+            flat = TrendAnalysis([now], {"O": [50.0]}, {"O": [None]})
+            self.assertRaises(ZeroDivisionError, flat.slope, "O")
+        finally:
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_trend_2(self):
+        """
+        傾向分析: 複数サンプルを集約した段の差分とレート
+        """
+        root = tempfile.mkdtemp()
+        try:
+            history = HistoryStore(root, 600, "trend")
+            start = 1000000 * 86400
+            stat = dict(self.baseJstatData)
+            for step in range(0, 360):
+                # a full GC every 30 sec for 3 hours
+                stat["Timestamp"] = 1800 + step * 30
+                stat["FGC"] += 1
+                history.record(dict(stat), start + step * 30)
+            now = start + 359 * 30
+
+            # 2 hours are read from the 1-minute tier, 2 samples per row
+            trend = TrendAnalysis.fromArchive(history, 7200, now)
+            self.assertEqual(trend.delta("FGC"), 240.0)
+            self.assertAlmostEqual(trend.rate("FGC"), 1.0 / 30)
+            self.assertAlmostEqual(trend.slope("FGC"), 0.0)
+        finally:
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_adaptive_1(self):
+        """
+        適応的閾値: 学習後は通常の分布からの逸脱で判定
+        """
+        root = tempfile.mkdtemp()
+        try:
+            history = HistoryStore(root, self.interval, "adaptive")
+            evaluator = Evaluator()
+            evaluator.applyConfig(dict(self._defaults(), adaptive=True,
+                                       adaptive_warning=3.0, adaptive_critical=5.0))
+            old = dict(self.baseJstatData)
+            for window in range(0, 20):
+                # one 2 second full GC per window is usual for this JVM
+                current = dict(old, Timestamp=old["Timestamp"] + self.interval,
+                               FGC=old["FGC"] + 1, FGCT=old["FGCT"] + 1900 + (window % 3) * 100)
+                adaptive = evaluator.adaptiveBaseline(history)
+                result = evaluator.evaluate(current, old, None, adaptive)
+                if window < 12:
+                    self.assertEqual(result.state, CheckResult.STATE_CRITICAL)
+                else:
+                    self.assertEqual(result.state, CheckResult.STATE_OK)
+                old = current
+            adaptive = evaluator.adaptiveBaseline(history)
+            self.assertEqual(adaptive.state["n"], 20)
+            self.assertEqual(adaptive.describe("gc_time"), (2000.0, 148.26))
+
+            # overlapping windows are not learned twice
+            adaptive.learn({"gc_time": 0.0, "gc_count": 0.0}, old["Timestamp"] + 10)
+            self.assertEqual(adaptive.state["n"], 20)
+
+            current = dict(old, Timestamp=old["Timestamp"] + self.interval,
+                           FGC=old["FGC"] + 3, FGCT=old["FGCT"] + 2000)
+            result = evaluator.evaluate(current, old, None, adaptive)
+            self.assertEqual(result.state, CheckResult.STATE_CRITICAL)
+            self.assertEqual(result.message, "GC count is too occured than usual. (3 times)")
+            self.assertEqual(adaptive.state["n"], 20)
+            self.assertRaises(ValueError, evaluator.setAdaptive, 5, 3)
+        finally:
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_adaptive_2(self):
+        """
+        適応的閾値: 平常時のシミュレーションで固定の閾値より誤検知が少ない
+        """
+        root = tempfile.mkdtemp()
+        try:
+            options = optparse.Values({
+                "time_warning": 200, "time_critical": 1000, "count_warning": 3, "count_critical": 10,
+                "interval": 600, "period": 60, "hours": 24.0, "runs": 3, "seed": 1, "fgct_unit": "msec",
+                "adaptive": False, "adaptive_warning": 3.0, "adaptive_critical": 5.0})
+            static = sim_check_jvm.runScenario("steady", options, root)
+            options.adaptive = True
+            adaptive = sim_check_jvm.runScenario("steady", options, root)
+        finally:
+            shutil.rmtree(root)
+        self.assertEqual(adaptive["negatives"], static["negatives"])
+        self.assertTrue(adaptive["false_positive_rate"] < static["false_positive_rate"])
+        self.assertTrue(adaptive["false_positive_rate"] < 0.02)
+
+    # ----------------------------------------------
+
+    def test_diagnostics_1(self):
+        """
+        診断情報の取得: クールダウン・同時実行数・容量の制限
+        """
+        root = tempfile.mkdtemp()
+        try:
+            jdk = _FakeJdk(root, 1, self.interval)
+            directory = os.path.join(root, "diagnostics")
+            os.mkdir(directory)
+            capture = _DiagnosticCapture(jdk.bin_dir, directory, 600, 1, 0)
+            capture.background = False
+            now = 1400000000
+            pid = jdk.pids.values()[0]
+
+            self.assertTrue(capture.capture(pid, "app01_tomcat", now))
+            self.assertFalse(capture.capture(pid, "app01_tomcat", now + 599))
+            captures = [name for name in os.listdir(directory) if not name.startswith(".")]
+            self.assertEqual(len(captures), 1)
+            files = sorted(os.listdir(os.path.join(directory, captures[0])))
+            self.assertEqual(files, ["class_histogram.txt", "gccause.txt", "threads.txt"])
+
+            # the only slot is taken by a running capture
+            slot = capture._acquireSlot(now + 600)
+            self.assertFalse(capture.capture(pid, "app01_tomcat", now + 600))
+            os.remove(slot)
+
+            # max_bytes 0 keeps the newest capture only
+            self.assertTrue(capture.capture(pid, "app01_tomcat", now + 601))
+            captures = sorted([name for name in os.listdir(directory) if not name.startswith(".")])
+            self.assertEqual(len(captures), 1)
+            self.assertTrue(captures[0].endswith("_app01_tomcat"))
+            self.assertFalse(os.path.exists(os.path.join(directory, ".running.0")))
+        finally:
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_metaspace_1(self):
+        """
+        Metaspace: JDK 毎の列の正規化と使用率・増加率の閾値
+        """
+        sampler = Sampler(self.java_bin)
+        jdk7 = ("Timestamp S0 S1 E O P YGC YGCT FGC FGCT GCT",
+                "1800.0 0.00 52.00 59.00 90.00 68.00 655 10.0 10 500.0 510.0")
+        stat = sampler._normalize(1, jdk7[0], sampler._parseGcUtil("\n".join(jdk7)), {
+            "sun.gc.generation.2.space.0.used": 60 * 1024 * 1024,
+            "sun.gc.generation.2.space.0.maxCapacity": 80 * 1024 * 1024})
+        self.assertEqual(stat["M"], 68.0)
+        # GC times in msec
+        self.assertEqual((stat["FGCT"], stat["GCT"]), (500000.0, 510000.0))
+        self.assertEqual((stat["MU"], stat["MCMX"]), (61440.0, 81920.0))
+        # MaxPermSize always bounds the permanent generation
+        self.assertEqual(stat["MMAX"], 81920.0)
+        self.assertEqual(sampler.layouts[1][1]["space"], "permgen")
+
+        jdk8 = ("Timestamp S0 S1 E O M CCS YGC YGCT FGC FGCT GCT",
+                "1800.0 0.00 52.00 59.00 90.00 97.50 95.00 655 10.0 10 500.0 510.0")
+        counters = {
+            "sun.gc.metaspace.used": 100 * 1024 * 1024,
+            # reserved space without MaxMetaspaceSize
+            "sun.gc.metaspace.maxCapacity": 1056768 * 1024,
+            "sun.gc.compressedclassspace.used": 10 * 1024 * 1024,
+            "java.rt.vmArgs": "-Xmx1g -XX:MetaspaceSize=64m"}
+        stat = sampler._normalize(2, jdk8[0], sampler._parseGcUtil("\n".join(jdk8)), counters)
+        self.assertFalse("P" in stat)
+        self.assertFalse("MMAX" in stat)
+        self.assertEqual((stat["M"], stat["CCSU"], stat["MCMX"]), (97.5, 10240.0, 1056768.0))
+        # the last MaxMetaspaceSize applies
+        bounded = sampler._normalize(2, jdk8[0], sampler._parseGcUtil("\n".join(jdk8)), dict(
+            counters, **{"sun.gc.metaspace.maxCapacity": 200 * 1024 * 1024,
+                         "java.rt.vmFlags": "MaxMetaspaceSize=1g",
+                         "java.rt.vmArgs": "-XX:MaxMetaspaceSize=100m -XX:MaxMetaspaceSize=200m"}))
+        self.assertEqual(bounded["MMAX"], 200 * 1024.0)
+        layout = sampler.layouts[2]
+        sampler._normalize(2, jdk8[0], {}, None)
+        self.assertTrue(sampler.layouts[2] is layout)
+
+        evaluator = Evaluator()
+        evaluator.applyConfig(dict(self._defaults(), time_warning=1000, time_critical=2000,
+                                   metaspace_warning=70, metaspace_critical=99,
+                                   metaspace_growth_warning=10, metaspace_growth_critical=50))
+        # unbounded MaxMetaspaceSize: jstat M is used
+        result = evaluator.evaluate(stat, None)
+        self.assertEqual(result.state, CheckResult.STATE_WARNING)
+        self.assertEqual(result.message, "Metaspace usage is too high. (97.5%)")
+
+        old = dict(bounded, MU=bounded["MU"] - 30 * 1024)
+        current = dict(bounded, Timestamp=bounded["Timestamp"] + 1800)
+        result = evaluator.evaluate(current, old)
+        self.assertEqual(result.state, CheckResult.STATE_CRITICAL)
+        self.assertEqual(result.message, "Metaspace is growing too fast. (60.0 MB/h)")
+        self.assertEqual(result.metrics["metaspace"], 50.0)
+        self.assertRaises(ValueError, evaluator.setMetaspace, 90, 80)
+
+    # ----------------------------------------------
+
+    def test_watcher_1(self):
+        """
+        JVM の監視: hsperfdata の作成・削除への追従 (inotify とポーリング)
+        """
+        for use_inotify in [True, False]:
+            root = tempfile.mkdtemp()
+            watcher = None
+            try:
+                os.mkdir(os.path.join(root, "hsperfdata_app"))
+                writePerfData(os.path.join(root, "hsperfdata_app", "2000"), [
+                    ("sun.rt.javaCommand", "org.apache.catalina.startup.Bootstrap start")])
+                watcher = JvmWatcher(root, use_inotify)
+                stopped = []
+                watcher.on_stop.append(stopped.append)
+                self.assertEqual(watcher.jvms(), [(2000, "Bootstrap")])
+
+                os.mkdir(os.path.join(root, "hsperfdata_batch"))
+                watcher.update(0.1)
+                writePerfData(os.path.join(root, "hsperfdata_batch", "2001"), [
+                    ("sun.rt.javaCommand", "/opt/batch/batch.jar --daily")])
+                open(os.path.join(root, "hsperfdata_batch", "2002"), "w").close()
+                watcher.update(0.1)
+                self.assertEqual(watcher.jvms(), [(2000, "Bootstrap"), (2001, "batch.jar")])
+                self.assertEqual(watcher.pending, set([2002]))
+
+                os.remove(os.path.join(root, "hsperfdata_app", "2000"))
+                watcher.update(0.1)
+                self.assertEqual(watcher.jvms(), [(2001, "batch.jar")])
+                self.assertEqual(stopped, [2000])
+
+                # a removed and recreated directory is watched again
+                os.rmdir(os.path.join(root, "hsperfdata_app"))
+                watcher.update(0.1)
+                os.mkdir(os.path.join(root, "hsperfdata_app"))
+                watcher.update(0.1)
+                writePerfData(os.path.join(root, "hsperfdata_app", "2003"), [
+                    ("sun.rt.javaCommand", "org.apache.catalina.startup.Bootstrap start")])
+                watcher.update(0.1)
+                self.assertEqual(watcher.jvms(), [(2001, "batch.jar"), (2003, "Bootstrap")])
+                self.assertEqual(len(watcher.watches), use_inotify and 3 or 0)
+            finally:
+                if watcher is not None:
+                    watcher.close()
+                shutil.rmtree(root)
+
+        # lost events: a queue overflow rescans the directories
+        root = tempfile.mkdtemp()
+        watcher = None
+        try:
+            os.mkdir(os.path.join(root, "hsperfdata_app"))
+            watcher = JvmWatcher(root, False)
+            # a live pid, as the rescan also sweeps exited ones
+            writePerfData(os.path.join(root, "hsperfdata_app", str(os.getpid())), [
+                ("sun.rt.javaCommand", "org.apache.catalina.startup.Bootstrap start")])
+            self.assertEqual(watcher.jvms(), [])
+            watcher._handleEvents(JvmWatcher.EVENT_HEADER.pack(-1, JvmWatcher.IN_Q_OVERFLOW, 0, 0))
+            self.assertEqual(watcher.jvms(), [(os.getpid(), "Bootstrap")])
+        finally:
+            if watcher is not None:
+                watcher.close()
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_causes_1(self):
+        """
+        GC 要因: 要因別の Full GC 時間の集計と除外
+        """
+        sampler = Sampler(self.java_bin)
+        gccause = ("  S0     S1     E      O      M     CCS    YGC     YGCT    FGC    FGCT     GCT    LGCC                 GCC",
+                   "  0.00  52.00  59.00  90.00  97.50  95.00    655   10.000    10    0.500   10.500 System.gc()          No GC")
+        stat = sampler._parseGcCause("\n".join(gccause))
+        self.assertEqual((stat["LGCC"], stat["GCC"], stat["FGC"]), ("System.gc()", "No GC", 10.0))
+
+        root = tempfile.mkdtemp()
+        try:
+            history = HistoryStore(root, self.interval, "causes")
+            stat = dict(self.baseJstatData, LGCC="Allocation Failure")
+            steps = [("System.gc()", 2, 800.0), ("Allocation Failure", 1, 150.0), ("System.gc()", 1, 400.0)]
+            for (cause, count, gc_time) in [(None, 0, 0.0)] + steps:
+                stat = dict(stat, Timestamp=stat["Timestamp"] + self.interval / 2,
+                            FGC=stat["FGC"] + count, FGCT=stat["FGCT"] + gc_time, LGCC=cause or stat["LGCC"])
+                old = history.baseline(stat)
+            self.assertEqual(stat["causes"], {"System.gc()": [3.0, 1200.0], "Allocation Failure": [1.0, 150.0]})
+
+            evaluator = Evaluator()
+            evaluator.applyConfig(self._defaults())
+            result = evaluator.evaluate(stat, old)
+            self.assertEqual(result.state, CheckResult.STATE_CRITICAL)
+            self.assertEqual(result.metrics["gc_causes"], stat["causes"])
+            self.assertTrue(result.message.endswith(
+                "Causes: System.gc() (3 times, 1200 msec), Allocation Failure (1 times, 150 msec)."))
+
+            evaluator.applyConfig(dict(self._defaults(), exclude_causes=["System.gc()"]))
+            result = evaluator.evaluate(stat, old)
+            self.assertEqual(result.state, CheckResult.STATE_OK)
+            self.assertEqual((result.metrics["gc_time"], result.metrics["gc_count"]), (150.0, 1.0))
+
+            # with young GCs in between LGCC tells nothing of the full GCs
+            history = HistoryStore(root, self.interval, "causes_young")
+            stat = dict(self.baseJstatData, LGCC="Allocation Failure", GCC="No GC")
+            history.baseline(stat)
+            for (gcc, fgct) in [("No GC", 300.0), ("System.gc()", 200.0)]:
+                stat = dict(stat, Timestamp=stat["Timestamp"] + self.interval / 2, YGC=stat["YGC"] + 20,
+                            FGC=stat["FGC"] + 1, FGCT=stat["FGCT"] + fgct, GCC=gcc)
+                history.baseline(stat)
+            self.assertEqual(stat["causes"], {"unknown": [1.0, 300.0], "System.gc()": [1.0, 200.0]})
+        finally:
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_promotion_1(self):
+        """
+        早期昇格: Tenuring threshold の低下と Young GC 毎の Old 領域の増加
+        """
+        sampler = Sampler(self.java_bin)
+        jdk8 = ("Timestamp S0 S1 E O M CCS YGC YGCT FGC FGCT GCT",
+                "1800.0 0.00 52.00 59.00 90.00 97.50 95.00 655 10.0 10 500.0 510.0")
+        counters = {
+            "sun.gc.policy.tenuringThreshold": 1,
+            "sun.gc.policy.maxTenuringThreshold": 15,
+            "sun.gc.policy.desiredSurvivorSize": 4 * 1024 * 1024,
+            "sun.gc.generation.0.space.1.used": 0,
+            "sun.gc.generation.0.space.2.used": 6 * 1024 * 1024,
+            "sun.gc.generation.1.space.0.used": 300 * 1024 * 1024}
+        old = sampler._normalize(1, jdk8[0], sampler._parseGcUtil("\n".join(jdk8)), counters)
+        self.assertEqual((old["TT"], old["MTT"], old["DSS"], old["S1U"]), (1.0, 15.0, 4096.0, 6144.0))
+
+        current = dict(old, Timestamp=old["Timestamp"] + self.interval, YGC=old["YGC"] + 20,
+                       OU=old["OU"] + 20 * 5 * 1024, TT=2.0)
+        evaluator = Evaluator()
+        evaluator.applyConfig(dict(self._defaults(), time_warning=1000, time_critical=2000,
+                                   tenuring_warning=2, promotion_warning=4))
+        result = evaluator.evaluate(current, old)
+        self.assertEqual(result.state, CheckResult.STATE_WARNING)
+        self.assertEqual(result.message, "Tenuring threshold collapsed. (2 of 15, survivor 150% of desired), "
+                         "Old generation grows too fast per young GC. (5.0 MB, survivor 150% of desired)")
+        self.assertEqual(result.metrics["promotion"], 5.0)
+        self.assertTrue(NagiosOutput.format(result).endswith(" tenuring_threshold=2;@0:2 promotion=5MB;4"))
+
+        # recovered within the window, or a full GC in it
+        result = evaluator.evaluate(dict(current, TT=7.0, FGC=current["FGC"] + 1), old)
+        self.assertEqual(result.state, CheckResult.STATE_OK)
+        self.assertFalse("promotion" in result.metrics)
+        self.assertRaises(ValueError, evaluator.setPromotion, -1, None)
+
+    # ----------------------------------------------
+
+    def test_gc_cpu_1(self):
+        """
+        GC スレッドの CPU 時間: /proc のタスク毎の集計とプロセス・ホストに対する割合
+        """
+        pid = os.getpid()
+        comm = "/proc/%d/task/%d/comm" % (pid, pid)
+        saved_name = open(comm).read().strip()
+        sampler = Sampler(self.java_bin)
+        try:
+            f = open(comm, "w")
+            f.write("GC Thread#0")
+            f.close()
+            (gc_cpu, cpu) = sampler.getThreadCpu(pid)
+            end = time.time() + 0.2
+            while time.time() < end:
+                pass
+            f = open(comm, "w")
+            f.write(saved_name)
+            f.close()
+            # classified by tid once
+            (gc_cpu2, cpu2) = sampler.getThreadCpu(pid)
+        finally:
+            f = open(comm, "w")
+            f.write(saved_name)
+            f.close()
+        self.assertTrue(sampler.threads[pid][str(pid)])
+        self.assertTrue(gc_cpu2 - gc_cpu > 0.1)
+        self.assertTrue(cpu2 >= gc_cpu2)
+        sampler.forget(pid)
+        self.assertFalse(pid in sampler.threads)
+
+        old = dict(self.baseJstatData, GCCPU=100.0, CPU=1000.0, NCPU=8)
+        current = dict(old, Timestamp=old["Timestamp"] + self.interval, GCCPU=250.0, CPU=1300.0)
+        evaluator = Evaluator()
+        evaluator.applyConfig(dict(self._defaults(), time_warning=1000, time_critical=2000,
+                                   gc_cpu_warning=30, gc_cpu_critical=60,
+                                   gc_cpu_host_warning=10, gc_cpu_host_critical=20))
+        result = evaluator.evaluate(current, old)
+        self.assertEqual(result.state, CheckResult.STATE_WARNING)
+        self.assertEqual(result.message, "GC threads use too much CPU. (50.0% of process), "
+                         "GC threads use too much CPU. (1.5 cores, 18.8% of host)")
+        self.assertEqual(result.perfdata[-1], ("gc_cpu_host", 18.75, "%", 10.0, 20.0))
+
+    # ----------------------------------------------
+
+    def test_gc_cpu_2(self):
+        """
+        GC スレッドの CPU 時間: プラグインとしての実行 (main) でも判定される
+        """
+        root = tempfile.mkdtemp()
+        saved_argv = sys.argv
+        saved_stdout = sys.stdout
+        try:
+            jdk = _FakeJdk(root, 1, self.interval)
+            (name, fake_pid) = jdk.pids.items()[0]
+            pid = os.getpid()
+            os.rename(os.path.join(jdk.perf_dir, str(fake_pid)), os.path.join(jdk.perf_dir, str(pid)))
+            f = open(os.path.join(root, "jps.out"), "w")
+            f.write("%d %s\n" % (pid, name))
+            f.close()
+            jdk.pids = {name: pid}
+            history = HistoryStore(root, self.interval)
+            arguments = ["check_jvm.py", "-n", name, "-b", jdk.bin_dir, "-t", root, "-i", str(self.interval),
+                         "--perfdata-dir", root]
+
+            # without a GC CPU threshold /proc is not read
+            sys.argv = arguments
+            jdk.setStep(0)
+            sys.stdout = StringIO.StringIO()
+            check_jvm.main()
+            sys.stdout = saved_stdout
+            self.assertEqual(history.loadThreads(pid), {})
+            self.assertFalse("GCCPU" in history._loadJson(os.path.join(root, history.tempfile_name % "1")))
+
+            sys.argv = arguments + ["--gc-cpu-warning", "0", "--gc-cpu-host-warning", "0"]
+            for step in [1, 2]:
+                jdk.setStep(step)
+                sys.stdout = StringIO.StringIO()
+                ret = check_jvm.main()
+                output = sys.stdout.getvalue()
+                sys.stdout = saved_stdout
+            self.assertEqual(ret, CheckResult.STATE_WARNING)
+            self.assertTrue(output.startswith("WARNING: GC threads use too much CPU."))
+            self.assertTrue(output.endswith(" gc_cpu=0%;0 gc_cpu_host=0%;0\n"))
+            # the classification is kept for the next run
+            self.assertFalse(history.loadThreads(pid)[str(pid)])
+            self.assertEqual(history.loadThreads(pid + 1), {})
+
+            evaluator = Evaluator()
+            self.assertFalse(evaluator.needsThreadCpu())
+            evaluator.addRule(CheckResult.STATE_WARNING, "rate(GCCPU) / NCPU > 0.5")
+            self.assertTrue(evaluator.needsThreadCpu())
+        finally:
+            sys.argv = saved_argv
+            sys.stdout = saved_stdout
+            shutil.rmtree(root)
+
+    # ----------------------------------------------
+
+    def test_advisor_1(self):
+        """
+        ヒープサイズの推奨: Full GC 後の生存量・Young GC の頻度・GC のオーバーヘッド
+        """
+        root = tempfile.mkdtemp()
+        try:
+            history = HistoryStore(root, self.interval, "advisor")
+            start = 1000000 * 600
+            stat = dict(self.baseJstatData, EC=100 * 1024.0, OC=1024 * 1024.0, OU=200 * 1024.0)
+            for step in range(0, 288):
+                # young GC every 10 sec (50 msec), full GC every 2 hours (2 sec)
+                stat = dict(stat, YGC=stat["YGC"] + 30, YGCT=stat["YGCT"] + 1500.0, OU=stat["OU"] + 5 * 1024)
+                if step % 24 == 23:
+                    stat = dict(stat, FGC=stat["FGC"] + 1, FGCT=stat["FGCT"] + 2000.0, OU=200 * 1024.0)
+                history.record(stat, start + step * 300, 1, None)
+            now = start + 288 * 300
+
+            advisor = HeapAdvisor.fromArchive(history, 86400, now)
+            self.assertEqual(advisor.live, 200 * 1024.0)
+            self.assertEqual(advisor.full_gcs, 12)
+            self.assertEqual(advisor.recommend(200, 0.05), (700 * 1024.0, 300 * 1024.0))
+            self.assertEqual(advisor.report(200, 0.05)[2:], [
+                "young GC: every 10.0 sec, 50 msec, eden 100 MB (10.0 MB/s allocated)",
+                "full GC: 12 times, 2000 msec",
+                "GC overhead: 0.5% (young 0.5%, full 0.0%)",
+                "recommended: -Xms700m -Xmx700m -Xmn300m"])
+            # young pauses over the target shrink the young generation
+            self.assertEqual(advisor.recommend(20, 0.05), (440 * 1024.0, 40 * 1024.0))
+
+            # the open row of the next 10 minutes is not counted yet
+            stat = dict(stat, YGC=stat["YGC"] + 30, YGCT=stat["YGCT"] + 1500.0)
+            history.record(stat, now, 1, None)
+            advisor = HeapAdvisor.fromArchive(history, 86400, now + 60)
+            self.assertEqual(advisor.elapsed, 143 * 600.0)
+            self.assertEqual(advisor.totals["YGC"], 143 * 60.0)
+            self.assertEqual(advisor.overhead()[0], 0.005)
+        finally:
+            shutil.rmtree(root)
+
 # ----------------------------------------------
 
 if __name__ == '__main__':